@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Deletion, recycle, and shred pipeline benchmarks for careful_rm.
+
+Synthesizes trees, then runs careful_rm.main() on them in a fresh
+interpreter for every mode, answering any prompt automatically. Reports
+latency, throughput, the filesystem calls careful_rm made (counted with
+audit hooks, so lstat is not included), read/write syscalls (from
+/proc/self/io), and processes spawned. Results are compared against a
+stored baseline. Requires python 3.8+ (for audit hooks) to run, careful_rm
+itself does not.
+
+Scenarios
+---------
+    small       many small files spread over a few hundred directories
+    huge        a few large files
+    deep        one very deep chain of directories
+    mounts      files spread over every writable device found (the temp
+                dir, /dev/shm, the current directory)
+    collisions  many files with the same name, so the trash renames them
+
+Modes
+-----
+    dryrun      -rf --dryrun
+    delete      -rf --direct
+    recycle     -rfc
+    shred       -rfs
+    fast        -rf --fast (timed until careful_rm returns, the background
+                reaper is waited for before the next run)
+
+Usage: bench_pipeline.py [-n RUNS] [--scale X] [--only NAME ..] [--save]
+                         [--check] [--baseline FILE]
+
+    -n RUNS          runs of each scenario and mode, the median is reported,
+                     default 3
+    --scale X        multiply the size of every scenario by X, default 1
+    --only NAME      only run scenarios or modes called NAME, may be given
+                     more than once
+    --save           store the results as the baseline, with the commit
+                     (and python) they were taken with
+    --check          exit 1 if anything is more than 50% slower, or makes
+                     more calls, than the baseline
+    --baseline FILE  default benchmarks/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+# Allowed slowdown before --check fails, times are noisy
+TOLERANCE = 0.5
+
+MODES = [
+    ('dryrun', ['-rf', '--dryrun']),
+    ('delete', ['-rf', '--direct']),
+    ('recycle', ['-rfc']),
+    ('shred', ['-rfs']),
+    ('fast', ['-rf', '--fast']),
+]
+
+# Executed in the child interpreter, prints one line of JSON
+CHILD = r'''
+import os, sys, json, time
+SPAWN = {
+    'subprocess.Popen', 'os.system', 'os.posix_spawn', 'os.fork',
+    'os.forkpty', 'os.exec', 'os.spawn',
+}
+FS = {
+    'open', 'os.remove', 'os.rmdir', 'os.rename', 'os.listdir',
+    'os.scandir', 'os.mkdir', 'os.chmod', 'os.utime', 'os.truncate',
+    'os.symlink', 'os.link', 'os.fwalk', 'os.walk', 'shutil.move',
+    'shutil.copyfile', 'shutil.rmtree',
+}
+counts = {'spawns': 0, 'calls': 0}
+active = [False]
+def hook(event, args):
+    if not active[0]:
+        return
+    if event in SPAWN:
+        counts['spawns'] += 1
+    elif event in FS:
+        counts['calls'] += 1
+sys.addaudithook(hook)
+sys.path.insert(0, sys.argv[1])
+import careful_rm
+
+def answer(message):
+    if 'skip/create/root/del' in message:
+        return 'root'
+    if 'add/ignore/cancel' in message:
+        return 'add'
+    return 'y'
+careful_rm.read_input = answer
+
+def io_counts():
+    try:
+        with open('/proc/self/io') as fin:
+            vals = dict(l.split(': ') for l in fin.read().splitlines())
+        return int(vals['syscr']) + int(vals['syscw'])
+    except (IOError, OSError, KeyError, ValueError):
+        return 0
+
+argv = ['careful_rm.py'] + json.loads(sys.argv[2])
+# Keep the (possibly large) output of verbose or dry runs off the pipe
+out = os.dup(1)
+null = os.open(os.devnull, os.O_WRONLY)
+os.dup2(null, 1)
+os.dup2(null, 2)
+io_start = io_counts()
+active[0] = True
+start = time.time()
+code = careful_rm.main(argv)
+elapsed = time.time() - start
+active[0] = False
+counts['rw_syscalls'] = io_counts() - io_start
+counts.update(code=code, time=elapsed)
+os.write(out, (json.dumps(counts) + '\n').encode())
+'''
+
+
+###############################################################################
+#                               Tree Builders                                 #
+###############################################################################
+
+
+def find_roots(base):
+    """Return one writable directory per distinct device, base first."""
+    roots = {os.stat(base).st_dev: base}
+    for cand in ['/dev/shm', os.getcwd()]:
+        if not os.path.isdir(cand) or not os.access(cand, os.W_OK):
+            continue
+        dev = os.stat(cand).st_dev
+        if dev not in roots:
+            roots[dev] = tempfile.mkdtemp(prefix='careful_rm_bench_', dir=cand)
+    return list(roots.values())
+
+
+def write_file(path, size=0):
+    """Create path with size bytes (written, not sparse, so shred has work)."""
+    with open(path, 'wb') as fout:
+        chunk = b'x' * min(size, 1024 * 1024)
+        left = size
+        while left > 0:
+            fout.write(chunk[:left])
+            left -= len(chunk)
+
+
+def build_small(root, scale):
+    """Many small files in a few hundred directories."""
+    count = int(20000 * scale)
+    per_dir = 100
+    for i in range(count):
+        dr = os.path.join(root, 'tree', 'd{0}'.format(i // per_dir))
+        if not i % per_dir:
+            os.makedirs(dr)
+        write_file(os.path.join(dr, 'f{0}'.format(i)), 512)
+    return [os.path.join(root, 'tree')], count, count * 512
+
+
+def build_huge(root, scale):
+    """A few large files."""
+    size = int(64 * 1024 * 1024 * scale)
+    os.makedirs(os.path.join(root, 'tree'))
+    for i in range(4):
+        write_file(os.path.join(root, 'tree', 'big{0}'.format(i)), size)
+    return [os.path.join(root, 'tree')], 4, 4 * size
+
+
+def build_deep(root, scale):
+    """One chain of nested directories, each with a file."""
+    depth = int(300 * scale)
+    dr = os.path.join(root, 'tree')
+    os.makedirs(dr)
+    fd = os.open(dr, os.O_RDONLY)
+    try:
+        # Relative to a directory fd, so depth is not limited by PATH_MAX
+        for i in range(depth):
+            os.mkdir('d', dir_fd=fd)
+            new = os.open('d', os.O_RDONLY, dir_fd=fd)
+            os.close(fd)
+            fd = new
+            os.close(os.open('f', os.O_WRONLY | os.O_CREAT, dir_fd=fd))
+    finally:
+        os.close(fd)
+    return [os.path.join(root, 'tree')], depth * 2, 0
+
+
+def build_mounts(root, scale, roots=None):
+    """Files spread over every writable device."""
+    count = int(2000 * scale)
+    targets = []
+    for num, base in enumerate(roots or [root]):
+        dr = os.path.join(base, 'tree{0}'.format(num))
+        os.makedirs(dr)
+        for i in range(count // len(roots or [root])):
+            write_file(os.path.join(dr, 'f{0}'.format(i)), 512)
+        targets.append(dr)
+    return targets, count, count * 512
+
+
+def build_collisions(root, scale):
+    """Files in separate directories with the same name, passed directly."""
+    count = int(500 * scale)
+    targets = []
+    for i in range(count):
+        dr = os.path.join(root, 'tree', 'd{0}'.format(i))
+        os.makedirs(dr)
+        write_file(os.path.join(dr, 'same'), 512)
+        targets.append(os.path.join(dr, 'same'))
+    return targets, count, count * 512
+
+
+SCENARIOS = [
+    ('small', build_small),
+    ('huge', build_huge),
+    ('deep', build_deep),
+    ('mounts', build_mounts),
+    ('collisions', build_collisions),
+]
+
+
+###############################################################################
+#                                  Running                                    #
+###############################################################################
+
+
+def mount_of(path):
+    """Return the mountpoint containing path."""
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def wait_for_reapers(dirs, timeout=120):
+    """Wait until no fast delete staging directory is left in dirs.
+
+    The mountpoints of dirs are checked too, as that is where staging
+    directories go when writable.
+    """
+    dirs = set(dirs) | set(mount_of(d) for d in dirs)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        left = [
+            d for d in dirs for name in os.listdir(d)
+            if name.startswith('.careful_rm_reap')
+        ]
+        if not left:
+            return
+        time.sleep(0.05)
+
+
+def run_once(name, builder, mode_args, scale, env, home, roots):
+    """Build a tree, run careful_rm on it, return a result dictionary."""
+    work = tempfile.mkdtemp(prefix='run_', dir=home)
+    if name == 'mounts':
+        roots = [work] + [tempfile.mkdtemp(dir=r) for r in roots[1:]]
+        targets, items, nbytes = builder(work, scale, roots)
+    else:
+        roots = [work]
+        targets, items, nbytes = builder(work, scale)
+    try:
+        out = subprocess.check_output(
+            [sys.executable, '-c', CHILD, REPO,
+             json.dumps(mode_args + targets)],
+            env=env
+        )
+        res = json.loads(out.decode().strip().splitlines()[-1])
+        wait_for_reapers([home] + roots)
+    finally:
+        for root in roots:
+            shutil.rmtree(root, ignore_errors=True)
+    res.update(items=items, bytes=nbytes)
+    return res
+
+
+def median(vals):
+    """Return the median of vals."""
+    vals = sorted(vals)
+    return vals[len(vals) // 2]
+
+
+def describe_commit():
+    """Return the commit careful_rm.py is at, None if it is not in git.
+
+    '-dirty' is added if careful_rm.py has uncommitted changes.
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+        dirty = subprocess.call(
+            ['git', 'diff', '--quiet', 'HEAD', '--', 'careful_rm.py'],
+            cwd=REPO, stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def compare(results, baseline):
+    """Print results against baseline, return a list of regressions."""
+    regressions = []
+    meta = baseline.get('_meta')
+    if meta:
+        sys.stdout.write('Baseline from commit {0}, python {1}, {2}\n'.format(
+            meta.get('commit'), meta.get('python'), meta.get('date')
+        ))
+    sys.stdout.write(
+        '{0:<20} {1:>8} {2:>9} {3:>10} {4:>9} {5:>8} {6:>8} {7:>6} '
+        '{8:>8}\n'.format(
+            'benchmark', 'items', 'time (s)', 'items/s', 'MB/s', 'calls',
+            'rw', 'spawn', 'vs base'
+        )
+    )
+    for key in sorted(results):
+        res = results[key]
+        base = baseline.get(key)
+        delta = ''
+        if base:
+            delta = '{0:+.0f}%'.format(
+                (res['time'] / max(base['time'], 1e-6) - 1) * 100
+            )
+            if res['time'] > base['time'] * (1 + TOLERANCE) and \
+                    res['time'] - base['time'] > 0.05:
+                regressions.append('{0} time {1:.3f}s, was {2:.3f}s'.format(
+                    key, res['time'], base['time']
+                ))
+            for count in ['calls', 'spawns']:
+                if res[count] > base[count] * 1.1 + 2:
+                    regressions.append('{0} {1} {2}, was {3}'.format(
+                        key, count, res[count], base[count]
+                    ))
+        sys.stdout.write(
+            '{0:<20} {1:>8} {2:>9.3f} {3:>10.0f} {4:>9.1f} {5:>8} {6:>8} '
+            '{7:>6} {8:>8}\n'.format(
+                key, res['items'], res['time'],
+                res['items'] / max(res['time'], 1e-6),
+                res['bytes'] / 1048576.0 / max(res['time'], 1e-6),
+                res['calls'], res['rw_syscalls'], res['spawns'], delta
+            )
+        )
+    return regressions
+
+
+def main(argv=None):
+    """Run the benchmarks, print a table, compare to or save the baseline."""
+    argv = sys.argv[1:] if argv is None else argv
+    runs = int(argv[argv.index('-n') + 1]) if '-n' in argv else 3
+    scale = float(argv[argv.index('--scale') + 1]) \
+        if '--scale' in argv else 1.0
+    baseline_file = argv[argv.index('--baseline') + 1] \
+        if '--baseline' in argv else BASELINE
+    only = [argv[i + 1] for i, arg in enumerate(argv) if arg == '--only']
+
+    home = tempfile.mkdtemp(prefix='careful_rm_bench_')
+    user = os.path.basename(home)
+    env = dict(
+        os.environ, HOME=home, USER=user, LOGNAME=user,
+        CAREFUL_RM_NO_DAEMON='1', XDG_CACHE_HOME=os.path.join(home, '.cache')
+    )
+    env.pop('CAREFUL_RM_JOURNAL', None)
+    roots = find_roots(home)
+    results = {}
+    try:
+        for name, builder in SCENARIOS:
+            for mode, mode_args in MODES:
+                if only and name not in only and mode not in only:
+                    continue
+                runs_ = [
+                    run_once(name, builder, mode_args, scale, env, home,
+                             roots)
+                    for _ in range(runs)
+                ]
+                res = dict(runs_[0])
+                for key in ['time', 'calls', 'rw_syscalls', 'spawns']:
+                    res[key] = median([r[key] for r in runs_])
+                results['{0}/{1}'.format(name, mode)] = res
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+        shutil.rmtree('/tmp/{0}_trash'.format(user), ignore_errors=True)
+        for root in roots[1:]:
+            shutil.rmtree(root, ignore_errors=True)
+
+    try:
+        with open(baseline_file) as fin:
+            baseline = json.load(fin)
+    except (IOError, OSError, ValueError):
+        baseline = {}
+    regressions = compare(results, baseline)
+    if '--save' in argv:
+        baseline.update(dict(
+            (key, dict((k, res[k]) for k in
+                       ['time', 'calls', 'rw_syscalls', 'spawns', 'items']))
+            for key, res in results.items()
+        ))
+        baseline['_meta'] = {
+            'commit': describe_commit(),
+            'python': '.'.join(str(i) for i in sys.version_info[:3]),
+            'date': time.strftime('%Y-%m-%d'),
+        }
+        with open(baseline_file, 'w') as fout:
+            json.dump(baseline, fout, indent=2, sort_keys=True)
+            fout.write('\n')
+        sys.stdout.write('Saved baseline to {0}\n'.format(baseline_file))
+    if regressions:
+        sys.stderr.write('Slower than the baseline:\n    {0}\n'.format(
+            '\n    '.join(regressions)
+        ))
+        if '--check' in argv:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
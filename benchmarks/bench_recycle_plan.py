@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Recycle planning benchmark for careful_rm.
+
+Creates many empty files spread over every distinct writable mount it can
+find (the temp dir, /dev/shm, the current directory), then times
+plan_recycle and RecyclePlan.resolve on them. Nothing is moved, and
+resolve is answered 'skip' for every missing trash, counting the prompts.
+
+Usage: bench_recycle_plan.py [-n FILES]
+
+    -n FILES  total number of files to create, default 100000
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import careful_rm  # noqa: E402
+
+
+def find_roots():
+    """Return one writable temp directory per distinct device."""
+    roots = {}
+    for cand in [tempfile.gettempdir(), '/dev/shm', os.getcwd()]:
+        if not os.path.isdir(cand) or not os.access(cand, os.W_OK):
+            continue
+        dev = os.stat(cand).st_dev
+        if dev not in roots:
+            roots[dev] = tempfile.mkdtemp(prefix='careful_rm_bench_', dir=cand)
+    return list(roots.values())
+
+
+def make_files(roots, count, per_dir=1000):
+    """Create count empty files spread across roots, return their paths."""
+    files = []
+    for i in range(count):
+        root = roots[i % len(roots)]
+        dr = os.path.join(root, 'd{0}'.format(i // per_dir))
+        if not os.path.isdir(dr):
+            os.mkdir(dr)
+        fl = os.path.join(dr, 'f{0}'.format(i))
+        open(fl, 'w').close()
+        files.append(fl)
+    return files
+
+
+def main(argv=None):
+    """Run the benchmark and print a summary."""
+    argv = sys.argv[1:] if argv is None else argv
+    count = int(argv[argv.index('-n') + 1]) if '-n' in argv else 100000
+    roots = find_roots()
+    prompts = []
+
+    def fake_ans(message, options, default=None, key=None):
+        prompts.append(message)
+        return 'skip'
+
+    careful_rm.get_ans = fake_ans
+    try:
+        files = make_files(roots, count)
+        start = time.time()
+        plan = careful_rm.plan_recycle(files)
+        planned = time.time()
+        plan.resolve()
+        resolved = time.time()
+    finally:
+        for root in roots:
+            shutil.rmtree(root, ignore_errors=True)
+    sys.stdout.write(
+        'files: {0} on {1} mounts, {2} (device, trash) groups\n'
+        'plan: {3:.1f} ms ({4:.2f} us/file)\n'
+        'resolve: {5:.1f} ms, {6} prompts\n'.format(
+            len(files), len(roots), len(plan.groups),
+            (planned - start) * 1000, (planned - start) * 1e6 / len(files),
+            (resolved - planned) * 1000, len(prompts),
+        )
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
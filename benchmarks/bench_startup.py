@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Startup benchmark for careful_rm.
+
+Times ``rm -f <file>`` three ways, several times each: running
+careful_rm.py as a script (compiled every time, scripts are never cached),
+running careful_rm_client.py with no daemon (the way the rm alias does, it
+imports careful_rm from cached bytecode), and running careful_rm_client.py
+with a daemon started for the benchmark. Then imports careful_rm in a fresh
+interpreter running main() the same way, to count the child processes
+spawned, split into those spawned while importing the module and those
+spawned by main(). Requires python 3.8+ (for audit hooks) to run,
+careful_rm itself does not.
+
+Usage: bench_startup.py [-n RUNS] [--check]
+
+    -n RUNS   number of interpreter launches, default 20
+    --check   exit 1 if importing careful_rm spawned any process
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import py_compile
+import subprocess
+import importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+SCRIPT = os.path.join(REPO, 'careful_rm.py')
+CLIENT = os.path.join(REPO, 'careful_rm_client.py')
+
+# Executed in the child interpreter, prints one line of JSON
+CHILD = r'''
+import sys, json
+SPAWN = {
+    'subprocess.Popen', 'os.system', 'os.posix_spawn', 'os.fork',
+    'os.forkpty', 'os.exec', 'os.spawn',
+}
+counts = {'import': 0, 'main': 0}
+phase = ['import']
+def hook(event, args):
+    if event in SPAWN:
+        counts[phase[0]] += 1
+sys.addaudithook(hook)
+sys.path.insert(0, sys.argv[1])
+import careful_rm
+phase[0] = 'main'
+code = careful_rm.main(['careful_rm.py', '-f', sys.argv[2]])
+print(json.dumps({'code': code, 'spawned': counts}))
+'''
+
+
+def make_target(home):
+    """Return the path of a fresh file to remove in home."""
+    target = os.path.join(home, 'somefile')
+    with open(target, 'w') as fout:
+        fout.write('x')
+    return target
+
+
+def time_rm(home, script, env):
+    """Run script -f on a fresh file in home, return seconds."""
+    target = make_target(home)
+    start = time.time()
+    subprocess.check_call([sys.executable, script, '-f', target], env=env)
+    return time.time() - start
+
+
+def start_daemon(env):
+    """Start a daemon with env, return once it listens."""
+    subprocess.check_call(
+        [sys.executable, SCRIPT, '--daemon'], env=env,
+        stderr=subprocess.DEVNULL,
+    )
+    sock = os.path.join(env['XDG_RUNTIME_DIR'], 'careful_rm.sock')
+    for _ in range(100):
+        if os.path.exists(sock):
+            return
+        time.sleep(0.05)
+    raise RuntimeError('daemon did not start')
+
+
+def stop_daemon(env):
+    """Stop the daemon started with env."""
+    subprocess.call(
+        [sys.executable, SCRIPT, '--stop-daemon'], env=env,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def summary(name, times):
+    """Return a line of min/median/max of times in ms."""
+    times = sorted(times)
+    return '{0}: min {1:.1f} ms, median {2:.1f} ms, max {3:.1f} ms\n'.format(
+        name, times[0] * 1000, times[len(times) // 2] * 1000,
+        times[-1] * 1000,
+    )
+
+
+def count_spawns(home):
+    """Run careful_rm once imported on a fresh file, return the result."""
+    target = make_target(home)
+    env = dict(os.environ, HOME=home, CAREFUL_RM_NO_DAEMON='1')
+    out = subprocess.check_output(
+        [sys.executable, '-c', CHILD, REPO, target], env=env
+    )
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def main(argv=None):
+    """Run the benchmark and print a summary."""
+    argv = sys.argv[1:] if argv is None else argv
+    runs = int(argv[argv.index('-n') + 1]) if '-n' in argv else 20
+    # As after an install or the first import, the client relies on it
+    py_compile.compile(SCRIPT, cfile=importlib.util.cache_from_source(SCRIPT))
+    home = tempfile.mkdtemp(prefix='careful_rm_bench_')
+    run_dir = os.path.join(home, 'run')
+    os.mkdir(run_dir, 0o700)
+    env = dict(os.environ, HOME=home, XDG_RUNTIME_DIR=run_dir)
+    no_daemon = dict(env, CAREFUL_RM_NO_DAEMON='1')
+    try:
+        script, client, daemon = [], [], []
+        import_spawns = 0
+        main_spawns = 0
+        for _ in range(runs):
+            script.append(time_rm(home, SCRIPT, no_daemon))
+            client.append(time_rm(home, CLIENT, env))
+            res = count_spawns(home)
+            import_spawns += res['spawned']['import']
+            main_spawns += res['spawned']['main']
+        start_daemon(env)
+        try:
+            for _ in range(runs):
+                daemon.append(time_rm(home, CLIENT, env))
+        finally:
+            stop_daemon(env)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+    sys.stdout.write(
+        'runs: {0}\n'.format(runs) + summary('careful_rm.py', script) +
+        summary('client, no daemon', client) +
+        summary('client, daemon', daemon) +
+        'processes spawned per run: import {0:.1f}, main {1:.1f}\n'.format(
+            float(import_spawns) / runs, float(main_spawns) / runs,
+        )
+    )
+    if '--check' in argv and import_spawns:
+        sys.stderr.write('FAIL: importing careful_rm spawned processes\n')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -26,6 +26,10 @@ CAREFUL_RM_DIR="$( cd -P "$( dirname "$SOURCE" )" && pwd )"
 # Try to use our version first
 CAREFUL_RM="${CAREFUL_RM_DIR}/careful_rm.py"
 
+# rm runs the small client, which passes requests to the daemon if one is
+# running, and imports careful_rm (cached, unlike a script) if not
+CAREFUL_RM_CLIENT="${CAREFUL_RM_DIR}/careful_rm_client.py"
+
 # Get the *system* python, the python script should work everywhere, even on
 # old systems, by using system python by default, we can avoid possible issues
 # with faulty python installs.  This is not used if we end up using a pip
@@ -89,7 +93,11 @@ if [ -z "${_USE_PIP}" ]; then
     alias rm="${CAREFUL_RM}"
     alias trash_dir="${CAREFUL_RM} --get-trash \${PWD}"
 elif [ -f "${CAREFUL_RM}" ]; then
-    alias rm="${_PY} ${CAREFUL_RM}"
+    if [ -f "${CAREFUL_RM_CLIENT}" ]; then
+        alias rm="${_PY} ${CAREFUL_RM_CLIENT}"
+    else
+        alias rm="${_PY} ${CAREFUL_RM}"
+    fi
     # Alias careful_rm if it isn't installed via pip already
     if ! hash careful_rm 2>/dev/null; then
         alias careful_rm="${_PY} ${CAREFUL_RM}"
@@ -102,4 +110,4 @@ fi
 
 unset _PY _USE_PIP _pth _pos_paths _pyver
 
-export CAREFUL_RM CAREFUL_RM_DIR
+export CAREFUL_RM CAREFUL_RM_DIR CAREFUL_RM_CLIENT
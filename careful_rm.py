@@ -16,8 +16,8 @@ and will disable recycle mode. Passing --direct will force disable recycle
 mode without enabling shred.
 
 Note: splits files, directories, and other non-files (e.g. sockets) and
-handles them separately. non-files are always deleted with rm after checking
-with the user.
+handles them separately. non-files are always deleted after checking with the
+user. All deletion is done in-process, without calling rm.
 
 Usage: careful_rm.py [-c] [-f | -i] [-dPRrvW] file ..
 
@@ -27,25 +27,91 @@ Arguments
                           ~/.rm_recycle)
     -s, --shred           run shred on all files (recursively if directories
                           included) prior to deleting, override recycle
+        --shred-passes=N  overwrite N times (default 3) before zeroing,
+                          implies --shred
+        --shred-external  use the shred executable instead of shredding
+                          in-process, implies --shred
         --direct          force off recycling, even if ~/.rm_recycle exists
+        --background-copy recycle to trashes on other devices (a slow copy)
+                          in the background and return immediately
+        --dedup           store identical recycled files (of 1M or more)
+                          once, as hard links to one copy in the trash,
+                          forced on by ~/.rm_dedup
+        --compress        compress files (of 64K or more) recycled over 30
+                          minutes ago, in the background at idle priority,
+                          forced on by ~/.rm_compress, they are decompressed
+                          when restored
+        --fast            move what is deleted out of the way and return
+                          immediately, it is deleted in the background
+                          (without asking about write-protected files)
+        --max-ops-per-sec=N
+                          at most N unlinks, renames, etc. per second
+        --max-bytes-per-sec=SIZE
+                          copy or shred at most SIZE (e.g. 50M) per second
+        --io-class=CLASS  I/O scheduling class, idle, best-effort, or
+                          realtime (as ionice), idle also sets nice 19
         --dryrun          do not actually remove or move files, just print
+        --policy=FILE     decide what to recycle, delete, or refuse, and
+                          answer prompts, by the rules in FILE (default
+                          ~/.rm_policy or $CAREFUL_RM_POLICY, used if it
+                          exists), see Policy in careful_rm.py
+        --no-policy       ignore any policy file
+        --progress        show a status line with rates and an ETA while
+                          deleting, shredding, or recycling (the default if
+                          STDERR is a terminal, unless -v or -i)
+        --no-progress     never show the status line
+        --progress-fd=N   write progress to file descriptor N, as a JSON
+                          line every second and when each step ends
+        --stats           print the time taken by each step when done
+        --journal[=PATH]  append what was done, and how long each step took,
+                          to PATH (default
+                          ~/.local/state/careful_rm/journal.jsonl), forced
+                          on by ~/.rm_journal or $CAREFUL_RM_JOURNAL
+        --get-trash [DIR] print the trash used for DIR (default .), cached
+        --get-trash-many DIR ..
+                          print the trash for each DIR (or line of STDIN),
+                          one per line
+    -0, --from0           file names read from STDIN (with -) are separated
+                          by NUL (e.g. find -print0), are not globbed, and are
+                          streamed in batches
+        --stdin0          same as -0 -
+        --list-trash [PATTERN]
+                          list recycled files (matching PATTERN, a glob of
+                          the original path or name), newest last
+        --restore PATTERN move recycled files matching PATTERN back to where
+                          they were deleted from
+        --trash-usage     print the size of every trash
+        --purge           permanently delete from every trash, the oldest
+                          deleted first, either:
+        --older-than AGE  everything deleted more than AGE (e.g. 7d, 12h,
+                          2w) ago
+        --max-size SIZE   until each trash uses at most SIZE (e.g. 50G)
+        --compress-trash [--older-than AGE]
+                          compress files recycled more than AGE (default
+                          30m) ago now, zstd if python has it, else gzip
+        --daemon          start a background server that runs rm requests
+                          without loading careful_rm each time, used
+                          automatically when running (unless
+                          $CAREFUL_RM_NO_DAEMON is set), fastest through
+                          careful_rm_client.py, which the alias runs
+        --stop-daemon     stop the background server
     -h, --help            display this help and exit
 
-All other arguments passed to rm
+All other arguments are interpreted as by rm
 
 Common rm arguments
 -------------------
     -f, --force           ignore nonexistent files and arguments, never prompt
     -i                    prompt before every removal
     -I                    prompt once before removing more than three files, or
-                          when removing recursively
+                          when removing recursively (careful_rm always does)
     -r, -R, --recursive   remove directories and their contents recursively
     -d, --dir             remove empty directories
     -v, --verbose         explain what is being done
 
-For full help for rm, see `man rm`, note that only the '-i', '-f' and '-v'
-options have any meaning in recycle mode, which uses `mv`. Argument order does
-not matter.
+For full help for rm, see `man rm`, note that only the '-v' option has any
+meaning in recycle mode, which never overwrites anything in the trash (files
+with the same name get a numbered suffix). Argument order does not matter.
 
 This tool should ideally be aliased to rm, add this to your bashrc/zshrc:
 
@@ -56,13 +122,25 @@ This tool should ideally be aliased to rm, add this to your bashrc/zshrc:
     fi
 """
 import os
+import re
 import sys
+import errno
+import stat
+import json
+import mmap
+import time
 import signal
+import shutil
+import threading
 import shlex as sh
 from glob import glob
+from fnmatch import fnmatch, translate
+from heapq import nlargest
+from itertools import chain
 from getpass import getuser
 from platform import system
 from datetime import datetime as dt
+from collections import namedtuple
 from collections import defaultdict as dd
 from subprocess import call, Popen, PIPE, CalledProcessError
 try:
@@ -82,6 +160,12 @@ DOCSTR = '{0}\nCUTOFF: {1} (more files than this results in warning\n'.format(
 # Print on one line if fewer than this number
 MAX_LINE = 2
 
+# Longer lists are cut to their first and last half of this many items, with
+# the LIST_GROUPS directories and extensions with the most items in them,
+# the full list can be paged from the prompt
+LIST_PREVIEW = 100
+LIST_GROUPS = 5
+
 # Where to move files to if recycled system-wide
 RECYCLE_BIN = os.path.expandvars('/tmp/{0}_trash'.format(getuser()))
 
@@ -166,6 +250,43 @@ def check_output(cmd, shell=False):
     return stdout
 
 
+def which(prog, path=None):
+    """Return the full path to prog if it is on the PATH, else None.
+
+    Done in-process, so finding a tool never costs a shell fork.
+
+    Params
+    ------
+    prog : str
+    path : str, optional
+        os.pathsep separated search path, defaults to $PATH
+    """
+    if hasattr(shutil, 'which'):
+        return shutil.which(prog, path=path)
+    if path is None:
+        path = os.environ.get('PATH', os.defpath)
+    for pth in path.split(os.pathsep):
+        fpth = os.path.join(pth, prog)
+        if os.path.isfile(fpth) and os.access(fpth, os.X_OK):
+            return fpth
+    return None
+
+
+def get_term_width(default=80):
+    """Return the width of the terminal without forking `tput`."""
+    try:
+        return int(os.environ['COLUMNS'])
+    except (KeyError, ValueError):
+        pass
+    if hasattr(os, 'get_terminal_size'):
+        for stream in (sys.stderr, sys.stdout):
+            try:
+                return os.get_terminal_size(stream.fileno()).columns
+            except (AttributeError, OSError, ValueError):
+                continue
+    return default
+
+
 ###############################################################################
 #               Constants the need the python compat functions                #
 ###############################################################################
@@ -177,9 +298,6 @@ HOME = os.path.expanduser('~')
 SYSTEM = system()
 if SYSTEM == 'Darwin':
     HOME_TRASH = os.path.join(HOME, '.Trash')
-    HAS_OSA = call('hash osascript 2>/dev/null', shell=True) == 0
-    if HAS_OSA:
-        OSA = check_output('command -pv osascript', shell=True).strip()
 elif SYSTEM == 'Linux':
     HOME_TRASH = os.path.join(HOME, '.local/share/Trash')
 else:
@@ -188,13 +306,109 @@ else:
 # Does the HOME trash exist?
 HAS_HOME = os.path.isdir(HOME_TRASH)
 
-# File shredding
-if call('hash gshred 2>/dev/null', shell=True) == 0:
-    SHRED = 'gshred'
-elif call('hash shred 2>/dev/null', shell=True) == 0:
-    SHRED = 'shred'
+# Trash location relative to the mountpoint of other volumes
+if SYSTEM == 'Darwin':
+    VOLUME_TRASH = os.path.join('.Trashes', str(UID))
 else:
-    SHRED = None
+    VOLUME_TRASH = '.Trash-{0}'.format(UID)
+
+# Persistent cache of the trash for each mount, for the zsh plugin's chpwd
+# hook (see get_trash_cached), and the entries kept in it
+TRASH_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(HOME, '.cache'),
+    'careful_rm', 'trashes'
+)
+TRASH_CACHE_MAX = 256
+
+# Fast deletion (--fast), targets are renamed into a staging directory on
+# their device, listed in REAP_LIST, and deleted by a background reaper with
+# fewer threads at a lower priority
+REAP_DIR = '.careful_rm_reap-{0}'.format(UID)
+REAP_LIST = os.path.join(os.path.dirname(TRASH_CACHE), 'reap')
+REAP_WORKERS = 4
+REAP_NICE = 10
+
+# Where the operation journal is written, if ~/.rm_journal exists, --journal
+# is passed, or $CAREFUL_RM_JOURNAL is set (to another path)
+JOURNAL_PATH = os.path.join(
+    os.environ.get('XDG_STATE_HOME') or os.path.join(HOME, '.local', 'state'),
+    'careful_rm', 'journal.jsonl'
+)
+
+# Policy file used unless --no-policy, $CAREFUL_RM_POLICY overrides it
+POLICY_FILE = os.path.join(HOME, '.rm_policy')
+
+# Linux ioprio_set syscall numbers by machine, and the I/O classes for
+# --io-class (as ionice), used by set_io_class
+IOPRIO_SET = {
+    'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314,
+    'ppc64le': 273, 'ppc64': 273, 's390x': 282, 'riscv64': 30,
+}
+IO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# External tools are looked up lazily (see get_shred and get_osascript), as
+# every rm goes through this script and most never need them
+_TOOLS = {}
+
+# Mount table, see get_mount_table
+_MOUNTS = {}
+
+# The RateLimiter for --max-ops-per-sec and --max-bytes-per-sec, see throttle
+_THROTTLE = {}
+
+# The Journal of the running invocation, see journal_phase
+_JOURNAL = {}
+
+# The Progress of the running invocation, if reported, see progress
+_PROGRESS = {}
+
+# The Policy in force, answers prompts in get_ans, see Policy
+_POLICY = {}
+
+# Set once file names are read from STDIN, after which prompts use the
+# terminal, 'tty' is the terminal to use if not /dev/tty (see run_request)
+_STDIN = {'files': False}
+
+# The daemon socket name (see daemon_socket), 'child' is set in the daemon's
+# children, which must run requests rather than pass them on, 'asked' by
+# careful_rm_client.py, which has already tried the daemon
+DAEMON_NAME = 'careful_rm.sock'
+_DAEMON = {'child': False, 'asked': False}
+
+# The environment the paths above are computed from when the daemon starts,
+# a request sent with different values is run in-process by the client
+DAEMON_ENV = ['HOME', 'USER', 'LOGNAME', 'XDG_CACHE_HOME', 'XDG_STATE_HOME']
+
+# In-process shredding, random overwrite passes (plus a final pass of zeros),
+# the size of the reused write buffers, and the most files shredded at once
+# on any one device
+SHRED_PASSES = 3
+SHRED_BUFFER = 4 * 1024 * 1024
+SHRED_PER_DEVICE = 4
+
+# Limits on counting the contents of directories for the recursive deletion
+# prompt, past these the prompt shows lower bounds. A scan still running
+# SUMMARY_GRACE seconds after the time limit (e.g. stuck on a hung network
+# filesystem) is abandoned
+SUMMARY_TIME = 0.2
+SUMMARY_ENTRIES = 1000000
+SUMMARY_GRACE = 0.5
+
+# Paths read from STDIN are classified and removed this many at a time in
+# NUL separated (-0) mode
+STREAM_BATCH = 10000
+
+# Threads used for parallel deletion, deletion is mostly waiting on metadata
+# syscalls, so use more threads than cores
+WORKERS = min(32, (getattr(os, 'cpu_count', lambda: 1)() or 1) + 4)
+
+# Arguments containing these are globbed, see expand_globs
+GLOB_MAGIC = re.compile(r'[*?[]')
+
+# Directory deletion can be done relative to directory file descriptors
+HAS_FWALK = hasattr(os, 'fwalk') and os.unlink in getattr(
+    os, 'supports_dir_fd', ()
+) and os.rmdir in os.supports_dir_fd
 
 # Linux trashinfo template
 TRASHINFO = """\
@@ -204,6 +418,45 @@ DeletionDate={date}
 """
 TIMEFMT = '%Y-%m-%dT%H:%M:%S'
 
+# Files recycled per batch, each batch shares its trashinfo fsyncs and one
+# index write
+RECYCLE_BATCH = 1000
+
+# Cross-device copies, bytes per copy call, seconds between progress lines,
+# and the Linux ioctl to reflink (share the blocks of) a file
+COPY_CHUNK = 64 * 1024 * 1024
+PROGRESS_INTERVAL = 1.0
+FICLONE = 0x40049409
+
+# The live status line (see Progress) is shown once a phase has taken
+# PROGRESS_DELAY seconds, and redrawn every PROGRESS_REFRESH seconds
+PROGRESS_DELAY = 1.0
+PROGRESS_REFRESH = 0.2
+
+# Append-only log of everything recycled, kept in the root of each trash
+INDEX_NAME = '.careful_rm_index'
+
+# Deduplication of recycled files (--dedup, or forced on by ~/.rm_dedup),
+# regular files of at least DEDUP_MIN_SIZE are hashed DEDUP_CHUNK bytes at a
+# time, and identical ones in a trash become hard links to one copy, which
+# is kept in DEDUP_DIR in the root of the trash
+DEDUP_DIR = '.careful_rm_objects'
+DEDUP_MIN_SIZE = 1024 * 1024
+DEDUP_CHUNK = 1024 * 1024
+
+# Compression of recycled files (--compress, or forced on by ~/.rm_compress),
+# a background compactor compresses regular files of at least
+# COMPRESS_MIN_SIZE recycled more than COMPRESS_AGE seconds ago, keeping
+# them only if no more than COMPRESS_RATIO of their size. It runs at most
+# once every COMPRESS_INTERVAL seconds, COMPRESS_STAMP is locked while it
+# runs and touched when it starts.
+COMPRESS_AGE = 30 * 60
+COMPRESS_MIN_SIZE = 64 * 1024
+COMPRESS_RATIO = 0.9
+COMPRESS_INTERVAL = 10 * 60
+COMPRESS_WORKERS = 2
+COMPRESS_STAMP = os.path.join(os.path.dirname(TRASH_CACHE), 'compress')
+
 
 ###############################################################################
 #                         Catch Keyboard Interruption                         #
@@ -222,7 +475,32 @@ signal.signal(signal.SIGINT, catch_keyboard)
 ###############################################################################
 
 
-def get_ans(message, options, default=None):
+def read_input(message):
+    """Return one line of user input for message.
+
+    Reads from /dev/tty instead of STDIN once file names have been read from
+    STDIN (see main), raises EOFError if there is no terminal.
+    """
+    pause_progress()
+    try:
+        with journal_phase('prompt'):
+            if not _STDIN['files']:
+                return input(message)
+            sys.stderr.write(message)
+            sys.stderr.flush()
+            try:
+                with open(_STDIN.get('tty', '/dev/tty')) as tty:
+                    line = tty.readline()
+            except (IOError, OSError):
+                line = ''
+    finally:
+        pause_progress(False)
+    if not line:
+        raise EOFError('No terminal to read an answer from')
+    return line
+
+
+def get_ans(message, options, default=None, key=None):
     """Get an answer from user from list.
 
     Params
@@ -233,11 +511,20 @@ def get_ans(message, options, default=None):
         Options to chose from
     default : str, optional
         Default option, must be in options
+    key : str, optional
+        The kind of question, if the Policy in force has an answer for key
+        the user is not asked (see Policy)
 
     Returns
     -------
     answer : str
     """
+    policy = _POLICY.get('current')
+    if key and policy is not None:
+        ans = policy.answers.get(key)
+        if ans in options:
+            sys.stderr.write('{0} {1} (policy)\n'.format(message, ans))
+            return ans
     if default:
         assert default in options
         default = default.lower()
@@ -251,7 +538,14 @@ def get_ans(message, options, default=None):
 
     message += ' [{0}] '.format('/'.join(str_options))
     while True:
-        ans = input(message)
+        try:
+            ans = read_input(message)
+        except EOFError:
+            # No one to ask, take the default (always the safe choice)
+            if default is None:
+                raise
+            sys.stderr.write('\n')
+            return default
         if not isinstance(ans, str):
             ans = ans.decode()
         ans = ans.strip().lower()
@@ -263,63 +557,574 @@ def get_ans(message, options, default=None):
         sys.stderr.write('Invalid choice {0}, try again\n'.format(ans))
 
 
-def yesno(message, def_yes=True):
-    """Get a yes or no answer from the user."""
-    ans = get_ans(message, ['y', 'n'], 'y' if def_yes else 'n')
-    return ans == 'y'
+def yesno(message, def_yes=True, key=None, full_list=None):
+    """Get a yes or no answer from the user, key is as in get_ans.
+
+    If full_list (what the question is about) is too long to have been
+    shown in full by format_list, 'l' pages it and asks again.
+    """
+    options = ['y', 'n']
+    if full_list is not None and len(full_list) > LIST_PREVIEW:
+        options.append('l')
+        message += ' (l to list all {0})'.format(len(full_list))
+    while True:
+        ans = get_ans(message, options, 'y' if def_yes else 'n', key=key)
+        if ans != 'l':
+            return ans == 'y'
+        page_list(full_list)
+
+
+def page_list(items):
+    """Show items one per line in $PAGER (default less), or on STDERR."""
+    text = ''.join(quote(i) + '\n' for i in items)
+    cmd = sh.split(os.environ.get('PAGER') or 'less')
+    if cmd and which(cmd[0]):
+        try:
+            Popen(cmd, stdin=PIPE).communicate(text.encode('utf-8'))
+            return
+        except OSError:
+            pass
+    sys.stderr.write(text)
+
+
+def get_shred():
+    """Return the path to gshred or shred, None if neither exist, cached."""
+    if 'shred' not in _TOOLS:
+        _TOOLS['shred'] = which('gshred') or which('shred')
+    return _TOOLS['shred']
+
+
+def get_osascript():
+    """Return the path to the system osascript or None, cached."""
+    if 'osa' not in _TOOLS:
+        # Equivalent to `command -pv`, search the default system path only
+        try:
+            sys_path = os.confstr('CS_PATH')
+        except (AttributeError, ValueError, OSError):
+            sys_path = None
+        _TOOLS['osa'] = which('osascript', path=sys_path or os.defpath)
+    return _TOOLS['osa']
 
 
-def format_list(input_list):
+def format_list(input_list, limit=None, infos=None):
     """Print a list as columns matched to the terminal width.
 
-    From: stackoverflow.com/questions/25026556
+    Lists of more than limit (default LIST_PREVIEW) items are cut to the
+    first and last limit/2, followed by the directories and extensions with
+    the most items, and the total size if infos (path->FileInfo) is given.
+    The layout takes two passes over the items shown, the summary one pass
+    over the rest.
+
+    Columns after: stackoverflow.com/questions/25026556
     """
-    try:
-        term_width = int(check_output(['tput', 'cols']).strip())
-    except (CalledProcessError, OSError, ValueError):
-        term_width = 80
+    term_width = get_term_width()
+    limit = LIST_PREVIEW if limit is None else limit
 
-    if len(str(input_list)) < term_width:
+    # str(input_list) if it fits on one line, without building it if not
+    length = 2 * len(input_list)
+    for x in input_list:
+        length += len(repr(x))
+        if length >= term_width:
+            break
+    else:
         return str(input_list).strip('[]')
 
+    if len(input_list) <= limit:
+        return _format_columns(input_list, term_width, last=True)
+    half = max(limit // 2, 1)
+    head = input_list[:half]
+    tail = input_list[-half:]
+    outstr = [
+        _format_columns(head, term_width),
+        '... {0} more ...\n'.format(len(input_list) - 2 * half),
+        _format_columns(tail, term_width, last=True),
+    ]
+    # As os.path.dirname and splitext, which are slower, by a lot at 1M
+    dirs = dd(int)
+    exts = dd(int)
+    for x in input_list:
+        dirname, _, base = x.rpartition(os.sep)
+        dirs[dirname or os.curdir] += 1
+        _, dot, ext = base.lstrip('.').rpartition('.')
+        exts[dot + ext if dot else '(none)'] += 1
+    for name, counts in [('directory', dirs), ('extension', exts)]:
+        top = nlargest(LIST_GROUPS, counts.items(), key=lambda x: x[1])
+        outstr.append('By {0} ({1} in all): {2}\n'.format(
+            name, len(counts),
+            ', '.join('{0} ({1})'.format(k, v) for k, v in top)
+        ))
+    if infos:
+        outstr.append('Total size: {0}\n'.format(format_size(sum(
+            infos[x].st_size for x in input_list if x in infos
+        ))))
+    return ''.join(outstr)
+
+
+def _format_columns(input_list, term_width, last=False):
+    """Lay out the reprs of input_list in columns, see format_list.
+
+    The number of columns is set by the widest item, then each column is
+    only as wide as its widest item. A comma follows every item unless last
+    is True, then not the final one.
+    """
     repr_list = [repr(x) for x in input_list]
-    min_chars_between = 3 # a comma and two spaces
+    min_chars_between = 3  # a comma and two spaces
     usable_term_width = term_width - 2
-    min_element_width = min(len(x) for x in repr_list) + min_chars_between
     max_element_width = max(len(x) for x in repr_list) + min_chars_between
-    if max_element_width >= usable_term_width:
-        ncol = 1
-        col_widths = [1]
-    else:
-        # Start with max possible number of columns and reduce until it fits
-        ncol = int(min(len(repr_list), usable_term_width/min_element_width))
+    ncol = max(1, min(len(repr_list), usable_term_width // max_element_width))
+    col_widths = [0] * ncol
+    for i, x in enumerate(repr_list):
+        col_widths[i % ncol] = max(
+            col_widths[i % ncol], len(x) + min_chars_between
+        )
+
+    lines = []
+    end = len(repr_list) - 1
+    for start in range(0, len(repr_list), ncol):
+        lines.append(''.join(
+            (x if last and i == end else x + ',').ljust(col_widths[i % ncol])
+            for i, x in enumerate(repr_list[start:start + ncol], start)
+        ))
+    return '\n'.join(lines) + '\n'
+
+
+def format_size(nbytes):
+    """Return a human readable string for a size in bytes, e.g. '3.4 GB'."""
+    size = float(nbytes)
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if size < 1024 or unit == 'TB':
+            break
+        size /= 1024
+    if unit == 'B':
+        return '{0} B'.format(int(size))
+    return '{0:.1f} {1}'.format(size, unit)
+
+
+def format_count(count):
+    """Return a short string for a count, e.g. 1234 or '1.2M'."""
+    if count < 10000:
+        return str(count)
+    for div, unit in [(1e9, 'G'), (1e6, 'M'), (1e3, 'K')]:
+        if count >= div:
+            return '{0:.1f}{1}'.format(count / div, unit)
+
+
+def format_eta(seconds):
+    """Return a duration as H:MM:SS, or M:SS if under an hour."""
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+    return '{0}:{1:02d}'.format(minutes, seconds)
+
+
+def parse_size(text):
+    """Return bytes for a size like '50G', '1.5T' or '4096'.
+
+    Units are powers of 1024, as used by format_size. Raises ValueError.
+    """
+    text = text.strip().upper().rstrip('IB') or '0'
+    units = 'KMGTP'
+    mult = 1
+    if text[-1] in units:
+        mult = 1024 ** (units.index(text[-1]) + 1)
+        text = text[:-1]
+    return int(float(text) * mult)
+
+
+def parse_duration(text):
+    """Return seconds for a duration like '7d', '12h', '30m', '2w' or '90s'.
+
+    A number alone is days. Raises ValueError.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    text = text.strip().lower()
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text) * units['d']
+
+
+class TreeSummary(object):
+    """Counts of everything below some directories, see summarize_dirs.
+
+    Attributes
+    ----------
+    files : int
+        Files, links, and other non-directories
+    dirs : int
+        Subdirectories, not including the top level
+    nbytes : int
+        Total size of files
+    complete : bool
+        False if the budget ran out, all counts are then lower bounds
+    """
+
+    def __init__(self):
+        """Start with everything at zero."""
+        self.files = 0
+        self.dirs = 0
+        self.nbytes = 0
+        self.complete = True
+        self.elapsed = 0.0
+
+    def describe(self):
+        """Return a description, e.g. '12 files and 3 folders (1.2 MB)'."""
+        pre = '' if self.complete else '>= '
+        info = []
+        if self.files:
+            info.append('{0}{1} files'.format(pre, format_count(self.files)))
+        if self.dirs:
+            info.append('{0}{1} folders'.format(pre, format_count(self.dirs)))
+        if not info:
+            return ''
+        desc = ' and '.join(info)
+        desc += ' ({0}{1}'.format(pre, format_size(self.nbytes))
+        if not self.complete:
+            desc += ', still counting after {0:.1f}s'.format(self.elapsed)
+        return desc + ')'
+
+
+def summarize_dirs(drs, budget=None, max_entries=None, workers=None,
+                   max_files=None):
+    """Count files, folders, and bytes below drs, in parallel and bounded.
+
+    Directories are read with os.scandir, so types come from d_type and only
+    files are stat'd (for their size). Scanning stops once budget seconds
+    have passed, max_entries have been seen, or more than max_files files,
+    the counts are then lower bounds (summary.complete is False).
+
+    Params
+    ------
+    drs : list of str
+    budget : float, optional
+        Seconds, defaults to SUMMARY_TIME
+    max_entries : int, optional
+        Defaults to SUMMARY_ENTRIES
+    workers : int, optional
+        Scanning threads, defaults to one per directory in drs, so a single
+        directory is scanned serially, or WORKERS for a budget of a second
+        or more (e.g. a complete count), at most WORKERS either way
+    max_files : int, optional
+        Stop once more than this many files (not folders) are seen, e.g. to
+        check a limit on them, no limit by default
+
+    Returns
+    -------
+    TreeSummary
+    """
+    try:
+        from queue import Queue
+    except ImportError:
+        from Queue import Queue
+    budget = budget if budget else SUMMARY_TIME
+    max_entries = max_entries if max_entries else SUMMARY_ENTRIES
+    if not workers:
+        workers = WORKERS if budget >= 1 else len(drs)
+    workers = min(workers, WORKERS)
+    summary = TreeSummary()
+    lock = threading.Lock()
+    todo = Queue()
+    # Directories queued or being scanned, done is set when none are left
+    pending = [len(drs)]
+    done = threading.Event()
+    if not drs:
+        done.set()
+    start = time.time()
+    deadline = start + budget
+
+    def out_of_budget(files=0, dirs=0):
+        # files and dirs are counted by the caller, not yet in summary
+        files += summary.files
+        if time.time() > deadline or \
+                files + dirs + summary.dirs > max_entries or \
+                (max_files is not None and files > max_files):
+            summary.complete = False
+            return True
+        return False
+
+    def scan(dr):
+        files = dirs = nbytes = 0
+        subdirs = []
+        try:
+            for name, is_dir in list_dir(dr):
+                pth = os.path.join(dr, name)
+                if is_dir:
+                    dirs += 1
+                    subdirs.append(pth)
+                    continue
+                files += 1
+                try:
+                    nbytes += os.lstat(pth).st_size
+                except OSError:
+                    pass
+                if not files % 256 and out_of_budget(files, dirs):
+                    break
+        except OSError:
+            pass
+        with lock:
+            summary.files += files
+            summary.dirs += dirs
+            summary.nbytes += nbytes
+        return subdirs
+
+    def worker():
         while True:
-            col_widths = [
-                max(
-                    len(x) + min_chars_between \
-                    for j, x in enumerate(repr_list) if j % ncol == i
-                ) for i in range(ncol)
-            ]
-            if sum( col_widths ) <= usable_term_width:
-                break
-            else:
-                ncol -= 1
+            dr = todo.get()
+            if dr is None:
+                return
+            # Once out of budget just drain the queue
+            subdirs = [] if out_of_budget() else scan(dr)
+            with lock:
+                pending[0] += len(subdirs) - 1
+                if not pending[0]:
+                    done.set()
+            for sub in subdirs:
+                todo.put(sub)
 
-    outstr = ""
-    for i, x in enumerate(repr_list):
-        if i != len(repr_list)-1:
-            x += ','
-        outstr += x.ljust(col_widths[ i % ncol ])
-        if i == len(repr_list) - 1:
-            outstr += '\n'
-        elif (i+1) % ncol == 0:
-            outstr += '\n'
+    # Even a serial scan runs in a thread, so it can be abandoned
+    threads = []
+    for _ in range(workers if drs else 0):
+        thread = threading.Thread(target=worker)
+        # A thread left scanning past the grace period must not keep the
+        # process alive
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for dr in drs:
+        todo.put(dr)
+    # Wait no longer than the budget allows, a scan blocked in a hung
+    # network filesystem would hold a plain Queue.join forever
+    limit = None
+    if deadline != float('inf'):
+        limit = deadline + SUMMARY_GRACE
+    done.wait(None if limit is None else max(limit - time.time(), 0))
+    if not done.is_set():
+        summary.complete = False
+    for _ in threads:
+        todo.put(None)
+    for thread in threads:
+        thread.join(None if limit is None else max(limit - time.time(), 0))
+    summary.elapsed = time.time() - start
+    return summary
+
+
+# The results of one lstat, kept for the life of the run. Field names match
+# os.stat_result so a FileInfo can be passed anywhere an lstat result is used
+# (st_mtime_ns is None where os.stat_result has none, python 2)
+FileInfo = namedtuple(
+    'FileInfo',
+    ['path', 'abspath', 'st_mode', 'st_size', 'st_dev', 'st_ino', 'st_mtime',
+     'st_mtime_ns']
+)
+
+
+def stat_file(fl, entry=None):
+    """Return a FileInfo for fl from a single lstat, None if it is missing.
+
+    If entry (an os.DirEntry for fl) is given, its stat is used, which is
+    free on Windows.
+    """
+    try:
+        if entry is not None:
+            st = entry.stat(follow_symlinks=False)
+        else:
+            st = os.lstat(fl)
+    except OSError:
+        return None
+    return FileInfo(
+        fl, os.path.abspath(fl), st.st_mode, st.st_size, st.st_dev, st.st_ino,
+        st.st_mtime, getattr(st, 'st_mtime_ns', None)
+    )
+
+
+def expand_globs(patterns):
+    """Expand shell style patterns as glob does, listing each directory once.
+
+    Paths that exist are taken as they are, as the shell has already
+    expanded them, even if they contain *, ? or [. Patterns are grouped by
+    the directory they list, each directory is scanned once and every
+    pattern for it is matched against that one listing. Names starting with
+    '.' only match patterns that do too. Other paths without wildcards are
+    passed through without a syscall, missing ones are found when they are
+    classified.
+
+    Returns
+    -------
+    paths : list of str
+        Matches in the order of patterns, each pattern's in directory order
+    entries : dict
+        path->os.DirEntry for paths found by scanning, for classify_files
+    """
+    matches = [[] for _ in patterns]
+    entries = {}
+    groups = {}
+    order = []
+    parents = {}
+    for index, pattern in enumerate(patterns):
+        if not GLOB_MAGIC.search(pattern) or os.path.lexists(pattern):
+            matches[index] = [pattern]
+            continue
+        dirname, base = os.path.split(pattern)
+        if not base:
+            # e.g. 'build*/', which only matches directories
+            matches[index] = glob(pattern)
+            continue
+        if dirname not in parents:
+            parents[dirname] = [dirname]
+            if GLOB_MAGIC.search(dirname):
+                parents[dirname] = [
+                    i for i in expand_globs([dirname])[0] if os.path.isdir(i)
+                ]
+        for parent in parents[dirname]:
+            if parent not in groups:
+                groups[parent] = []
+                order.append(parent)
+            groups[parent].append((index, base))
+    matchers = {}
+    for parent in order:
+        listing = None
+        for index, base in groups[parent]:
+            if not GLOB_MAGIC.search(base):
+                pth = os.path.join(parent, base)
+                if os.path.lexists(pth):
+                    matches[index].append(pth)
+                continue
+            if listing is None:
+                listing = scan_dir(parent or os.curdir)
+            if base not in matchers:
+                matchers[base] = re.compile(
+                    translate(os.path.normcase(base))
+                ).match
+            match = matchers[base]
+            hidden = base.startswith('.')
+            for name, entry in listing:
+                if (hidden or not name.startswith('.')) and \
+                        match(os.path.normcase(name)):
+                    pth = os.path.join(parent, name)
+                    matches[index].append(pth)
+                    if entry is not None:
+                        entries[pth] = entry
+    return [i for l in matches for i in l], entries
 
-    return outstr
 
+def scan_dir(path):
+    """Return (name, os.DirEntry or None) for everything in path.
 
-def get_mount(fl):
-    """Return the mountpoint for fl."""
+    Returns an empty list if path cannot be listed, as glob does.
+    """
+    try:
+        if hasattr(os, 'scandir'):
+            return [(i.name, i) for i in os.scandir(path)]
+        return [(i, None) for i in os.listdir(path)]
+    except OSError:
+        return []
+
+
+def classify_files(files, entries=None):
+    """Split files into directories, files/links, other, and missing.
+
+    One lstat per path, see stat_file, entries is an optional path->DirEntry
+    dictionary (from expand_globs).
+
+    Returns
+    -------
+    drs, fls, oth, bad : list of str
+    infos : dict
+        path->FileInfo for every path that exists
+    """
+    drs = []
+    fls = []
+    bad = []
+    oth = []
+    infos = {}
+    entries = entries if entries else {}
+    for fl in files:
+        info = stat_file(fl, entries.get(fl))
+        if info is None:
+            bad.append(fl)
+            continue
+        infos[fl] = info
+        if stat.S_ISDIR(info.st_mode):
+            drs.append(fl)
+        # Includes all symlinks, even broken ones or those to directories
+        elif stat.S_ISREG(info.st_mode) or stat.S_ISLNK(info.st_mode):
+            fls.append(fl)
+        # Anything else, e.g. sockets or fifos
+        else:
+            oth.append(fl)
+    return drs, fls, oth, bad, infos
+
+
+def read_paths(stream, sep=b'\0', batch_size=None, chunk_size=65536):
+    """Yield lists of at most batch_size paths read from stream as they come.
+
+    Memory use is bounded by batch_size and chunk_size, not the length of
+    the input. Paths are not globbed.
+
+    Params
+    ------
+    stream : file
+        Opened in binary mode
+    sep : bytes, optional
+        Separator between paths, default NUL (e.g. find -print0)
+    batch_size : int, optional
+        Defaults to STREAM_BATCH
+    """
+    batch_size = batch_size if batch_size else STREAM_BATCH
+    decode = getattr(os, 'fsdecode', lambda x: x)
+    batch = []
+    rest = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        parts = (rest + chunk).split(sep)
+        rest = parts.pop()
+        for part in parts:
+            if part:
+                batch.append(decode(part))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if rest:
+        batch.append(decode(rest))
+    if batch:
+        yield batch
+
+
+def get_mount_table():
+    """Return a dictionary of st_dev->[mountpoints], parsed only once.
+
+    Read from /proc/self/mountinfo, if that doesn't exist (e.g. MacOS) the
+    table starts empty and is filled in by get_mount as devices are seen.
+    """
+    if 'table' not in _MOUNTS:
+        table = dd(list)
+        try:
+            with open('/proc/self/mountinfo') as fin:
+                for line in fin:
+                    fields = line.split()
+                    if len(fields) < 5:
+                        continue
+                    major, minor = fields[2].split(':')
+                    table[os.makedev(int(major), int(minor))].append(
+                        _unescape_mount(fields[4])
+                    )
+        except (IOError, OSError, ValueError):
+            pass
+        _MOUNTS['table'] = table
+    return _MOUNTS['table']
+
+
+def _unescape_mount(pth):
+    """Decode the octal escapes (e.g. \\040 for space) used by mountinfo."""
+    if '\\' not in pth:
+        return pth
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), pth)
+
+
+def _walk_mount(fl):
+    """Return the mountpoint for fl by walking up the path with ismount."""
     test_path = fl
     while test_path:
         if os.path.ismount(test_path) or test_path == '/':
@@ -328,6 +1133,39 @@ def get_mount(fl):
     return '/'
 
 
+def get_mount(fl, st=None):
+    """Return the mountpoint for fl.
+
+    Looked up by the st_dev of fl in the mount table, so this costs a single
+    lstat per file (none if st is provided). Only walks up the path if the
+    device is unknown, and then remembers the answer for that device.
+
+    Params
+    ------
+    fl : str
+    st : os.stat_result, optional
+        The result of os.lstat(fl) if already known
+    """
+    fl = os.path.abspath(fl)
+    if st is None:
+        try:
+            st = os.lstat(fl)
+        except OSError:
+            return _walk_mount(fl)
+    mounts = get_mount_table()[st.st_dev]
+    # More than one mountpoint per device means bind mounts, use the deepest
+    # one that contains fl
+    best = None
+    for mnt in mounts:
+        if fl == mnt or mnt == '/' or fl.startswith(mnt + '/'):
+            if best is None or len(mnt) > len(best):
+                best = mnt
+    if best is None:
+        best = _walk_mount(fl)
+        mounts.append(best)
+    return best
+
+
 def get_trashes(files):
     """Return a dictionary of trash->files for files in list."""
     trashes = dd(list)
@@ -336,13 +1174,11 @@ def get_trashes(files):
     return trashes
 
 
-def get_trash(fl=None):
-    """Return the trash can for the file/dir fl."""
-    # Default trash locations
-    v_trash_mac = os.path.join('.Trashes', str(UID))
-    v_trash_lin = '.Trash-{0}'.format(UID)
-    v_trash = v_trash_mac if SYSTEM == 'Darwin' else v_trash_lin
+def get_trash(fl=None, st=None):
+    """Return the trash can for the file/dir fl.
 
+    st is the optional result of os.lstat(fl), passed to get_mount.
+    """
     # Get absolute path to location of interest
     if not fl:
         if sys.argv and len(sys.argv) > 1 and os.path.exists(sys.argv[1]):
@@ -355,7 +1191,7 @@ def get_trash(fl=None):
     if fl.startswith(HOME):
         trash = HOME_TRASH
     else:
-        mnt = get_mount(fl)
+        mnt = get_mount(fl, st)
         if mnt == '/':
             if HAS_HOME and fl.startswith(HOME):
                 trash = HOME_TRASH
@@ -364,222 +1200,3624 @@ def get_trash(fl=None):
         elif mnt == HOME:
             trash = HOME_TRASH
         else:
-            trash = os.path.join(mnt, v_trash)
+            trash = os.path.join(mnt, VOLUME_TRASH)
 
     return trash
 
-###############################################################################
-#                              Deletion Helpers                               #
-###############################################################################
 
+def read_trash_cache():
+    """Return the trash cache entries as a list of (st_dev, mount, trash).
 
-def recycle_files(files, mv_flags, try_apple=True, verbose=False, dryrun=False):
-    """Identify best recycle bins for files and then try to recycle them.
+    The cache is one tab separated line per entry, the first line maps the
+    HOME prefix to HOME_TRASH (as "home HOME HOME_TRASH"), so the zsh plugin
+    can read it too. Returns an empty list if the cache is missing or is for
+    a different HOME.
+    """
+    if 'cache' in _MOUNTS:
+        return _MOUNTS['cache']
+    entries = []
+    try:
+        with open(TRASH_CACHE) as fin:
+            lines = fin.read().splitlines()
+    except (IOError, OSError):
+        lines = []
+    if lines and lines[0] == '\t'.join(['home', HOME, str(HOME_TRASH)]):
+        for line in lines[1:]:
+            fields = line.split('\t')
+            if len(fields) == 3 and fields[0].isdigit():
+                entries.append((int(fields[0]), fields[1], fields[2]))
+    _MOUNTS['cache'] = entries
+    return entries
+
+
+def write_trash_cache(entries, append=None):
+    """Write the trash cache, or just append one entry to it.
 
     Params
     ------
-    files : list of str
-        Files, directories, or something else to recycle
-    mv_flags : list of str
-        Flags to pass to mv
-    try_apple : bool, optional
-        Try to use apple script, only means anything on Darwin, default True.
-    verbose : bool, optional
-        Print extra info
-    dryrun : bool
-        Don't actually move anything
-
-    Returns
-    -------
-    list
-        List of failed files, empty on success
+    entries : list of tuple
+        All (st_dev, mount, trash) entries
+    append : tuple, optional
+        A new entry, already in entries, appended if the cache is not too
+        long, otherwise the cache is rewritten
     """
-    # Get the longest path first, so we can pick the best mountpoints
-    # We need absolute paths for recycling
-    files = sorted(
-        [os.path.abspath(i) for i in files],
-        key=lambda x: len(x), reverse=True
-    )
-
-    # Try applescript first on MacOS
-    if try_apple and SYSTEM == 'Darwin' and HAS_OSA:
-        if verbose:
-            sys.stderr.write('Attempting to use applescript\n')
-        new_fls = []
-        if dryrun:
-            sys.stderr.write(
-                'Moving {0} to Trash with Finder via Applescript\n'
-                .format(files)
-            )
-            return []
-        for fl in files:
-            if recycle_darwin(fl, verbose=verbose) != 0:
-                new_fls.append(fl)
-        if new_fls:
-            sys.stderr.write(
-                'Applescript failed on:\n{0}\n'.format(format_list(new_fls))
-            )
-            files = new_fls
-        else:
-            return []
+    def fmt(entry):
+        return '{0}\t{1}\t{2}\n'.format(*entry)
+    try:
+        cache_dir = os.path.dirname(TRASH_CACHE)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        if append and len(entries) > 1 and len(entries) <= TRASH_CACHE_MAX:
+            with open(TRASH_CACHE, 'a') as fout:
+                fout.write(fmt(append))
+            return
+        tmp = '{0}.{1}.tmp'.format(TRASH_CACHE, os.getpid())
+        with open(tmp, 'w') as fout:
+            fout.write('\t'.join(['home', HOME, str(HOME_TRASH)]) + '\n')
+            for entry in entries[-TRASH_CACHE_MAX:]:
+                fout.write(fmt(entry))
+        os.rename(tmp, TRASH_CACHE)
+    except (IOError, OSError):
+        pass
 
-    # Get a mount point for all files
-    bins = dd(list)
-    gotn = tuple()
-    for fl in files:
-        # Load the ones we have found already quickly
-        if fl.startswith(gotn):
-            for d in gotn:
-                if fl.startswith(d):
-                    bins[d].append(fl)
-                    break
-        else:
-            mnt = get_mount(fl)
-            bins[mnt].append(fl)
-            gotn += (mnt,)
-
-    # Build final list of recycle bins
-    trashes = {}
-    to_delete = []
-    for mount, file_list in bins.items():
-        # Get all trash directories
-        r_trashes = get_trashes(files)
-        for r_trash, r_trash_files in r_trashes.items():
-            if os.path.isdir(r_trash):
-                trashes[r_trash] = file_list
-            else:
-                ans = get_ans(
-                    ('Mount {0} has no trash at {1}.\n' +
-                     'Skip, create, use (root) {2}, or delete files?')
-                     .format(mount, r_trash, RECYCLE_BIN),
-                     ['skip', 'create', 'root', 'del']
-                )
-                if ans == 'create':
-                    os.makedirs(r_trash)
-                    if SYSTEM == 'Linux':
-                        for f in ['expunged', 'files', 'info']:
-                            os.makedirs(os.path.join(r_trash, f))
-                    trashes[r_trash] = file_list
-                elif ans == 'root':
-                    if RECYCLE_BIN not in trashes:
-                        trashes[RECYCLE_BIN] = []
-                    trashes[RECYCLE_BIN] += file_list
-                elif ans == 'del':
-                    to_delete += file_list
-                elif ans == 'skip':
-                    # Just don't add the files to the trashes dict
-                    pass
-                else:
-                    raise Exception('Invalid response {0}'.format(ans))
 
-    # Do the deed, one file at a time (for metadata)
-    for trash, file_list in trashes.items():
-        for fl in file_list:
-            if dryrun:
-                sys.stderr.write('Moving {0} to {1}\n'.format(fl, trash))
-            if not dryrun and recycle_file(fl, trash, mv_flags) != 0:
-                to_delete.append(fl)
+def get_trash_cached(fl):
+    """Return the trash can for fl, using the persistent trash cache.
 
-    # Check if user wants to try to force delete files
-    if to_delete:
-        sys.stderr.write(
-            'Failed to recycle:\n{0}\n'.format(format_list(to_delete))
+    A cached entry is only used while its mountpoint is still on the same
+    device, which catches remounts without parsing the mount table. Misses
+    fall back to get_trash and are added to the cache.
+    """
+    fl = os.path.abspath(fl)
+    if fl.startswith(HOME):
+        return get_trash(fl)
+    try:
+        st = os.lstat(fl)
+    except OSError:
+        return get_trash(fl)
+    entries = read_trash_cache()
+    found = [
+        (dev, mnt, trash) for dev, mnt, trash in entries
+        if dev == st.st_dev and (
+            fl == mnt or mnt == '/' or fl.startswith(mnt + '/')
         )
-        if yesno('Attempt to fully delete with rm?', False):
-            return to_delete
+    ]
+    for dev, mnt, trash in sorted(found, key=lambda e: -len(e[1])):
+        try:
+            if os.stat(mnt).st_dev == dev:
+                return trash
+        except OSError:
+            continue
+    # Every entry found is stale, replace them
+    trash = get_trash(fl, st)
+    entry = (st.st_dev, get_mount(fl, st), trash)
+    if not any(c in ''.join(entry[1:]) for c in '\t\n'):
+        entries[:] = [
+            e for e in entries if e not in found and e[:2] != entry[:2]
+        ] + [entry]
+        write_trash_cache(entries, append=None if found else entry)
+    return trash
 
-    return []
 
+###############################################################################
+#                      Trash Index, Listing and Restoring                     #
+###############################################################################
 
-def recycle_file(fl, trash, mv_flags=None):
-    """Move one file to trash, do kung-foo on Linux.
 
-    If on Linux, file moved to trash/files unless trash==RECYCLE_BIN. Will
-    also create a trashinfo file. If not Linux, file just moved to trash
-    directly.
+def index_path(trash):
+    """Return the path to the index of trash."""
+    return os.path.join(trash, INDEX_NAME)
 
-    Params
-    -------
-    fl : str
-    trash : str
-    mv_flags : list of str
-        Flags to pass to mv
 
-    Returns
+def index_add(trash, records):
+    """Append records (dictionaries) to the index of trash, one write.
+
+    Records with op 'add' have path (original location), name (in the
+    trash), size, mtime (and mtime_ns, in nanoseconds, if known), date (of
+    deletion), and usage (bytes including contents, not known yet for
+    directories). 'usage' records set the usage of name, 'compress' records
+    set its codec (None if it is not worth compressing), usage, and rename
+    (the name of the compressed file), 'restore' and 'purge' records only
+    need name.
+    """
+    lines = ''.join(json.dumps(rec, sort_keys=True) + '\n' for rec in records)
+    try:
+        with open(index_path(trash), 'a') as fout:
+            fout.write(lines)
+    except (IOError, OSError) as err:
+        sys.stderr.write('Could not update trash index for {0}: {1}\n'.format(
+            trash, getattr(err, 'strerror', None) or err
+        ))
+
+
+def read_index(trash):
+    """Return name->record for everything currently in trash, per its index.
+
+    The log is replayed, so restored items are dropped. Nothing in the trash
+    itself is read.
+    """
+    items = {}
+    try:
+        with open(index_path(trash)) as fin:
+            for line in fin:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # A partial line from an interrupted write
+                    continue
+                op = rec.get('op')
+                if op == 'add':
+                    items[rec['name']] = rec
+                elif op == 'usage':
+                    if rec['name'] in items:
+                        items[rec['name']]['usage'] = rec['usage']
+                elif op == 'compress':
+                    if rec['name'] in items:
+                        items[rec['name']]['codec'] = rec['codec']
+                        if 'usage' in rec:
+                            items[rec['name']]['usage'] = rec['usage']
+                        if rec.get('rename'):
+                            item = items.pop(rec['name'])
+                            item['name'] = rec['rename']
+                            items[rec['rename']] = item
+                else:
+                    items.pop(rec.get('name'), None)
+    except (IOError, OSError):
+        pass
+    return items
+
+
+def get_all_trashes(indexed=True):
+    """Return every trash with an index, the home, root, and volume trashes.
+
+    Costs one stat per mountpoint, trash contents are never read. If indexed
+    is False, also returns trashes with no index (e.g. only ever used by a
+    desktop file manager).
+    """
+    trashes = [HOME_TRASH, RECYCLE_BIN]
+    for mounts in get_mount_table().values():
+        for mnt in mounts:
+            trashes.append(os.path.join(mnt, VOLUME_TRASH))
+    found = []
+    for trash in trashes:
+        if trash and trash not in found and (
+                os.path.isfile(index_path(trash)) if indexed
+                else os.path.isdir(trash)):
+            found.append(trash)
+    return found
+
+
+def find_trashed(pattern=None):
+    """Return a list of (trash, record) matching pattern, oldest first.
+
+    pattern is a glob matched against the original path and its basename,
+    everything matches if it is None.
+    """
+    found = []
+    for trash in get_all_trashes():
+        for rec in read_index(trash).values():
+            if pattern is None or fnmatch(rec['path'], pattern) or \
+                    fnmatch(os.path.basename(rec['path']), pattern):
+                found.append((trash, rec))
+    return sorted(found, key=lambda x: x[1]['date'])
+
+
+def list_trash(pattern=None):
+    """Print date, size, and original path of everything trashed."""
+    for trash, rec in find_trashed(pattern):
+        sys.stdout.write('{0}  {1:>9}  {2}\n'.format(
+            rec['date'], format_size(rec.get('usage', rec['size'])),
+            rec['path']
+        ))
+    return 0
+
+
+def restore_files(pattern, verbose=False, dryrun=False):
+    """Move trashed files matching pattern back to where they came from.
+
+    If the same path was trashed more than once, the newest copy is restored.
+    Nothing is overwritten. Deduplicated files get their own copy back, and
+    compressed files are decompressed.
+
+    Returns
+    -------
+    exit_code : int
+        0 on success, 1 if anything failed, 22 if nothing matched
+    """
+    newest = {}
+    for trash, rec in find_trashed(pattern):
+        newest[rec['path']] = (trash, rec)
+    if not newest:
+        sys.stderr.write('Nothing in the trash matches {0}\n'.format(pattern))
+        return 22
+    paths = sorted(newest)
+    if len(paths) >= CUTOFF:
+        sys.stderr.write('Restoring the following {0} files:\n{1}\n'.format(
+            len(paths), format_list(paths)
+        ))
+        if not yesno('Restore?', False, full_list=paths):
+            return 10
+    code = 0
+    deduped = set()
+    for path in paths:
+        trash, rec = newest[path]
+        src = os.path.join(trash_files_dir(trash), rec['name'])
+        if dryrun:
+            sys.stderr.write('Moving {0} to {1}\n'.format(src, path))
+            continue
+        if os.path.lexists(path):
+            sys.stderr.write('Not restoring {0}, it already exists\n'.format(
+                quote(path)
+            ))
+            code = 1
+            continue
+        parent = os.path.dirname(path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        if move_file(src, path, verbose=verbose) != 0:
+            code = 1
+            continue
+        if rec.get('codec'):
+            try:
+                decompress_file(path, rec['codec'])
+            except (IOError, OSError, EOFError, ImportError) as err:
+                sys.stderr.write('{0} is still compressed ({1}): {2}\n'.format(
+                    quote(path), rec['codec'], err
+                ))
+                code = 1
+        if 'object' in rec:
+            deduped.add(trash)
+            try:
+                unshare_file(path, rec)
+            except (IOError, OSError) as err:
+                sys.stderr.write(
+                    '{0} is still a hard link to a copy in the trash: '
+                    '{1}\n'.format(quote(path), err)
+                )
+                code = 1
+        if trash_files_dir(trash) != trash:
+            try:
+                os.unlink(os.path.join(
+                    trash, 'info', rec['name'] + '.trashinfo'
+                ))
+            except OSError:
+                pass
+        index_add(trash, [{'op': 'restore', 'name': rec['name']}])
+    for trash in deduped:
+        prune_objects(trash)
+    return code
+
+###############################################################################
+#                          Trash Usage and Purging                            #
+###############################################################################
+
+
+def trash_items(trash):
+    """Return name->record for everything in trash, syncing the index.
+
+    Items put in a freedesktop trash by other tools are added to the index
+    from their trashinfo, and items that are gone (e.g. the trash was emptied
+    by a file manager) are dropped from it. Costs one listdir per trash.
+    """
+    items = read_index(trash)
+    trash_can = trash_files_dir(trash)
+    try:
+        present = set(os.listdir(trash_can))
+    except OSError:
+        present = set()
+    records = [
+        {'op': 'purge', 'name': name} for name in items
+        if name not in present
+    ]
+    for rec in records:
+        items.pop(rec['name'])
+    info_dir = os.path.join(trash, 'info')
+    if trash_can != trash and os.path.isdir(info_dir):
+        for info_name in os.listdir(info_dir):
+            name = info_name[:-len('.trashinfo')]
+            if not info_name.endswith('.trashinfo') or name in items or \
+                    name not in present:
+                continue
+            rec = read_trashinfo(os.path.join(info_dir, info_name))
+            try:
+                st = os.lstat(os.path.join(trash_can, name))
+            except OSError:
+                continue
+            rec.update({
+                'op': 'add', 'name': name, 'size': st.st_size,
+                'mtime': int(st.st_mtime),
+            })
+            if not stat.S_ISDIR(st.st_mode):
+                rec['usage'] = st.st_size
+            items[name] = rec
+            records.append(rec)
+    if records:
+        index_add(trash, records)
+    return items
+
+
+def read_trashinfo(info_file):
+    """Return the original path and deletion date from a trashinfo file."""
+    try:
+        from urllib.parse import unquote as url_unquote
+
+        def unquote(val):
+            return url_unquote(val, errors='surrogateescape')
+    except ImportError:
+        from urllib import unquote
+    rec = {'path': '', 'date': ''}
+    try:
+        with open(info_file) as fin:
+            for line in fin:
+                key, _, val = line.strip().partition('=')
+                if key == 'Path':
+                    rec['path'] = unquote(val)
+                elif key == 'DeletionDate':
+                    rec['date'] = val
+    except (IOError, OSError, ValueError):
+        pass
+    return rec
+
+
+def has_date(rec):
+    """Return True if rec has a valid deletion date (see TIMEFMT)."""
+    try:
+        dt.strptime(rec['date'], TIMEFMT)
+    except (KeyError, TypeError, ValueError):
+        return False
+    return True
+
+
+def measure_usage(trash, items):
+    """Fill in the usage of directories in items, and save it in the index.
+
+    Each directory tree is walked once, its usage is then read from the
+    index.
+    """
+    trash_can = trash_files_dir(trash)
+    records = []
+    for name, rec in items.items():
+        if 'usage' in rec:
+            continue
+        pth = os.path.join(trash_can, name)
+        summary = summarize_dirs(
+            [pth], budget=float('inf'), max_entries=float('inf')
+        )
+        rec['usage'] = summary.nbytes
+        records.append({'op': 'usage', 'name': name, 'usage': summary.nbytes})
+    if records:
+        index_add(trash, records)
+
+
+def trash_usage():
+    """Print the number of items and bytes in every trash."""
+    for trash in get_all_trashes(indexed=False):
+        items = trash_items(trash)
+        measure_usage(trash, items)
+        sys.stdout.write('{0:>9}  {1:>8} items  {2}\n'.format(
+            format_size(sum(i['usage'] for i in items.values())),
+            len(items), trash
+        ))
+    return 0
+
+
+def purge_trash(older_than=None, max_size=None, force=False, verbose=False,
+                dryrun=False):
+    """Permanently delete old items from every trash.
+
+    Params
+    ------
+    older_than : float, optional
+        Delete everything deleted more than this many seconds ago
+    max_size : int, optional
+        Then delete the oldest items in each trash until the rest use no
+        more than this many bytes
+    force : bool, optional
+        Do not ask first
+    verbose : bool, optional
+    dryrun : bool, optional
+
+    Returns
+    -------
+    exit_code : int
+        0 on success, 1 if anything could not be deleted, 10 if cancelled
+    """
+    cutoff = None
+    if older_than is not None:
+        # Deletion dates sort as strings, to the second, so an item
+        # deleted in the cutoff second is included (older_than 0 is all)
+        cutoff = dt.fromtimestamp(time.time() - older_than).strftime(TIMEFMT)
+    plan = []
+    nbytes = 0
+    undated = 0
+    for trash in get_all_trashes(indexed=False):
+        items = trash_items(trash)
+        measure_usage(trash, items)
+        total = sum(i['usage'] for i in items.values())
+        purge = []
+        # Oldest deletion first, items with no valid date are never old
+        # enough, and are only evicted for max_size after all the others
+        for rec in sorted(items.values(),
+                          key=lambda i: (not has_date(i), i['date'])):
+            dated = has_date(rec)
+            if (cutoff and dated and rec['date'] <= cutoff) or (
+                    max_size is not None and total > max_size):
+                purge.append(rec)
+                total -= rec['usage']
+                nbytes += rec['usage']
+            elif cutoff and not dated:
+                undated += 1
+        if purge:
+            plan.append((trash, purge))
+    if undated:
+        sys.stderr.write(
+            'Kept {0} items with no valid deletion date\n'.format(undated)
+        )
+    count = sum(len(purge) for _, purge in plan)
+    if not count:
+        sys.stderr.write('Nothing to purge\n')
+        return 0
+    sys.stderr.write('Purging {0} items ({1}) from:\n{2}\n'.format(
+        count, format_size(nbytes),
+        '\n'.join('    {0} ({1} items)'.format(t, len(p)) for t, p in plan)
+    ))
+    if dryrun:
+        for _, purge in plan:
+            for rec in purge:
+                sys.stdout.write('{0}  {1:>9}  {2}\n'.format(
+                    rec['date'], format_size(rec['usage']), rec['path']
+                ))
+        return 0
+    if not force and not yesno('Permanently delete?', False):
+        return 10
+    code = 0
+    for trash, purge in plan:
+        trash_can = trash_files_dir(trash)
+        paths = [os.path.join(trash_can, rec['name']) for rec in purge]
+        if delete_files(paths, force=True, recursive=True, verbose=verbose):
+            code = 1
+        done = [
+            rec for rec, pth in zip(purge, paths) if not os.path.lexists(pth)
+        ]
+        if trash_can != trash:
+            for rec in done:
+                try:
+                    os.unlink(os.path.join(
+                        trash, 'info', rec['name'] + '.trashinfo'
+                    ))
+                except OSError:
+                    pass
+        if done:
+            index_add(trash, [
+                {'op': 'purge', 'name': rec['name']} for rec in done
+            ])
+            prune_objects(trash)
+    return code
+
+
+###############################################################################
+#                         Compression of Trash Contents                       #
+###############################################################################
+
+
+def get_codec(name=None):
+    """Return the name and open function of a codec.
+
+    If name is None, the best available: zstd if python has it (3.14 and
+    later), otherwise gzip. Raises ImportError if name is not available.
+    """
+    if name in (None, 'zst'):
+        try:
+            from compression import zstd
+            return 'zst', zstd.open
+        except ImportError:
+            if name:
+                raise
+    import gzip
+    return 'gz', lambda pth, mode: gzip.open(pth, mode, compresslevel=6)
+
+
+def compress_file(path, dest, codec, min_size=COMPRESS_MIN_SIZE):
+    """Compress the regular file path to dest, keeping its mode and times.
+
+    path is removed once dest is in place, dest should already be reserved
+    (see reserve_trash_name).
+
+    Returns
+    -------
+    size : int or None
+        The compressed size, None if path is not worth compressing (not a
+        regular file with one link, too small, or compressed too little)
+
+    Raises
+    ------
+    OSError
+        If it could not be compressed, or path changed in the meantime
+        (e.g. it was restored)
+    """
+    st = os.lstat(path)
+    if not stat.S_ISREG(st.st_mode) or st.st_nlink != 1 or \
+            st.st_size < min_size:
+        return None
+    codec_open = get_codec(codec)[1]
+    tmp = os.path.join(os.path.dirname(path), '.{0}.{1}.compress'.format(
+        os.path.basename(path), os.getpid()
+    ))
+    try:
+        with open(path, 'rb') as fin:
+            with codec_open(tmp, 'wb') as fout:
+                shutil.copyfileobj(fin, fout, DEDUP_CHUNK)
+        size = os.lstat(tmp).st_size
+        if size > st.st_size * COMPRESS_RATIO:
+            os.unlink(tmp)
+            return None
+        copy_stat(tmp, st)
+        now = os.lstat(path)
+        if (now.st_ino, now.st_size, now.st_mtime) != \
+                (st.st_ino, st.st_size, st.st_mtime):
+            raise os_error(errno.EBUSY)
+        os.rename(tmp, dest)
+    except (IOError, OSError):
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+    try:
+        os.unlink(path)
+    except OSError:
+        # Restored in the meantime, so the compressed copy is not wanted
+        os.unlink(dest)
+        raise
+    return size
+
+
+def decompress_file(path, codec):
+    """Decompress path in place, keeping its mode and times."""
+    st = os.lstat(path)
+    codec_open = get_codec(codec)[1]
+    tmp = os.path.join(os.path.dirname(path), '.{0}.{1}.restore'.format(
+        os.path.basename(path), os.getpid()
+    ))
+    try:
+        with codec_open(path, 'rb') as fin:
+            with open(tmp, 'wb') as fout:
+                shutil.copyfileobj(fin, fout, DEDUP_CHUNK)
+        copy_stat(tmp, st)
+        os.rename(tmp, path)
+    except (IOError, OSError, EOFError):
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def compress_trash(trash, older_than=COMPRESS_AGE, workers=COMPRESS_WORKERS,
+                   verbose=False, dryrun=False):
+    """Compress the files recycled to trash more than older_than seconds ago.
+
+    Files are compressed in parallel, and each is recorded in the index, so
+    restore_files can decompress it. A compressed file is renamed with its
+    codec as suffix (name.gz), and its trashinfo has that suffix added to
+    the original path, so other trash tools restore a file that says what
+    it is. Directories, and files deduplicated by dedup_trashed, are left as
+    they are.
+
+    Returns
+    -------
+    count : int
+        Number of files compressed
+    saved : int
+        Bytes saved
+    """
+    # As purge_trash, the cutoff second counts, so older_than 0 is all
+    cutoff = dt.fromtimestamp(time.time() - older_than).strftime(TIMEFMT)
+    todo = [
+        rec for rec in read_index(trash).values()
+        if 'codec' not in rec and 'object' not in rec and
+        has_date(rec) and rec['date'] <= cutoff and
+        rec.get('usage', 0) >= COMPRESS_MIN_SIZE
+    ]
+    if dryrun:
+        for rec in todo:
+            sys.stderr.write('Compressing {0}\n'.format(rec['path']))
+        return len(todo), 0
+    if not todo:
+        return 0, 0
+    codec = get_codec()[0]
+    trash_can = trash_files_dir(trash)
+    trash_info = os.path.join(trash, 'info') if trash_can != trash else None
+
+    def release(name):
+        if trash_info:
+            try:
+                os.unlink(os.path.join(trash_info, name + '.trashinfo'))
+            except OSError:
+                pass
+
+    def compress(rec):
+        pth = os.path.join(trash_can, rec['name'])
+        name = None
+        try:
+            name = reserve_trash_name(
+                trash_can, trash_info, '{0}.{1}'.format(rec['name'], codec)
+            )
+            if trash_info:
+                write_trashinfo(
+                    trash_info, name, '{0}.{1}'.format(rec['path'], codec),
+                    rec['date']
+                )
+            size = compress_file(pth, os.path.join(trash_can, name), codec)
+        except (IOError, OSError) as err:
+            if name:
+                release(name)
+            if verbose:
+                sys.stderr.write('Could not compress {0}: {1}\n'.format(
+                    quote(pth), err
+                ))
+            return None
+        if size is None:
+            release(name)
+            return {'op': 'compress', 'name': rec['name'], 'codec': None}
+        release(rec['name'])
+        if verbose:
+            sys.stderr.write('Compressed {0} to {1}\n'.format(
+                quote(pth), format_size(size)
+            ))
+        return {
+            'op': 'compress', 'name': rec['name'], 'codec': codec,
+            'usage': size, 'rename': name,
+        }
+
+    pool = get_thread_pool(min(workers, len(todo)))
+    if pool:
+        with pool:
+            results = list(pool.map(compress, todo))
+    else:
+        results = [compress(rec) for rec in todo]
+    records = [i for i in results if i]
+    if records:
+        if trash_info:
+            fsync_dir(trash_info)
+        fsync_dir(trash_can)
+        index_add(trash, records)
+    done = [
+        (rec, res) for rec, res in zip(todo, results) if res and res['codec']
+    ]
+    return len(done), sum(rec['usage'] - res['usage'] for rec, res in done)
+
+
+def compress_trashes(older_than=COMPRESS_AGE, verbose=False, dryrun=False):
+    """Compress old files in every trash, printing what was saved."""
+    for trash in get_all_trashes():
+        count, saved = compress_trash(
+            trash, older_than, verbose=verbose, dryrun=dryrun
+        )
+        if count and not dryrun:
+            sys.stderr.write(
+                'Compressed {0} files in {1}, saving {2}\n'.format(
+                    count, trash, format_size(saved)
+                )
+            )
+    return 0
+
+
+def start_compactor():
+    """Compress old files in every trash in a detached, idle process.
+
+    Does nothing if the compactor ran in the last COMPRESS_INTERVAL seconds,
+    or is still running, or there is no fork.
+    """
+    if not hasattr(os, 'fork'):
+        return
+    try:
+        if time.time() - os.stat(COMPRESS_STAMP).st_mtime < COMPRESS_INTERVAL:
+            return
+    except OSError:
+        pass
+
+    def compact():
+        import fcntl
+        stamp_dir = os.path.dirname(COMPRESS_STAMP)
+        if not os.path.isdir(stamp_dir):
+            os.makedirs(stamp_dir)
+        with open(COMPRESS_STAMP, 'a') as stamp:
+            try:
+                fcntl.flock(stamp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return
+            os.utime(COMPRESS_STAMP, None)
+            set_io_class('idle')
+            for trash in get_all_trashes():
+                compress_trash(trash)
+
+    run_detached(compact)
+
+
+###############################################################################
+#                      Deduplication of Recycled Files                        #
+###############################################################################
+
+
+def hash_file(path):
+    """Return the sha256 hex digest of the file at path, None on failure.
+
+    Read DEDUP_CHUNK bytes at a time, hashlib releases the GIL for large
+    updates so files can be hashed in parallel threads.
+    """
+    import hashlib
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as fin:
+            while True:
+                chunk = fin.read(DEDUP_CHUNK)
+                if not chunk:
+                    break
+                digest.update(chunk)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+
+def dedup_trashed(trash, moved, min_size=DEDUP_MIN_SIZE, workers=None):
+    """Hard link identical files just moved into trash to one stored copy.
+
+    Every regular file of at least min_size bytes is hashed. The first file
+    with a given content (and mode) is linked into DEDUP_DIR as the stored
+    copy, later ones are replaced by a link to it, renamed over the file so
+    that the trash never lacks it. Files already linked elsewhere are left
+    alone, as the trash must not change with them.
+
+    Params
+    ------
+    trash : str
+    moved : list of tuple
+        (original path, name in trash, FileInfo or lstat result), as for
+        record_trashed
+    min_size : int, optional
+    workers : int, optional
+        Threads used to hash, default WORKERS
+
+    Returns
+    -------
+    objects : dict
+        name in trash->(name in DEDUP_DIR, True if it is now a link to an
+        earlier copy), for every file hashed
+    """
+    candidates = [
+        (name, info) for _, name, info in moved
+        if stat.S_ISREG(info.st_mode) and info.st_size >= min_size
+    ]
+    if not candidates:
+        return {}
+    trash_can = trash_files_dir(trash)
+    paths = [os.path.join(trash_can, name) for name, _ in candidates]
+
+    def hash_unlinked(pth):
+        try:
+            if os.lstat(pth).st_nlink != 1:
+                return None
+        except OSError:
+            return None
+        return hash_file(pth)
+
+    pool = get_thread_pool(min(workers or WORKERS, len(paths)))
+    if pool:
+        with pool:
+            digests = list(pool.map(hash_unlinked, paths))
+    else:
+        digests = [hash_unlinked(pth) for pth in paths]
+    store = os.path.join(trash, DEDUP_DIR)
+    if not os.path.isdir(store):
+        os.makedirs(store)
+    objects = {}
+    for (name, info), pth, digest in zip(candidates, paths, digests):
+        if digest is None:
+            continue
+        # Links share their mode, so only files with the same mode match
+        obj = '{0}-{1:o}-{2}'.format(
+            info.st_size, stat.S_IMODE(info.st_mode), digest
+        )
+        obj_path = os.path.join(store, obj)
+        try:
+            os.link(pth, obj_path)
+            objects[name] = (obj, False)
+            continue
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                continue
+        tmp = os.path.join(trash_can, '.{0}.{1}.dedup'.format(
+            name, os.getpid()
+        ))
+        try:
+            if os.stat(obj_path).st_size != info.st_size:
+                continue
+            os.link(obj_path, tmp)
+            os.rename(tmp, pth)
+        except OSError:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            continue
+        objects[name] = (obj, True)
+    return objects
+
+
+def unshare_file(path, rec):
+    """Give a restored file its own copy of a deduplicated trash file.
+
+    The copy in DEDUP_DIR must not change if the restored file is edited,
+    so the file is copied and renamed over itself, then given the mtime it
+    had when it was recycled.
+    """
+    st = os.lstat(path)
+    if st.st_nlink == 1:
+        return
+    tmp = os.path.join(os.path.dirname(path), '.{0}.{1}.restore'.format(
+        os.path.basename(path), os.getpid()
+    ))
+    try:
+        shutil.copyfile(path, tmp)
+        copy_stat(tmp, st)
+        if rec.get('dedup'):
+            if 'mtime_ns' in rec and hasattr(st, 'st_atime_ns'):
+                os.utime(tmp, ns=(st.st_atime_ns, rec['mtime_ns']))
+            else:
+                os.utime(tmp, (st.st_atime, rec['mtime']))
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def prune_objects(trash):
+    """Delete stored copies in trash no longer linked to any trashed file."""
+    store = os.path.join(trash, DEDUP_DIR)
+    try:
+        names = os.listdir(store)
+    except OSError:
+        return
+    for name in names:
+        pth = os.path.join(store, name)
+        try:
+            if os.lstat(pth).st_nlink == 1:
+                os.unlink(pth)
+        except OSError:
+            pass
+
+
+###############################################################################
+#                              Recycle Planning                               #
+###############################################################################
+
+
+class RecyclePlan(object):
+    """Files to recycle grouped by device and trash, built by plan_recycle.
+
+    Attributes
+    ----------
+    groups : dict
+        (st_dev, trash)->[files], st_dev is None if the file could not be
+        stat'd
+    mounts : dict
+        trash->mountpoint of the first file assigned to it, for messages
+    """
+
+    def __init__(self):
+        """Create an empty plan."""
+        self.groups = dd(list)
+        self.mounts = {}
+
+    def add(self, fl, st=None):
+        """Add one absolute path to the plan, st is os.lstat(fl) if known."""
+        if st is None:
+            try:
+                st = os.lstat(fl)
+            except OSError:
+                st = None
+        trash = get_trash(fl, st)
+        if trash not in self.mounts:
+            self.mounts[trash] = get_mount(fl, st)
+        self.groups[(st.st_dev if st else None, trash)].append(fl)
+
+    def trashes(self):
+        """Return a dictionary of trash->files."""
+        trashes = dd(list)
+        for (_, trash), file_list in self.groups.items():
+            trashes[trash] += file_list
+        return trashes
+
+    def resolve(self):
+        """Check every trash exists, asking the user once per missing trash.
+
+        Returns
+        -------
+        trashes : dict
+            trash->files for every file that can be recycled
+        to_delete : list
+            Files the user chose to delete instead of recycling
+        """
+        trashes = dd(list)
+        to_delete = []
+        for r_trash, file_list in self.trashes().items():
+            if os.path.isdir(r_trash):
+                trashes[r_trash] += file_list
+                continue
+            ans = get_ans(
+                ('Mount {0} has no trash at {1}.\n' +
+                 'Skip, create, use (root) {2}, or delete files?')
+                .format(self.mounts[r_trash], r_trash, RECYCLE_BIN),
+                ['skip', 'create', 'root', 'del'], key='missing-trash'
+            )
+            if ans == 'create':
+                os.makedirs(r_trash)
+                if SYSTEM == 'Linux':
+                    for f in ['expunged', 'files', 'info']:
+                        os.makedirs(os.path.join(r_trash, f))
+                trashes[r_trash] += file_list
+            elif ans == 'root':
+                trashes[RECYCLE_BIN] += file_list
+            elif ans == 'del':
+                to_delete += file_list
+            elif ans == 'skip':
+                # Just don't add the files to the trashes dict
+                pass
+            else:
+                raise Exception('Invalid response {0}'.format(ans))
+        return dict(trashes), to_delete
+
+    def __len__(self):
+        """Return the total number of files in the plan."""
+        return sum(len(i) for i in self.groups.values())
+
+
+def plan_recycle(files, infos=None):
+    """Return a RecyclePlan for files, at most one lstat per file.
+
+    Params
+    ------
+    files : list of str
+        Absolute paths
+    infos : dict, optional
+        abspath->FileInfo (or lstat result), files in here are not stat'd
+    """
+    infos = infos if infos else {}
+    plan = RecyclePlan()
+    for fl in files:
+        plan.add(fl, infos.get(fl))
+    return plan
+
+
+###############################################################################
+#                          I/O Throttling and Priority                        #
+###############################################################################
+
+
+class RateLimiter(object):
+    """Token buckets for operations and bytes per second, shared by threads.
+
+    Each bucket holds up to one second of its rate, so short bursts are
+    allowed but the long run average never exceeds it.
+    """
+
+    def __init__(self, ops_rate=None, bytes_rate=None):
+        """Either rate may be None for no limit."""
+        self.rates = (ops_rate, bytes_rate)
+        self.tokens = [ops_rate or 0, bytes_rate or 0]
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self, ops=1, nbytes=0):
+        """Take ops and nbytes from the buckets, sleeping if they are empty.
+
+        Buckets can go into debt, so requests bigger than one second's worth
+        still work, the debt is slept off by the caller.
+        """
+        with self._lock:
+            now = time.time()
+            elapsed = now - self.last
+            self.last = now
+            delay = 0.0
+            for i, (rate, want) in enumerate(zip(self.rates, (ops, nbytes))):
+                if not rate:
+                    continue
+                self.tokens[i] = min(
+                    rate, self.tokens[i] + elapsed * rate
+                ) - want
+                if self.tokens[i] < 0:
+                    delay = max(delay, -self.tokens[i] / rate)
+        if delay:
+            time.sleep(delay)
+
+
+def set_throttle(ops_rate=None, bytes_rate=None):
+    """Limit all deletion, recycling, and shredding to these rates."""
+    if ops_rate or bytes_rate:
+        _THROTTLE['limiter'] = RateLimiter(ops_rate, bytes_rate)
+    else:
+        _THROTTLE.pop('limiter', None)
+
+
+def throttle(ops=1, nbytes=0):
+    """Wait for the rate limits before ops operations writing nbytes."""
+    limiter = _THROTTLE.get('limiter')
+    if limiter is not None:
+        limiter.wait(ops, nbytes)
+
+
+def set_io_class(io_class):
+    """Set the I/O scheduling class of this process, as ionice -c.
+
+    Must be called before any threads are started, as Linux keeps the I/O
+    priority per thread (new threads inherit it). The idle class also lowers
+    the CPU priority, which is all that can be done on systems without
+    ioprio_set. Child processes (e.g. shred) inherit both.
+
+    Returns
+    -------
+    bool : True if the I/O class was set
+    """
+    if io_class == 'idle':
+        try:
+            if hasattr(os, 'setpriority'):
+                os.setpriority(os.PRIO_PROCESS, 0, 19)
+            else:
+                os.nice(19)
+        except (AttributeError, OSError):
+            pass
+    number = IOPRIO_SET.get(os.uname()[4]) if SYSTEM == 'Linux' else None
+    if number is None:
+        return False
+    import ctypes
+    # IOPRIO_WHO_PROCESS, this thread, class in the top 3 bits, level 4
+    level = 0 if io_class == 'idle' else 4
+    ioprio = IO_CLASSES[io_class] << 13 | level
+    libc = ctypes.CDLL(None, use_errno=True)
+    return libc.syscall(number, 1, 0, ioprio) == 0
+
+
+###############################################################################
+#                             Progress Reporting                              #
+###############################################################################
+
+
+class Progress(object):
+    """Live progress of the slow phases of a run, see progress.
+
+    The deletion, shredding, recycling, and copying loops only add to two
+    counters (see progress). While a phase runs, a reporting thread redraws
+    one status line on a terminal every PROGRESS_REFRESH seconds, once the
+    phase has taken PROGRESS_DELAY, and writes a JSON line to fd every
+    PROGRESS_INTERVAL seconds and when the phase ends. So reporting costs the
+    same for ten files as for ten million.
+
+    Stream records have phase, items, bytes, items_total and bytes_total
+    (null if unknown), exact (False if the totals are lower bounds),
+    elapsed, items_per_sec, bytes_per_sec, eta (seconds, or null), and done.
+    """
+
+    def __init__(self, tty=False, fd=None):
+        """Draw a status line on STDERR if tty, stream to descriptor fd."""
+        self.tty = tty
+        self.fd = fd
+        self.name = None
+        self.items = 0
+        self.nbytes = 0
+        self.totals = (None, None)
+        self.exact = True
+        self.start = 0.0
+        self._lock = threading.Lock()
+        self._stop = None
+        self._thread = None
+        self._paused = False
+        self._shown = False
+
+    def add(self, items, nbytes):
+        """Count items and nbytes as done."""
+        with self._lock:
+            self.items += items
+            self.nbytes += nbytes
+
+    def begin(self, name, items=None, nbytes=None, exact=True):
+        """Start reporting the phase name, with totals if known."""
+        self.name = name
+        self.items = self.nbytes = 0
+        self.totals = (items, nbytes)
+        self.exact = exact
+        self.start = time.time()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._report)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def end(self):
+        """Stop reporting the phase, clearing the line, with a last record."""
+        self._stop.set()
+        self._thread.join()
+        self.pause(True)
+        self._paused = False
+        self._emit(True)
+
+    def pause(self, paused=True):
+        """Hide the status line (e.g. for a prompt) or show it again."""
+        with self._lock:
+            self._paused = paused
+            if paused and self._shown:
+                sys.stderr.write('\r\033[K')
+                sys.stderr.flush()
+                self._shown = False
+
+    def _report(self):
+        last = self.start
+        while not self._stop.wait(PROGRESS_REFRESH):
+            now = time.time()
+            if self.tty and now - self.start >= PROGRESS_DELAY:
+                self._draw()
+            if self.fd is not None and now - last >= PROGRESS_INTERVAL:
+                last = now
+                self._emit(False)
+
+    def status(self):
+        """Return the current counts, rates, and ETA as a dictionary."""
+        elapsed = max(time.time() - self.start, 1e-6)
+        done = {'items': self.items, 'bytes': self.nbytes}
+        rec = {
+            'phase': self.name, 'items': self.items, 'bytes': self.nbytes,
+            'items_total': self.totals[0], 'bytes_total': self.totals[1],
+            'exact': self.exact, 'elapsed': round(elapsed, 3),
+            'items_per_sec': round(self.items / elapsed, 1),
+            'bytes_per_sec': int(self.nbytes / elapsed), 'eta': None,
+        }
+        # Bytes are the better measure of what is left, if known
+        for key in ('bytes', 'items'):
+            total = rec[key + '_total']
+            if not self.exact and total is not None and done[key] > total:
+                # Past a lower bound, the total is not known after all
+                rec[key + '_total'] = total = None
+            if total and done[key] and done[key] < total:
+                rec['eta'] = round(
+                    (total - done[key]) / (done[key] / elapsed), 1
+                )
+                break
+        return rec
+
+    def _draw(self):
+        rec = self.status()
+        pre = '' if self.exact else '>='
+        text = '{0}: {1}'.format(self.name.capitalize(), rec['items'])
+        if rec['items_total']:
+            text += ' of {0}{1}'.format(pre, rec['items_total'])
+        text += ' items ({0}/s)'.format(format_count(
+            int(rec['items_per_sec'])
+        ))
+        if rec['bytes']:
+            text += ', {0}'.format(format_size(rec['bytes']))
+            if rec['bytes_total']:
+                text += ' of {0}{1}'.format(
+                    pre, format_size(rec['bytes_total'])
+                )
+            text += ' ({0}/s)'.format(format_size(rec['bytes_per_sec']))
+        if rec['eta'] is not None:
+            text += ', ETA {0}{1}'.format(pre, format_eta(rec['eta']))
+        with self._lock:
+            if self._paused:
+                return
+            sys.stderr.write(
+                '\r' + text[:get_term_width() - 1] + '\033[K'
+            )
+            sys.stderr.flush()
+            self._shown = True
+
+    def _emit(self, done):
+        if self.fd is None:
+            return
+        rec = self.status()
+        rec['done'] = done
+        try:
+            line = json.dumps(rec, sort_keys=True) + '\n'
+            os.write(self.fd, line.encode())
+        except OSError:
+            # Nobody is listening any more
+            self.fd = None
+
+
+class _ProgressPhase(object):
+    """Reports progress during a with block, see progress_phase."""
+
+    def __init__(self, prog, name, items=None, nbytes=None, exact=True):
+        self.prog = prog
+        self.args = (name, items, nbytes, exact)
+
+    def __enter__(self):
+        if self.prog is not None:
+            self.prog.begin(*self.args)
+        return self
+
+    def __exit__(self, *exc):
+        if self.prog is not None:
+            self.prog.end()
+        return False
+
+
+def progress_phase(name, items=None, nbytes=None, exact=True):
+    """Report the progress of a with block, if progress is being reported.
+
+    items and nbytes are the totals expected, None if unknown, exact is
+    False if they are lower bounds.
+    """
+    return _ProgressPhase(_PROGRESS.get('current'), name, items, nbytes, exact)
+
+
+def pause_progress(paused=True):
+    """Hide the status line, if any, e.g. to prompt, or show it again."""
+    prog = _PROGRESS.get('current')
+    if prog is not None:
+        prog.pause(paused)
+
+
+def progress(items=1, nbytes=0):
+    """Count items and nbytes as done, for the progress report if any."""
+    prog = _PROGRESS.get('current')
+    if prog is not None:
+        prog.add(items, nbytes)
+
+
+###############################################################################
+#                              Deletion Helpers                               #
+###############################################################################
+
+
+def recycle_files(files, mv_flags, try_apple=True, verbose=False, dryrun=False,
+                  infos=None, background=False, dedup=False):
+    """Identify best recycle bins for files and then try to recycle them.
+
+    Params
+    ------
+    files : list of str
+        Files, directories, or something else to recycle
+    mv_flags : list of str
+        mv style flags, only '-v' has any meaning, as nothing is overwritten
+    try_apple : bool, optional
+        Try to use apple script, only means anything on Darwin, default True.
+    verbose : bool, optional
+        Print extra info
+    dryrun : bool
+        Don't actually move anything
+    infos : dict, optional
+        abspath->FileInfo (or lstat result) for files already stat'd, saves
+        stat'ing them again
+    background : bool, optional
+        Copy files to trashes on other devices in the background
+    dedup : bool, optional
+        Hard link identical files in each trash to one copy
+
+    Returns
+    -------
+    list
+        List of failed files, empty on success
+    """
+    # Get the longest path first, so we can pick the best mountpoints
+    # We need absolute paths for recycling
+    files = sorted(
+        [os.path.abspath(i) for i in files],
+        key=lambda x: len(x), reverse=True
+    )
+
+    # Try applescript first on MacOS
+    if try_apple and SYSTEM == 'Darwin' and get_osascript():
+        if verbose:
+            sys.stderr.write('Attempting to use applescript\n')
+        new_fls = []
+        if dryrun:
+            sys.stderr.write(
+                'Moving {0} to Trash with Finder via Applescript\n'
+                .format(files)
+            )
+            return []
+        for fl in files:
+            if recycle_darwin(fl, verbose=verbose) != 0:
+                new_fls.append(fl)
+        if new_fls:
+            sys.stderr.write(
+                'Applescript failed on:\n{0}\n'.format(format_list(new_fls))
+            )
+            files = new_fls
+        else:
+            return []
+
+    # Group files by device and trash in one pass, then check each trash once
+    plan = plan_recycle(files, infos)
+    trashes, to_delete = plan.resolve()
+
+    # Do the deed, in batches so metadata writes and fsyncs are shared
+    for trash, file_list in trashes.items():
+        if dryrun:
+            for fl in file_list:
+                sys.stderr.write('Moving {0} to {1}\n'.format(fl, trash))
+            continue
+        for i in range(0, len(file_list), RECYCLE_BATCH):
+            to_delete += recycle_batch(
+                file_list[i:i+RECYCLE_BATCH], trash, mv_flags, infos,
+                background=background, dedup=dedup
+            )
+
+    # Check if user wants to try to force delete files
+    if to_delete:
+        sys.stderr.write(
+            'Failed to recycle:\n{0}\n'.format(
+                format_list(to_delete, infos=infos)
+            )
+        )
+        if yesno('Attempt to fully delete with rm?', False,
+                 key='recycle-failed'):
+            return to_delete
+
+    return []
+
+
+def move_file(src, dest, verbose=False):
+    """Move src to the exact path dest in-process, like `mv -- src dest`.
+
+    Uses os.rename, which is atomic and O(1) on the same filesystem. Only
+    falls back to copying (via shutil.move) if src and dest are on different
+    devices.
+
+    Params
+    ------
+    src : str
+    dest : str
+        The final path, not the parent directory
+    verbose : bool, optional
+        Print what was moved (mv -v)
+
+    Returns
+    -------
+    exit_code : int
+        0 on success, something else on failure
+    """
+    throttle()
+    try:
+        try:
+            os.rename(src, dest)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            shutil.move(src, dest)
+    except (OSError, IOError, shutil.Error) as err:
+        reason = getattr(err, 'strerror', None) or err
+        sys.stderr.write(
+            'cannot move {0} to {1}: {2}\n'.format(
+                quote(src), quote(dest), reason
+            )
+        )
+        return 1
+    if verbose:
+        sys.stdout.write(
+            'renamed {0} -> {1}\n'.format(quote(src), quote(dest))
+        )
+    return 0
+
+
+def recycle_file(fl, trash, mv_flags=None, info=None, dedup=False):
+    """Move one file to trash, do kung-foo on Linux.
+
+    If on Linux, file moved to trash/files unless trash==RECYCLE_BIN. Will
+    also create a trashinfo file. If not Linux, file just moved to trash
+    directly. See recycle_batch, which does the work.
+
+    Params
+    -------
+    fl : str
+    trash : str
+    mv_flags : list of str
+        mv style flags, only '-v' has any meaning, as nothing is overwritten
+    info : FileInfo or os.stat_result, optional
+        lstat of fl, for the size and mtime in the index
+    dedup : bool, optional
+        Hard link fl to an identical file already in trash, see dedup_trashed
+
+    Returns
+    -------
+    exit_code : int
+        0 on success, something else on failure
+    """
+    infos = {fl: info} if info else None
+    return 1 if recycle_batch([fl], trash, mv_flags, infos, dedup=dedup) \
+        else 0
+
+
+def recycle_batch(files, trash, mv_flags=None, infos=None, background=False,
+                  dedup=False):
+    """Move files to trash, with trashinfo files on Linux.
+
+    Every file gets a unique name in the trash (name, name.2, name.3...), so
+    two files with the same basename never clobber each other. On Linux the
+    name is reserved by creating its trashinfo with O_EXCL, as in the
+    FreeDesktop spec. The trashinfo contents are written to temporary files
+    and renamed into place once the whole batch has moved, followed by one
+    fsync per directory and one index write for the batch.
+
+    Params
+    ------
+    files : list of str
+        Absolute paths
+    trash : str
+    mv_flags : list of str
+        mv style flags, only '-v' has any meaning
+    infos : dict, optional
+        path->FileInfo (or lstat result), for the size and mtime in the index
+    background : bool, optional
+        Copy files on other devices to the trash in a forked child process
+        (see TreeCopier), instead of waiting for them
+    dedup : bool, optional
+        Hard link files identical to ones already in the trash to a single
+        copy once moved, see dedup_trashed
+
+    Returns
+    -------
+    failed : list of str
+        Files that could not be recycled
+    """
+    verbose = '-v' in mv_flags if mv_flags else False
+    infos = infos if infos else {}
+    trash_can = trash_files_dir(trash)
+    trash_info = os.path.join(trash, 'info') if trash_can != trash else None
+    for dr in [trash_can, trash_info]:
+        if dr and not os.path.isdir(dr):
+            os.makedirs(dr)
+    date = dt.now().strftime(TIMEFMT)
+    trash_dev = os.stat(trash_can).st_dev
+    failed = []
+    moved = []
+    cross = []
+    # basename->next suffix to try, so repeated names are not probed again
+    counters = {}
+    for fl in files:
+        info = infos.get(fl)
+        try:
+            if info is None:
+                info = os.lstat(fl)
+            name = reserve_trash_name(trash_can, trash_info, fl, counters)
+        except OSError as err:
+            sys.stderr.write('cannot recycle {0}: {1}\n'.format(
+                quote(fl), err.strerror
+            ))
+            failed.append(fl)
+            continue
+        # Renaming across devices is a slow copy, do those all at once below
+        if info.st_dev != trash_dev:
+            cross.append((fl, name, info))
+            continue
+        if move_file(fl, os.path.join(trash_can, name), verbose=verbose):
+            if trash_info:
+                os.unlink(os.path.join(trash_info, name + '.trashinfo'))
+            failed.append(fl)
+            continue
+        moved.append((fl, name, info))
+        progress()
+
+    if cross and background and hasattr(os, 'fork'):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if os.fork() == 0:
+            # The child copies while the shell gets control back, so must
+            # not write to the terminal, or touch the reporter thread, which
+            # is not running here (its lock may have been held at the fork)
+            try:
+                os.setsid()
+                _PROGRESS.pop('current', None)
+                null = os.open(os.devnull, os.O_RDWR)
+                for fd in (0, 1, 2):
+                    os.dup2(null, fd)
+                done = copy_to_trash(cross, trash_can, trash_info)[0]
+                record_trashed(
+                    trash, done, date,
+                    dedup_trashed(trash, done) if dedup else None
+                )
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(0)
+        sys.stderr.write(
+            'Copying {0} items to {1} in the background\n'
+            .format(len(cross), trash)
+        )
+    elif cross:
+        done, bad = copy_to_trash(cross, trash_can, trash_info,
+                                  verbose=verbose, progress=verbose)
+        progress(len(done))
+        moved += done
+        failed += bad
+    record_trashed(
+        trash, moved, date, dedup_trashed(trash, moved) if dedup else None
+    )
+    return failed
+
+
+def record_trashed(trash, moved, date, objects=None):
+    """Write trashinfo files and the index for items moved into trash.
+
+    Params
+    ------
+    trash : str
+    moved : list of tuple
+        (original path, name in trash, FileInfo or lstat result)
+    date : str
+        Deletion date, formatted with TIMEFMT
+    objects : dict, optional
+        name->(stored copy, linked) from dedup_trashed
+    """
+    if not moved:
+        return
+    trash_can = trash_files_dir(trash)
+    trash_info = os.path.join(trash, 'info') if trash_can != trash else None
+    if trash_info:
+        for fl, name, _ in moved:
+            write_trashinfo(trash_info, name, fl, date)
+        fsync_dir(trash_info)
+    fsync_dir(trash_can)
+    records = []
+    for fl, name, info in moved:
+        rec = {
+            'op': 'add', 'path': fl, 'name': name, 'size': info.st_size,
+            'mtime': info.st_mtime, 'date': date,
+        }
+        # Exactly, to give a deduplicated file back its mtime on restore
+        if getattr(info, 'st_mtime_ns', None) is not None:
+            rec['mtime_ns'] = info.st_mtime_ns
+        # Directory usage is measured when first needed (see measure_usage)
+        if not stat.S_ISDIR(info.st_mode):
+            rec['usage'] = info.st_size
+        if objects and name in objects:
+            rec['object'], linked = objects[name]
+            # The stored copy's blocks are counted once, by its first file
+            if linked:
+                rec['dedup'] = True
+                rec['usage'] = 0
+        records.append(rec)
+    index_add(trash, records)
+
+
+def write_trashinfo(trash_info, name, path, date):
+    """Write name.trashinfo in trash_info, replacing any reservation.
+
+    The contents are written to a temporary file and renamed into place, so
+    the trashinfo is never seen half written. As the trash spec requires,
+    path is percent-encoded (see read_trashinfo).
+    """
+    try:
+        from urllib.parse import quote as url_quote
+        path = url_quote(path, safe='/', errors='surrogateescape')
+    except ImportError:
+        from urllib import quote as url_quote
+        path = url_quote(path, safe='/')
+    tmp = os.path.join(trash_info, '.{0}.{1}.tmp'.format(name, os.getpid()))
+    with open(tmp, 'w') as fout:
+        fout.write(TRASHINFO.format(path=path, date=date))
+    os.rename(tmp, os.path.join(trash_info, name + '.trashinfo'))
+
+
+def copy_to_trash(items, trash_can, trash_info=None, verbose=False,
+                  progress=False):
+    """Copy items to trash_can in parallel, removing each source once copied.
+
+    A source is only removed once every file below it has been copied and
+    its size checked. Anything that fails is left in place, its partial copy
+    and name reservation are removed.
+
+    Params
+    ------
+    items : list of tuple
+        (original path, reserved name, FileInfo or lstat result)
+    trash_can : str
+    trash_info : str, optional
+        Trash info directory holding the name reservations
+    verbose : bool, optional
+    progress : bool, optional
+        Print progress to STDERR every PROGRESS_INTERVAL seconds
+
+    Returns
+    -------
+    done : list of tuple
+        The items that are now in the trash
+    failed : list of str
+        Original paths that could not be recycled
+    """
+    copier = TreeCopier(progress=progress)
+    ok = copier.run([
+        (fl, os.path.join(trash_can, name)) for fl, name, _ in items
+    ])
+    done = []
+    failed = []
+    for (fl, name, info), good in zip(items, ok):
+        dest = os.path.join(trash_can, name)
+        if good:
+            # The copy is safe in the trash even if the source cannot go
+            done.append((fl, name, info))
+            if verbose:
+                sys.stdout.write(
+                    'copied {0} -> {1}\n'.format(quote(fl), quote(dest))
+                )
+            delete_files([fl], force=True, recursive=True)
+            continue
+        failed.append(fl)
+        delete_files([dest], force=True, recursive=True)
+        if trash_info:
+            os.unlink(os.path.join(trash_info, name + '.trashinfo'))
+    return done, failed
+
+
+def reserve_trash_name(trash_can, trash_info, fl, counters=None):
+    """Return a name for fl that is unused in trash_can, reserving it.
+
+    With a trash_info directory the name is claimed by creating an empty
+    name.trashinfo with O_EXCL, which is atomic even between processes,
+    without one the name is just checked to be free.
+
+    counters (basename->next suffix) is updated with the suffix after the
+    one reserved, so that a batch of files with the same basename starts
+    each search where the last one stopped, instead of probing name, name.2,
+    name.3... all over again.
+    """
+    base = os.path.basename(fl.rstrip(os.sep)) or 'root'
+    counters = {} if counters is None else counters
+    count = counters.get(base, 1)
+    name = base if count == 1 else '{0}.{1}'.format(base, count)
+    while True:
+        if trash_info:
+            try:
+                fd = os.open(
+                    os.path.join(trash_info, name + '.trashinfo'),
+                    os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600
+                )
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            else:
+                os.close(fd)
+                # An orphan without a trashinfo may still hold the name
+                if not os.path.lexists(os.path.join(trash_can, name)):
+                    counters[base] = count + 1
+                    return name
+                os.unlink(os.path.join(trash_info, name + '.trashinfo'))
+        elif not os.path.lexists(os.path.join(trash_can, name)):
+            counters[base] = count + 1
+            return name
+        count += 1
+        name = '{0}.{1}'.format(base, count)
+
+
+def fsync_dir(path):
+    """fsync the directory path, so renames into it are durable."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def trash_files_dir(trash):
+    """Return the directory in trash that recycled files are moved into."""
+    if trash == RECYCLE_BIN or SYSTEM != 'Linux':
+        return trash
+    return os.path.join(trash, 'files')
+
+
+def recycle_darwin(fl, verbose=False):
+    """Move fl (file or dir) to trash on MacOS using applescript.
+
+    Returns
+    -------
+    exit_code : int
+        0 on success, something else on failure
+    """
+    cmnd = (
+        '{0} -e '
+        '"tell application \\"Finder\\" to delete POSIX file \\"{1}\\"" '
+        '>/dev/null 2>/dev/null'
+    ).format(get_osascript(), os.path.abspath(fl))
+    if verbose:
+        sys.stderr.write(cmnd + '\n')
+    return call(cmnd, shell=True)
+
+
+def shred_paths(drs, fls, shred_args, verbose=False, dryrun=False,
+                external=False):
+    """Shred fls and every file in drs, recursively.
+
+    Shredding is done in-process by Shredder, unless external is True, in
+    which case the shred (or gshred) executable is run once per directory.
+
+    Returns
+    -------
+    failed : list of str
+        Directories and files where shred failed, empty on success
+    """
+    if not external:
+        shredder = Shredder(shred_args, verbose=verbose, dryrun=dryrun)
+        return shredder.run(drs, fls)
+    failed = []
+    if drs:
+        if verbose:
+            sys.stderr.write(
+                'Recursively shredding files in the following dirs:\n{0}\n'
+                .format(format_list(drs))
+            )
+        for dr in drs:
+            for wroot, wdirs, wfiles in os.walk(dr):
+                if verbose:
+                    sys.stderr.write('Shredding in {0}\n'.format(wroot))
+                if wfiles:
+                    sfls = [os.path.join(wroot, i) for i in wfiles]
+                    if shred_files(sfls, shred_args, verbose, dryrun) != 0:
+                        failed.append(wroot)
+                elif verbose:
+                    sys.stderr.write('No files to shred\n')
+    if fls:
+        if shred_files(fls, shred_args, verbose, dryrun) != 0:
+            failed += fls
+    return failed
+
+
+def shred_files(sfls, shred_args, verbose=False, dryrun=False):
+    """Call shred on sfls."""
+    cmd = '{0} {1} -- {2}'.format(
+        get_shred(), ' '.join(shred_args),
+        ' '.join([quote(i) for i in sfls])
+    )
+    if dryrun or verbose:
+        sys.stderr.write('Running: {0}\n'.format(cmd))
+    if not dryrun:
+        return call(sh.split(cmd))
+    return 0
+
+
+###############################################################################
+#                          In-Process Shredding Engine                        #
+###############################################################################
+
+
+class Shredder(object):
+    """Overwrite files in-process, a multi-threaded replacement for shred.
+
+    Every file is overwritten passes times from one preallocated, page
+    aligned random buffer, then once with zeros if -z, with an fsync after
+    each pass. Files are shredded in parallel by WORKERS threads, with at
+    most SHRED_PER_DEVICE files on any one device at a time. Like shred,
+    writes are rounded up to the filesystem block size. Symlinks are never
+    followed, only regular files are overwritten.
+
+    Attributes
+    ----------
+    failed : list of str
+        Files that could not be shredded
+    files : int
+        Files shredded
+    nbytes : int
+        Bytes written, all passes included
+    """
+
+    def __init__(self, shred_args=None, verbose=False, dryrun=False,
+                 workers=None):
+        """Options come from shred style flags: -n N, -z, -f, and -v."""
+        shred_args = shred_args if shred_args else []
+        self.passes = SHRED_PASSES
+        if '-n' in shred_args:
+            self.passes = int(shred_args[shred_args.index('-n') + 1])
+        self.zero = '-z' in shred_args
+        self.force = '-f' in shred_args
+        self.verbose = verbose or '-v' in shred_args
+        self.dryrun = dryrun
+        self.workers = workers if workers else WORKERS
+        self.failed = []
+        self.files = 0
+        self.nbytes = 0
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._random = None
+        self._zeros = None
+
+    def _buffers(self):
+        """Create the random and zero buffers, mmap is page aligned.
+
+        On python 2 mmap has no buffer interface for memoryview, bytearrays
+        are used instead.
+        """
+        random = mmap.mmap(-1, SHRED_BUFFER)
+        random.write(os.urandom(SHRED_BUFFER))
+        zeros = mmap.mmap(-1, SHRED_BUFFER)
+        try:
+            self._random = memoryview(random)
+            self._zeros = memoryview(zeros)
+        except TypeError:
+            self._random = memoryview(bytearray(random[:]))
+            self._zeros = memoryview(bytearray(SHRED_BUFFER))
+            random.close()
+            zeros.close()
+
+    def _device_lock(self, dev):
+        """Return the semaphore capping concurrent shreds on device dev."""
+        with self._lock:
+            if dev not in self._devices:
+                self._devices[dev] = threading.Semaphore(SHRED_PER_DEVICE)
+            return self._devices[dev]
+
+    def _open(self, path):
+        """Open path for writing without following symlinks, chmod if -f."""
+        flags = os.O_WRONLY | getattr(os, 'O_NOFOLLOW', 0)
+        try:
+            return os.open(path, flags)
+        except OSError as err:
+            if not self.force or err.errno not in (errno.EACCES, errno.EPERM):
+                raise
+        os.chmod(path, stat.S_IMODE(os.lstat(path).st_mode) | stat.S_IWUSR)
+        return os.open(path, flags)
+
+    def shred(self, path):
+        """Overwrite one file, records any failure."""
+        try:
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode):
+                return
+            if self.dryrun:
+                if self.verbose:
+                    sys.stderr.write('Would shred {0}\n'.format(quote(path)))
+                return
+            blksize = getattr(st, 'st_blksize', 0) or 4096
+            size = -(-st.st_size // blksize) * blksize
+            bufs = [self._random] * self.passes
+            if self.zero:
+                bufs.append(self._zeros)
+            with self._device_lock(st.st_dev):
+                throttle()
+                fd = self._open(path)
+                try:
+                    for buf in bufs:
+                        offset = 0
+                        while offset < size:
+                            chunk = buf[:min(len(buf), size - offset)]
+                            throttle(0, len(chunk))
+                            written = _pwrite(fd, chunk, offset)
+                            progress(0, written)
+                            offset += written
+                        os.fsync(fd)
+                finally:
+                    os.close(fd)
+        except (OSError, IOError) as err:
+            with self._lock:
+                self.failed.append(path)
+            sys.stderr.write('shred: {0}: {1}\n'.format(
+                quote(path), getattr(err, 'strerror', None) or err
+            ))
+            return
+        progress()
+        with self._lock:
+            self.files += 1
+            self.nbytes += size * len(bufs)
+        if self.verbose:
+            sys.stderr.write('shredded {0}\n'.format(quote(path)))
+
+    def _walk(self, drs, fls):
+        """Yield every path to shred."""
+        for fl in fls:
+            yield fl
+        for dr in drs:
+            for wroot, _, wfiles in os.walk(dr):
+                for fl in wfiles:
+                    yield os.path.join(wroot, fl)
+
+    def run(self, drs, fls):
+        """Shred fls and every file below drs, returns the failed files."""
+        try:
+            from queue import Queue
+        except ImportError:
+            from Queue import Queue
+        # Bounded, so huge trees are never listed in memory all at once
+        todo = Queue(self.workers * 64)
+
+        def worker():
+            while True:
+                path = todo.get()
+                if path is None:
+                    return
+                self.shred(path)
+
+        start = time.time()
+        if not self.dryrun:
+            self._buffers()
+        threads = [
+            threading.Thread(target=worker) for _ in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for path in self._walk(drs, fls):
+                todo.put(path)
+        finally:
+            for _ in threads:
+                todo.put(None)
+            for thread in threads:
+                thread.join()
+        elapsed = max(time.time() - start, 1e-6)
+        if not self.dryrun:
+            pause_progress()
+            sys.stderr.write(
+                'Shredded {0} files, wrote {1} in {2:.1f}s ({3}/s)\n'.format(
+                    self.files, format_size(self.nbytes), elapsed,
+                    format_size(self.nbytes / elapsed)
+                )
+            )
+            pause_progress(False)
+        return self.failed
+
+
+def _pwrite(fd, data, offset):
+    """Write data at offset in fd, returns the number of bytes written."""
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+###############################################################################
+#                         Cross-Device Copy Engine                            #
+###############################################################################
+
+
+class TreeCopier(object):
+    """Copy files and directory trees between devices in parallel.
+
+    File data is copied by the fastest method that works: a reflink (FICLONE
+    ioctl, shares blocks on filesystems like btrfs and XFS), then
+    os.copy_file_range, then os.sendfile, then plain reads and writes. The
+    working method is remembered per pair of devices. Directories are
+    created as the tree is walked, their file copies run on a thread pool.
+
+    Attributes
+    ----------
+    copied : int
+        Bytes copied so far
+    total : int
+        Bytes found to copy so far
+    """
+
+    def __init__(self, workers=None, progress=False):
+        """progress prints a status line every PROGRESS_INTERVAL seconds."""
+        self.workers = workers if workers else WORKERS
+        self.progress = progress
+        self.copied = 0
+        self.total = 0
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def _copy_data(self, sfd, dfd, size, devs):
+        """Copy size bytes from sfd to dfd, returns bytes copied."""
+        methods = ['clone', 'range', 'sendfile', 'rw']
+        start = methods.index(self._methods.get(devs, 'clone'))
+        for method in methods[start:]:
+            try:
+                done = getattr(self, '_copy_' + method)(sfd, dfd, size)
+            except (OSError, IOError, AttributeError, NotImplementedError):
+                done = None
+            if done is not None:
+                self._methods[devs] = method
+                return done
+        raise IOError(errno.EIO, 'Could not copy file data')
+
+    def _copy_clone(self, sfd, dfd, size):
+        import fcntl
+        fcntl.ioctl(dfd, FICLONE, sfd)
+        self._add(size)
+        return size
+
+    def _copy_range(self, sfd, dfd, size):
+        return self._copy_loop(
+            lambda left: os.copy_file_range(sfd, dfd, left), size
+        )
+
+    def _copy_sendfile(self, sfd, dfd, size):
+        offset = [0]
+
+        def send(left):
+            sent = os.sendfile(dfd, sfd, offset[0], left)
+            offset[0] += sent
+            return sent
+        return self._copy_loop(send, size)
+
+    def _copy_rw(self, sfd, dfd, size):
+        def rw(left):
+            data = os.read(sfd, min(left, COPY_CHUNK))
+            return os.write(dfd, data) if data else 0
+        return self._copy_loop(rw, size)
+
+    def _copy_loop(self, step, size):
+        """Call step(bytes left) until size bytes are copied or it is done."""
+        done = 0
+        while done < size:
+            count = step(min(size - done, COPY_CHUNK))
+            if not count:
+                break
+            done += count
+            self._add(count)
+            throttle(0, count)
+        return done
+
+    def _add(self, count):
+        progress(0, count)
+        with self._lock:
+            self.copied += count
+
+    def copy_file(self, src, dst, st):
+        """Copy the regular file src to dst, with its mode and times.
+
+        Raises IOError if the copy is not the same size as src.
+        """
+        throttle()
+        sfd = os.open(src, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        try:
+            dfd = os.open(
+                dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                stat.S_IMODE(st.st_mode) | stat.S_IWUSR
+            )
+            try:
+                dev = os.fstat(dfd).st_dev
+                self._copy_data(sfd, dfd, st.st_size, (st.st_dev, dev))
+                size = os.fstat(dfd).st_size
+            finally:
+                os.close(dfd)
+        finally:
+            os.close(sfd)
+        if size != st.st_size:
+            raise IOError(errno.EIO, 'Copy is {0} bytes, not {1}'.format(
+                size, st.st_size
+            ))
+        copy_stat(dst, st)
+
+    def copy_other(self, src, dst, st):
+        """Copy a symlink, directory (not its contents), or fifo."""
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), dst)
+        elif stat.S_ISDIR(st.st_mode):
+            os.mkdir(dst, 0o700)
+        elif stat.S_ISFIFO(st.st_mode):
+            os.mkfifo(dst, stat.S_IMODE(st.st_mode))
+        else:
+            raise IOError(errno.EINVAL, 'Cannot copy special file')
+
+    def run(self, items):
+        """Copy every (src, dst) in items, returns a list of bools for success.
+
+        Everything below a directory is copied in parallel, directory modes
+        and times are set once their contents are done.
+        """
+        ok = [True] * len(items)
+        pool = get_thread_pool(self.workers)
+        jobs = []
+        dirs = []
+        start = time.time()
+
+        def submit(index, src, dst, st):
+            if pool is None:
+                try:
+                    self.copy_file(src, dst, st)
+                except (OSError, IOError) as err:
+                    self._fail(ok, index, src, err)
+            else:
+                jobs.append((index, src, pool.submit(
+                    self.copy_file, src, dst, st
+                )))
+
+        for index, (src, dst) in enumerate(items):
+            try:
+                st = os.lstat(src)
+                if not stat.S_ISDIR(st.st_mode):
+                    if stat.S_ISREG(st.st_mode):
+                        self.total += st.st_size
+                        submit(index, src, dst, st)
+                    else:
+                        self.copy_other(src, dst, st)
+                    continue
+                for root, drs, fls in os.walk(src, onerror=_raise):
+                    droot = dst if root == src else os.path.join(
+                        dst, os.path.relpath(root, src)
+                    )
+                    rst = os.lstat(root)
+                    self.copy_other(root, droot, rst)
+                    dirs.append((droot, rst))
+                    for name in fls + [i for i in drs if os.path.islink(
+                            os.path.join(root, i))]:
+                        fsrc = os.path.join(root, name)
+                        fst = os.lstat(fsrc)
+                        if stat.S_ISREG(fst.st_mode):
+                            self.total += fst.st_size
+                            submit(index, fsrc, os.path.join(droot, name), fst)
+                        else:
+                            self.copy_other(
+                                fsrc, os.path.join(droot, name), fst
+                            )
+            except (OSError, IOError) as err:
+                self._fail(ok, index, src, err)
+
+        last = start
+        if jobs:
+            # Waiting, rather than result with a timeout, means no timeout
+            # exception to tell apart from the copy's own errors (on python
+            # 3.11+ the futures TimeoutError is an OSError)
+            from concurrent.futures import wait
+        for index, src, job in jobs:
+            while not wait([job], PROGRESS_INTERVAL)[0]:
+                if self.progress and time.time() - last >= PROGRESS_INTERVAL:
+                    last = time.time()
+                    self.report(last - start)
+            err = job.exception()
+            if err is None:
+                continue
+            if not isinstance(err, (OSError, IOError)):
+                raise err
+            self._fail(ok, index, src, err)
+        if pool is not None:
+            pool.shutdown()
+        for droot, rst in reversed(dirs):
+            try:
+                copy_stat(droot, rst)
+            except OSError:
+                pass
+        if self.progress and jobs:
+            self.report(time.time() - start)
+        return ok
+
+    def _fail(self, ok, index, src, err):
+        ok[index] = False
+        sys.stderr.write('cannot copy {0}: {1}\n'.format(
+            quote(src), getattr(err, 'strerror', None) or err
+        ))
+
+    def report(self, elapsed):
+        """Print how much has been copied."""
+        sys.stderr.write('Copied {0} of {1} to trash ({2}/s)\n'.format(
+            format_size(self.copied), format_size(self.total),
+            format_size(self.copied / max(elapsed, 1e-6))
+        ))
+
+
+def _raise(err):
+    """os.walk onerror callback, so unreadable directories fail the copy."""
+    raise err
+
+
+def copy_stat(dst, st):
+    """Set the mode and times of dst (not followed if a symlink) from st."""
+    if stat.S_ISLNK(st.st_mode):
+        if os.utime not in getattr(os, 'supports_follow_symlinks', ()):
+            return
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns),
+                 follow_symlinks=False)
+        return
+    os.chmod(dst, stat.S_IMODE(st.st_mode))
+    if hasattr(st, 'st_mtime_ns'):
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    else:
+        os.utime(dst, (st.st_atime, st.st_mtime))
+
+
+###############################################################################
+#                          In-Process Deletion Engine                         #
+###############################################################################
+
+
+def get_thread_pool(workers):
+    """Return a ThreadPoolExecutor, None on python 2 where there is none.
+
+    Imported here as concurrent.futures is slow to import and most runs
+    never need it.
+    """
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        return None
+    return ThreadPoolExecutor(workers)
+
+
+def os_error(code):
+    """Return an OSError for the errno code, with the standard message."""
+    return OSError(code, os.strerror(code))
+
+
+def list_dir(path):
+    """Yield (name, is_dir) for the entries in path, symlinks are not dirs.
+
+    Uses os.scandir where available, so the type comes from d_type without
+    another stat.
+    """
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                is_dir = False
+            yield entry.name, is_dir
+    else:
+        for name in os.listdir(path):
+            try:
+                mode = os.lstat(os.path.join(path, name)).st_mode
+            except OSError:
+                mode = 0
+            yield name, stat.S_ISDIR(mode)
+
+
+def refuse_reason(path, info):
+    """Return why rm would refuse to delete path, None if it would not."""
+    if os.path.basename(path.rstrip(os.sep)) in ('.', '..'):
+        return "refusing to remove '.' or '..' directory"
+    if stat.S_ISDIR(info.st_mode) and os.path.realpath(path) == '/':
+        return "it is dangerous to operate on '/'"
+    return None
+
+
+class Deleter(object):
+    """Delete files and directories in-process, see delete_files.
+
+    Attributes
+    ----------
+    failed : list of tuple
+        (path, reason) for everything that could not be removed
+    kept : set of str
+        Write-protected files the user chose to keep, and the directories
+        holding them, all left alone
+    """
+
+    # Files unlinked per pool task, and the fewest top-level items before
+    # it is worth starting threads at all
+    batch_size = 512
+
+    def __init__(self, force=False, interactive=False, verbose=False,
+                 recursive=False, dirs=False, workers=None):
+        """Set rm style options, workers defaults to WORKERS."""
+        self.force = force
+        self.interactive = interactive and not force
+        self.verbose = verbose
+        self.recursive = recursive
+        self.dirs = dirs
+        self.workers = workers if workers else WORKERS
+        self.failed = []
+        self.kept = set()
+        self._lock = threading.Lock()
+
+    def report(self, path, err):
+        """Record a failure, missing files are ignored with force.
+
+        As rm, ENOTDIR (e.g. link/ for a symlink to a directory) counts as
+        missing.
+        """
+        if self.force and getattr(err, 'errno', None) in (
+                errno.ENOENT, errno.ENOTDIR):
+            return
+        reason = getattr(err, 'strerror', None) or str(err)
+        with self._lock:
+            self.failed.append((path, reason))
+            sys.stderr.write(
+                'cannot remove {0}: {1}\n'.format(quote(path), reason)
+            )
+
+    def removed(self, path, is_dir=False):
+        """Print a path as it is removed, if verbose."""
+        progress()
+        if self.verbose:
+            with self._lock:
+                sys.stdout.write('removed {0}{1}\n'.format(
+                    'directory ' if is_dir else '', quote(path)
+                ))
+
+    def unlink(self, path, name=None, dir_fd=None):
+        """Unlink path, relative to dir_fd as name if given."""
+        if path in self.kept:
+            return
+        throttle()
+        try:
+            if dir_fd is None:
+                os.unlink(path)
+            else:
+                os.unlink(name, dir_fd=dir_fd)
+        except OSError as err:
+            self.report(path, err)
+        else:
+            self.removed(path)
+
+    def rmdir(self, path, name=None, dir_fd=None):
+        """Remove the empty directory path, relative to dir_fd as name."""
+        if path in self.kept:
+            return
+        throttle()
+        try:
+            if dir_fd is None:
+                os.rmdir(path)
+            else:
+                os.rmdir(name, dir_fd=dir_fd)
+        except OSError as err:
+            # Walkers list symlinks to directories as directories
+            if err.errno == errno.ENOTDIR:
+                self.unlink(path, name, dir_fd)
+            else:
+                self.report(path, err)
+        else:
+            self.removed(path, True)
+
+    def remove_tree(self, path, name=None, dir_fd=None):
+        """Remove path and everything below it, bottom up.
+
+        Uses os.fwalk and dir_fd relative calls where supported, so no path
+        is resolved more than once and symlinks are never followed. If
+        dir_fd is given, path is name relative to it (fwalk only).
+        """
+        def onerror(err):
+            self.report(err.filename or path, err)
+        if HAS_FWALK:
+            top = path if dir_fd is None else name
+            parent = os.path.dirname(path) if dir_fd is not None else ''
+            for root, drs, fls, rootfd in os.fwalk(
+                    top, topdown=False, onerror=onerror, dir_fd=dir_fd):
+                root = os.path.join(parent, root)
+                for name in fls:
+                    self.unlink(os.path.join(root, name), name, rootfd)
+                for name in drs:
+                    self.rmdir(os.path.join(root, name), name, rootfd)
+        else:
+            for root, drs, fls in os.walk(path, topdown=False,
+                                          onerror=onerror):
+                for name in fls:
+                    self.unlink(os.path.join(root, name))
+                for name in drs:
+                    self.rmdir(os.path.join(root, name))
+        if dir_fd is not None:
+            self.rmdir(path, top, dir_fd)
+        else:
+            self.rmdir(path)
+
+    def unlink_many(self, paths):
+        """Unlink every path in paths."""
+        for path in paths:
+            self.unlink(path)
+
+    def refuse(self, path, info):
+        """Return True (and report) if rm would refuse to delete path."""
+        reason = refuse_reason(path, info)
+        if reason:
+            self.report(path, reason)
+            return True
+        return False
+
+    def keep_protected(self, path, info):
+        """Return True if the user declines to remove a write-protected file.
+
+        As rm, asked without -f when STDIN is a terminal, before any
+        threads are started.
+        """
+        if self.force or not stat.S_ISREG(info.st_mode) or \
+                os.access(path, os.W_OK) or not sys.stdin.isatty():
+            return False
+        kind = 'regular file' if info.st_size else 'regular empty file'
+        return not yesno('remove write-protected {0} {1}?'.format(
+            kind, quote(path)
+        ), False)
+
+    def keep_protected_below(self, trees):
+        """Ask about the write-protected files in trees, see keep_protected.
+
+        Walks the trees serially before any threads are started, only if rm
+        would ask (no -f, STDIN a terminal). Files the user keeps are added
+        to kept, with every directory above them up to the tree.
+        """
+        if self.force or not sys.stdin.isatty():
+            return
+        for tree in trees:
+            for root, _, fls in os.walk(tree):
+                for name in fls:
+                    path = os.path.join(root, name)
+                    try:
+                        info = os.lstat(path)
+                    except OSError:
+                        continue
+                    if not self.keep_protected(path, info):
+                        continue
+                    self.kept.add(path)
+                    while path.rstrip(os.sep) != tree.rstrip(os.sep) and \
+                            os.path.dirname(path) != path:
+                        path = os.path.dirname(path)
+                        self.kept.add(path)
+                    self.kept.add(tree)
+
+    def remove_interactive(self, path, is_dir):
+        """Remove path, asking the user first, always runs serially."""
+        if not is_dir:
+            if yesno('remove {0}?'.format(quote(path)), False):
+                self.unlink(path)
+            return
+        if not self.recursive:
+            if yesno('remove directory {0}?'.format(quote(path)), False):
+                self.rmdir(path)
+            return
+        if not yesno('descend into directory {0}?'.format(quote(path)),
+                     False):
+            return
+        try:
+            entries = list(list_dir(path))
+        except OSError as err:
+            self.report(path, err)
+            return
+        for name, sub_dir in entries:
+            self.remove_interactive(os.path.join(path, name), sub_dir)
+        if yesno('remove directory {0}?'.format(quote(path)), False):
+            self.rmdir(path)
+
+    def run(self, files, infos=None):
+        """Delete files, infos is an optional path->FileInfo dictionary.
+
+        Top-level files are unlinked in batches and the subdirectories of
+        each top-level directory are removed in parallel, each top-level
+        directory is removed once its contents are gone.
+        """
+        infos = infos if infos else {}
+        singles = []
+        trees = []
+        for fl in files:
+            info = infos.get(fl) or stat_file(fl)
+            if info is None:
+                self.report(fl, os_error(errno.ENOENT))
+                continue
+            if self.refuse(fl, info):
+                continue
+            is_dir = stat.S_ISDIR(info.st_mode)
+            if self.interactive:
+                if is_dir and not (self.recursive or self.dirs):
+                    self.report(fl, os_error(errno.EISDIR))
+                else:
+                    self.remove_interactive(fl, is_dir)
+            elif not is_dir:
+                if self.keep_protected(fl, info):
+                    continue
+                singles.append(fl)
+            elif self.recursive:
+                trees.append(fl)
+            elif self.dirs:
+                self.rmdir(fl)
+            else:
+                self.report(fl, os_error(errno.EISDIR))
+
+        self.keep_protected_below(trees)
+        serial = not trees and len(singles) < self.batch_size
+        pool = None if serial or self.workers < 2 else \
+            get_thread_pool(self.workers)
+        if pool is None:
+            self.unlink_many(singles)
+            for tree in trees:
+                self.remove_tree(tree)
+            return self.failed
+
+        try:
+            jobs = []
+            for i in range(0, len(singles), self.batch_size):
+                jobs.append(pool.submit(
+                    self.unlink_many, singles[i:i+self.batch_size]
+                ))
+            # Fan out one level down, so a single huge tree still uses
+            # every worker
+            for tree in trees:
+                batch = []
+                try:
+                    for name, is_dir in list_dir(tree):
+                        sub = os.path.join(tree, name)
+                        if is_dir:
+                            jobs.append(pool.submit(self.remove_tree, sub))
+                        else:
+                            batch.append(sub)
+                        if len(batch) >= self.batch_size:
+                            jobs.append(pool.submit(self.unlink_many, batch))
+                            batch = []
+                except OSError as err:
+                    self.report(tree, err)
+                if batch:
+                    jobs.append(pool.submit(self.unlink_many, batch))
+            for job in jobs:
+                job.result()
+        finally:
+            pool.shutdown()
+        for tree in trees:
+            self.rmdir(tree)
+        return self.failed
+
+
+def delete_files(files, force=False, interactive=False, verbose=False,
+                 recursive=False, dirs=False, infos=None, workers=None):
+    """Delete files and directories in-process with the semantics of rm.
+
+    Params
+    ------
+    files : list of str
+    force : bool, optional
+        Ignore missing files, never prompt (rm -f)
+    interactive : bool, optional
+        Prompt before every removal, runs serially (rm -i)
+    verbose : bool, optional
+        Print every path removed (rm -v)
+    recursive : bool, optional
+        Remove directories and their contents (rm -r)
+    dirs : bool, optional
+        Remove empty directories (rm -d)
+    infos : dict, optional
+        path->FileInfo for files already stat'd
+    workers : int, optional
+        Size of the thread pool, defaults to WORKERS
+
+    Returns
+    -------
+    failed : list of tuple
+        (path, reason) for everything that could not be removed, empty on
+        success
+    """
+    deleter = Deleter(
+        force=force, interactive=interactive, verbose=verbose,
+        recursive=recursive, dirs=dirs, workers=workers
+    )
+    return deleter.run(files, infos)
+
+
+###############################################################################
+#                      Fast Deletion, Rename Then Reap                        #
+###############################################################################
+
+
+def get_reap_dir(fl, st):
+    """Return a staging directory on the same device as fl, or None.
+
+    Tries the root of the mount, then HOME, then the directory containing
+    fl, creating the staging directory if needed.
+    """
+    for base in [get_mount(fl, st), HOME, os.path.dirname(fl)]:
+        reap_dir = os.path.join(base, REAP_DIR)
+        try:
+            if not os.path.lexists(reap_dir):
+                os.mkdir(reap_dir, 0o700)
+                os.chmod(reap_dir, 0o700)
+            rst = os.lstat(reap_dir)
+            if is_reap_dir(rst) and rst.st_dev == st.st_dev:
+                return reap_dir
+        except OSError:
+            continue
+    return None
+
+
+def is_reap_dir(st):
+    """Return True if st (from lstat) is a staging directory we can trust.
+
+    Staging directories are made in shared places (e.g. the root of a
+    mount), so anything not a real directory, owned by us, mode 0700, could
+    have been planted to make the reaper delete something else.
+    """
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == UID and \
+        stat.S_IMODE(st.st_mode) == 0o700
+
+
+def open_reap_dir(reap_dir):
+    """Return a file descriptor for reap_dir, None if it is not trusted.
+
+    Symlinks are not followed, and the directory opened is checked with
+    is_reap_dir, so it cannot be swapped after checking.
+    """
+    flags = os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0) | \
+        getattr(os, 'O_DIRECTORY', 0)
+    try:
+        fd = os.open(reap_dir, flags)
+    except OSError:
+        return None
+    try:
+        if is_reap_dir(os.fstat(fd)):
+            return fd
+    except OSError:
+        pass
+    os.close(fd)
+    return None
+
+
+def stage_files(files, infos=None, recursive=False, verbose=False):
+    """Rename files into staging directories and start a reaper on them.
+
+    Each rename is O(1), so this returns as soon as the targets are out of
+    the way, however big they are. Directories are only staged if recursive,
+    and nothing rm refuses to remove ('.', '..', '/') is ever staged.
+
+    Params
+    ------
+    files : list of str
+    infos : dict, optional
+        path->FileInfo for files already stat'd
+    recursive : bool, optional
+    verbose : bool, optional
+
+    Returns
     -------
-    exit_code : int
-        0 on success, something else on failure
+    left : list of str
+        Files that could not be staged, to be deleted directly
     """
-    if mv_flags:
-        mv_flags = ' '.join(mv_flags)
-    else:
-        mv_flags = ""
+    infos = infos if infos else {}
+    shared = {}
+    staged = []
+    left = []
+    prefix = '{0}.{1}.'.format(int(time.time()), os.getpid())
+    for count, fl in enumerate(files):
+        info = infos.get(fl)
+        if info is None:
+            info = stat_file(fl)
+        # Left for the Deleter to refuse, renaming would get round it
+        if info is None or (stat.S_ISDIR(info.st_mode) and not recursive) \
+                or refuse_reason(fl, info):
+            left.append(fl)
+            continue
+        abspath = os.path.abspath(fl)
+        reap_dir = shared.get(info.st_dev)
+        if reap_dir is None:
+            reap_dir = get_reap_dir(abspath, info)
+            if reap_dir is None:
+                left.append(fl)
+                continue
+            # Only the mount and HOME staging directories serve other paths
+            if os.path.dirname(reap_dir) != os.path.dirname(abspath):
+                shared[info.st_dev] = reap_dir
+        try:
+            # A target that is (or contains) the staging directory fails
+            os.rename(abspath, os.path.join(reap_dir, prefix + str(count)))
+        except OSError:
+            left.append(fl)
+            continue
+        if reap_dir not in staged:
+            staged.append(reap_dir)
+        if verbose:
+            sys.stdout.write('removed {0}\n'.format(quote(fl)))
+    if staged:
+        register_reap_dirs(staged)
+        start_reaper(staged)
+    return left
 
-    if trash == RECYCLE_BIN or SYSTEM != 'Linux':
-        return call(
-            sh.split('mv {0} -- {1} {2}'.format(
-                mv_flags, quote(fl), quote(trash)
-            ))
-        )
-    trash_can = os.path.join(trash, 'files')
-    if not os.path.isdir(trash_can):
-        call(sh.split('mkdir {0}'.format(trash_can)))
-    err = call(
-        sh.split('mv {0} -- {1} {2}'.format(
-            mv_flags, quote(fl), quote(trash_can)
-        ))
-    )
-    if err == 0:
-        now = dt.now()
-        trash_info = os.path.join(trash, 'info')
-        if not os.path.isdir(trash_info):
-            call(sh.split('mkdir {0}'.format(trash_info)))
-        info_file = os.path.join(
-            trash_info, os.path.basename(fl) + '.trashinfo'
+
+def register_reap_dirs(reap_dirs):
+    """Add reap_dirs to REAP_LIST, so an interrupted reap can be resumed."""
+    try:
+        with open(REAP_LIST) as fin:
+            known = set(fin.read().splitlines())
+    except (IOError, OSError):
+        known = set()
+    new = [i for i in reap_dirs if i not in known and '\n' not in i]
+    if not new:
+        return
+    try:
+        if not os.path.isdir(os.path.dirname(REAP_LIST)):
+            os.makedirs(os.path.dirname(REAP_LIST))
+        with open(REAP_LIST, 'a') as fout:
+            fout.write(''.join(i + '\n' for i in new))
+    except (IOError, OSError):
+        pass
+
+
+def start_reaper(reap_dirs):
+    """Empty reap_dirs in a detached process, in the foreground if no fork."""
+    def reap_all():
+        try:
+            os.nice(REAP_NICE)
+        except (AttributeError, OSError):
+            pass
+        for reap_dir in reap_dirs:
+            reap(reap_dir)
+    run_detached(reap_all)
+
+
+def run_detached(func):
+    """Call func in a detached process, in the foreground if no fork.
+
+    The process is not our child and has no terminal, its output is
+    discarded.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        pid = os.fork()
+    except (AttributeError, OSError):
+        func()
+        return
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        # Double fork, so func's process is not our child
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        null = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(null, fd)
+        func()
+    finally:
+        os._exit(0)
+
+
+def reap(reap_dir):
+    """Delete everything in reap_dir, then reap_dir itself.
+
+    Holds a lock on reap_dir while deleting, returns at once if another
+    reaper has it. Gives up, leaving the rest for later, if nothing more can
+    be deleted.
+    """
+    import fcntl
+    fd = open_reap_dir(reap_dir)
+    if fd is None:
+        return
+    # Everything is deleted relative to fd, which is checked, where possible
+    listdir = os.listdir if os.listdir not in getattr(
+        os, 'supports_fd', ()) else lambda _: os.listdir(fd)
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return
+            names = listdir(reap_dir)
+            while names:
+                reap_names(reap_dir, fd, names)
+                left = listdir(reap_dir)
+                if set(left) >= set(names):
+                    return
+                names = left
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            # Anything staged as we unlocked would wait for the next rm
+            if not listdir(reap_dir):
+                break
+        try:
+            os.rmdir(reap_dir)
+        except OSError:
+            pass
+    finally:
+        os.close(fd)
+
+
+def reap_names(reap_dir, fd, names):
+    """Delete names in reap_dir, relative to its descriptor fd if we can."""
+    if not HAS_FWALK:
+        delete_files(
+            [os.path.join(reap_dir, i) for i in names], force=True,
+            recursive=True, workers=REAP_WORKERS
         )
-        with open(info_file, 'w') as trash_info:
-            trash_info.write(
-                TRASHINFO.format(path=fl, date=now.strftime(TIMEFMT))
-            )
-    return err
+        return
+    deleter = Deleter(force=True, recursive=True)
 
+    def remove(name):
+        pth = os.path.join(reap_dir, name)
+        try:
+            st = os.lstat(name, dir_fd=fd)
+        except OSError:
+            return
+        if stat.S_ISDIR(st.st_mode):
+            deleter.remove_tree(pth, name, fd)
+        else:
+            deleter.unlink(pth, name, fd)
+
+    pool = get_thread_pool(REAP_WORKERS)
+    with pool:
+        list(pool.map(remove, names))
+
+
+def resume_reaps():
+    """Restart reaping any staging directories an earlier reaper left."""
+    try:
+        with open(REAP_LIST) as fin:
+            reap_dirs = fin.read().splitlines()
+    except (IOError, OSError):
+        return
+    live = []
+    for reap_dir in reap_dirs:
+        try:
+            if is_reap_dir(os.lstat(reap_dir)):
+                live.append(reap_dir)
+        except OSError:
+            pass
+    if len(live) != len(reap_dirs):
+        try:
+            if live:
+                tmp = '{0}.{1}.tmp'.format(REAP_LIST, os.getpid())
+                with open(tmp, 'w') as fout:
+                    fout.write(''.join(i + '\n' for i in live))
+                os.rename(tmp, REAP_LIST)
+            else:
+                os.unlink(REAP_LIST)
+        except OSError:
+            pass
+    pending = [i for i in live if os.listdir(i) and not reap_locked(i)]
+    if pending:
+        start_reaper(pending)
+
+
+def reap_locked(reap_dir):
+    """Return True if a reaper is working on reap_dir."""
+    import fcntl
+    fd = open_reap_dir(reap_dir)
+    if fd is None:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except (IOError, OSError):
+        return True
+    finally:
+        os.close(fd)
+
+
+###############################################################################
+#                       Streaming Removal for -0 Mode                         #
+###############################################################################
 
-def recycle_darwin(fl, verbose=False):
-    """Move fl (file or dir) to trash on MacOS using applescript.
+
+def stream_files(batches, rec_args, shred_args, recursive=False, dirs=False,
+                 force=False, interactive=False, verbose=False, dryrun=False,
+                 recycle=False, recycle_hm=False, shred=False,
+                 shred_external=False, dedup=False):
+    """Classify and remove paths one batch at a time, for -0 mode.
+
+    As in main, -f does not skip confirmation: the user is asked once, after
+    the first batch is read, to confirm all paths, unless that batch is all
+    there is and main would not ask about it either (fewer than CUTOFF
+    files, no directories or other files). Only one batch is held in memory
+    at a time, two while finding out if the first is the only one. The
+    Policy in force is applied to each batch before any of it is removed,
+    its limits to the running totals, so the first batch over a limit stops
+    the stream.
+
+    Params
+    ------
+    batches : iterable of list of str
+        e.g. from read_paths
+    rec_args, shred_args : list of str
+        Flags for recycle_file and shred
+    All other arguments are the options of the same name in main
 
     Returns
     -------
     exit_code : int
-        0 on success, something else on failure
     """
-    cmnd = (
-        '{0} -e '
-        '"tell application \\"Finder\\" to delete POSIX file \\"{1}\\"" '
-        '>/dev/null 2>/dev/null'
-    ).format(OSA, os.path.abspath(fl))
-    if verbose:
-        sys.stderr.write(cmnd + '\n')
-    return call(cmnd, shell=True)
+    confirmed = False
+    code = 0
+    count = 0
+    policy = _POLICY.get('current')
+    nfiles = 0
+    nbytes = 0
+    # Whether the first batch is all there is, only a short batch may be
+    batches = iter(batches)
+    head = [i for i in [next(batches, None)] if i is not None]
+    if head and len(head[0]) < STREAM_BATCH:
+        head += [i for i in [next(batches, None)] if i is not None]
+    single = len(head) == 1 and len(head[0]) < STREAM_BATCH
+    for batch in chain(head, batches):
+        drs, fls, oth, bad, infos = classify_files(batch)
+        count += len(batch)
+        if not force:
+            for fl in bad:
+                sys.stderr.write('cannot remove {0}: {1}\n'.format(
+                    quote(fl), os.strerror(errno.ENOENT)
+                ))
+                code = 1
+        if drs and not recursive and not dirs:
+            for dr in drs:
+                sys.stderr.write('cannot remove {0}: {1}\n'.format(
+                    quote(dr), os.strerror(errno.EISDIR)
+                ))
+            drs = []
+            code = 1
+        actions = {}
+        if policy is not None:
+            actions = dict((i, policy.action(
+                infos[i].abspath, stat.S_ISDIR(infos[i].st_mode)
+            )) for i in drs + fls + oth)
+            refused = [i for i in drs + fls + oth if actions[i] == 'refuse']
+            if refused:
+                sys.stderr.write('Policy refuses to remove:\n{0}\n'.format(
+                    format_list(refused)
+                ))
+                drs = [i for i in drs if actions[i] != 'refuse']
+                fls = [i for i in fls if actions[i] != 'refuse']
+                oth = [i for i in oth if actions[i] != 'refuse']
+                code = 1
+            if policy.max_files is not None or policy.max_bytes is not None:
+                nfiles += len(fls) + len(oth)
+                nbytes += sum(infos[i].st_size for i in fls)
+                if drs:
+                    # Stops once over max-files, however many dirs
+                    summary = summarize_dirs(
+                        drs, budget=float('inf'), max_entries=float('inf'),
+                        max_files=policy.max_files
+                    )
+                    nfiles += summary.files
+                    nbytes += summary.nbytes
+                reason = policy.over_limit(nfiles, nbytes)
+                if reason:
+                    sys.stderr.write(
+                        'Policy refuses to remove {0}\n'.format(reason)
+                    )
+                    return 15
+        if not confirmed and single and not drs and not oth and \
+                len(fls) < CUTOFF:
+            confirmed = True
+        if not confirmed:
+            sys.stderr.write(
+                'Read {0} paths from STDIN so far: {1} dirs{2}, {3} '
+                'files/links, and {4} other{5}\n'.format(
+                    count, len(drs), ' (recursively)' if recursive else '',
+                    len(fls), len(oth), '' if single else ', more may follow'
+                )
+            )
+            if not yesno('Delete these and all further paths?', False,
+                         key='confirm'):
+                return 1
+            confirmed = True
 
+        if shred:
+            failed = set(shred_paths(
+                drs, fls, shred_args, verbose, dryrun, shred_external
+            ))
+            if failed:
+                sys.stderr.write(
+                    'shred FAILED, not deleting:\n{0}\n'
+                    .format(format_list(sorted(failed)))
+                )
+                code = 13
+                drs = [i for i in drs if not any(
+                    j == i or j.startswith(i + os.sep) for j in failed
+                )]
+                fls = [i for i in fls if i not in failed]
 
-def shred_files(sfls, shred_args, verbose=False, dryrun=False):
-    """Call shred on sfls."""
-    cmd = '{0} {1} -- {2}'.format(
-        SHRED, ' '.join(shred_args),
-        ' '.join([quote(i) for i in sfls])
+        to_delete = drs + fls
+        to_recycle = []
+        if recycle:
+            to_recycle = to_delete
+            to_delete = []
+        elif recycle_hm:
+            in_home = [infos[i].abspath.startswith(HOME) for i in to_delete]
+            to_recycle = [i for i, h in zip(to_delete, in_home) if h]
+            to_delete = [i for i, h in zip(to_delete, in_home) if not h]
+        if actions and not shred:
+            everything = to_recycle + to_delete
+            recycling = set(to_recycle)
+            to_recycle = [
+                i for i in everything if actions[i] == 'recycle' or (
+                    actions[i] != 'delete' and i in recycling
+                )
+            ]
+            recycling = set(to_recycle)
+            to_delete = [i for i in everything if i not in recycling]
+        if to_recycle:
+            if not os.path.isdir(RECYCLE_BIN):
+                os.makedirs(RECYCLE_BIN)
+            to_delete += recycle_files(
+                to_recycle, mv_flags=rec_args, try_apple=False,
+                verbose=verbose, dryrun=dryrun,
+                infos=dict((infos[i].abspath, infos[i]) for i in to_recycle),
+                dedup=dedup
+            )
+        to_delete += oth
+        if not to_delete:
+            continue
+        if dryrun:
+            sys.stdout.write(
+                'Removing: {0}\n'.format(' '.join(quote(i) for i in to_delete))
+            )
+        elif delete_files(
+                to_delete, force=force, interactive=interactive,
+                verbose=verbose, recursive=recursive, dirs=dirs, infos=infos):
+            code = 1
+    if not count:
+        sys.stderr.write('No files or folders to delete\n')
+        return 22
+    return code
+
+
+###############################################################################
+#                     Daemon, Skips Startup for Every rm                      #
+###############################################################################
+
+
+def daemon_socket():
+    """Return the path of the per-user daemon socket.
+
+    In $XDG_RUNTIME_DIR if set (private to the user already), otherwise in a
+    0700 directory in /tmp.
+    """
+    run_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not run_dir or not os.path.isdir(run_dir):
+        run_dir = '/tmp/careful_rm-{0}'.format(UID)
+    return os.path.join(run_dir, DAEMON_NAME)
+
+
+def _send_request(sock, argv, fds=None):
+    """Send cwd, argv and the environment, plus fds if given, over sock.
+
+    The request is NUL terminated fields: the cwd, the number of args, the
+    args, the environment as KEY=VALUE, then an empty field. Simple enough
+    for the zsh plugin to write without python. Our umask is sent in the
+    environment, as CAREFUL_RM_UMASK (octal).
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    fields = [os.getcwd(), str(len(argv))] + list(argv) + [
+        '{0}={1}'.format(k, v) for k, v in os.environ.items()
+        if k != 'CAREFUL_RM_UMASK'
+    ] + ['CAREFUL_RM_UMASK={0:o}'.format(umask), '', '']
+    data = '\0'.join(fields).encode('utf-8', 'surrogateescape')
+    if fds:
+        import socket
+        import array
+        sent = sock.sendmsg([data[:1]], [(
+            socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds)
+        )])
+        data = data[sent:]
+    sock.sendall(data)
+
+
+def _parse_request(data):
+    """Return (cwd, argv, env) from a request, or None if it is incomplete."""
+    # Only fields followed by a NUL are complete
+    fields = data.decode('utf-8', 'surrogateescape').split('\0')[:-1]
+    if len(fields) < 2:
+        return None
+    start = 2 + int(fields[1])
+    if '' not in fields[start:]:
+        return None
+    end = fields.index('', start)
+    env = dict(i.split('=', 1) for i in fields[start:end] if '=' in i)
+    return fields[0], fields[2:start], env
+
+
+def _recv_request(conn):
+    """Read a request from conn, returns (cwd, argv, env, fds)."""
+    import socket
+    import array
+    fds = array.array('i')
+    data, anc, _, _ = conn.recvmsg(
+        65536, socket.CMSG_LEN(4 * fds.itemsize)
     )
-    if dryrun or verbose:
-        sys.stderr.write('Running: {0}\n'.format(cmd))
-    if not dryrun:
-        return call(sh.split(cmd))
+    for level, kind, fd_data in anc:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(fd_data[:len(fd_data) - len(fd_data) % fds.itemsize])
+    request = _parse_request(data)
+    while request is None:
+        more = conn.recv(65536)
+        if not more:
+            raise IOError(errno.EPIPE, 'Incomplete request')
+        data += more
+        request = _parse_request(data)
+    return request + (list(fds),)
+
+
+def run_client(argv):
+    """Run argv in the daemon if it is running, returns exit code or None.
+
+    Passes the daemon STDIN, STDOUT, STDERR and the terminal, so prompts and
+    output work exactly as when run in-process. Ctrl-C is forwarded. Returns
+    None, to run in-process, whenever the daemon cannot be reached.
+    """
+    path = daemon_socket()
+    if not os.path.exists(path) or not hasattr(os, 'fork') or \
+            os.stat(os.path.dirname(path)).st_uid != UID:
+        return None
+    import socket
+    if not hasattr(socket, 'AF_UNIX') or \
+            not hasattr(socket.socket, 'sendmsg'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    fds = [0, 1, 2]
+    try:
+        fds.append(os.open('/dev/tty', os.O_RDWR | os.O_NOCTTY))
+    except OSError:
+        pass
+    try:
+        sock.connect(path)
+        _send_request(sock, argv, fds)
+        reply = sock.makefile('rb')
+        pid = reply.readline()
+        if not pid:
+            return None
+        pid = int(pid)
+
+        def forward(sig, frame):
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, forward)
+        code = reply.readline()
+        return int(code) if code else 1
+    except (OSError, IOError, ValueError):
+        return None
+    finally:
+        sock.close()
+        for fd in fds[3:]:
+            os.close(fd)
+
+
+def run_request(conn):
+    """Run one client request, in a forked child, then exit.
+
+    With the client's fds, they replace STDIN, STDOUT and STDERR, and the
+    exit code is sent back. Without (the zsh plugin), output is sent back on
+    the socket and there is no STDIN. The client's environment and umask
+    are used, but if the client's DAEMON_ENV differs from ours the request
+    is closed unanswered, so the client runs it in-process with its own
+    paths.
+    """
+    code = 1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, catch_keyboard)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        cwd, argv, env, fds = _recv_request(conn)
+        umask = env.pop('CAREFUL_RM_UMASK', None)
+        if env and any(env.get(i) != os.environ.get(i) for i in DAEMON_ENV):
+            code = 0
+            return
+        if umask:
+            os.umask(int(umask, 8))
+        if fds:
+            for target, fd in enumerate(fds[:3]):
+                os.dup2(fd, target)
+            if len(fds) > 3:
+                _STDIN['tty'] = '/dev/fd/{0}'.format(fds[3])
+            conn.sendall('{0}\n'.format(os.getpid()).encode())
+        else:
+            null = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(null, 0)
+            os.dup2(conn.fileno(), 1)
+            os.dup2(conn.fileno(), 2)
+        sys.stdout = os.fdopen(os.dup(1), 'w', 1)
+        sys.stderr = os.fdopen(os.dup(2), 'w', 1)
+        if env:
+            os.environ.clear()
+            os.environ.update(env)
+        os.chdir(cwd)
+        global HAS_HOME
+        HAS_HOME = os.path.isdir(HOME_TRASH)
+        _DAEMON['child'] = True
+        try:
+            code = main(argv)
+        except SystemExit as err:
+            code = err.code if isinstance(err.code, int) else 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if fds:
+            conn.sendall('{0}\n'.format(code or 0).encode())
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        os._exit(code or 0)
+
+
+def run_daemon():
+    """Serve rm requests on daemon_socket() until stopped.
+
+    Forks a child for every request, the child inherits the warm mount table
+    and tool paths. The mount table is re-read whenever the mounts change,
+    and the daemon exits if this script is changed, or on SIGTERM (see
+    --stop-daemon in main).
+
+    Returns
+    -------
+    int : exit code
+    """
+    import socket
+    import select
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(os, 'fork') or \
+            not hasattr(socket.socket, 'recvmsg'):
+        sys.stderr.write('The daemon is not supported on this system\n')
+        return 1
+    path = daemon_socket()
+    run_dir = os.path.dirname(path)
+    if not os.path.isdir(run_dir):
+        os.makedirs(run_dir, 0o700)
+    if os.stat(run_dir).st_uid != UID:
+        sys.stderr.write('{0} belongs to another user\n'.format(run_dir))
+        return 1
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            sys.stderr.write('Daemon already running on {0}\n'.format(path))
+            return 0
+        except (OSError, IOError):
+            os.unlink(path)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_mask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_mask)
+    server.listen(64)
+    sys.stderr.write('Daemon listening on {0}\n'.format(path))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+
+    script = os.path.abspath(__file__)
+    script_mtime = os.stat(script).st_mtime
+    poller = select.poll()
+    poller.register(server.fileno(), select.POLLIN)
+    mounts = None
+    if os.path.exists('/proc/self/mountinfo'):
+        # The kernel flags mountinfo with POLLPRI when the mounts change
+        mounts = open('/proc/self/mountinfo')
+        poller.register(mounts.fileno(), select.POLLPRI | select.POLLERR)
+    get_mount_table()
+    try:
+        while True:
+            events = dict(poller.poll())
+            if mounts is not None and mounts.fileno() in events:
+                mounts.seek(0)
+                mounts.read()
+                _MOUNTS.clear()
+                get_mount_table()
+            if server.fileno() not in events:
+                continue
+            try:
+                conn, _ = server.accept()
+            except (OSError, IOError):
+                continue
+            if hasattr(socket, 'SO_PEERCRED'):
+                import struct
+                creds = conn.getsockopt(
+                    socket.SOL_SOCKET, socket.SO_PEERCRED,
+                    struct.calcsize('3i')
+                )
+                if struct.unpack('3i', creds)[1] != UID:
+                    conn.close()
+                    continue
+            if os.stat(script).st_mtime != script_mtime:
+                # Stale code, let the client run in-process
+                conn.close()
+                break
+            if os.fork() == 0:
+                server.close()
+                run_request(conn)
+            conn.close()
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
     return 0
 
 
+###############################################################################
+#                               Deletion Policy                               #
+###############################################################################
+
+
+class Policy(object):
+    """Rules that decide what happens to each path, and answer prompts.
+
+    Read from a file of one rule per line, # starts a comment::
+
+        recycle ~/            # recycle anything under HOME
+        delete /scratch       # delete without recycling under /scratch
+        refuse /data/*.db     # never remove these
+        max-files 100000      # refuse the whole run if more files than this
+        max-bytes 50G         # or more bytes than this
+        confirm yes           # answer yes to "Delete?" prompts (or no)
+        dirs add              # directories without -r: add, ignore, cancel
+        missing-trash create  # skip, create, root, or del
+        recycle-failed yes    # delete files that could not be recycled
+        shred-failed no       # delete files that could not be shredded
+
+    Patterns are globs of the absolute path (~ and $VARS are expanded), and
+    also match everything below a matching directory. The first path rule
+    that matches wins, paths with no matching rule follow the usual flags.
+    A directory that a refuse rule could match something below is refused
+    whole, so recursive removal never takes refused paths with it.
+
+    Attributes
+    ----------
+    rules : list of tuple
+        (action, pattern), action is recycle, delete, or refuse
+    answers : dict
+        Prompt key->answer, see get_ans
+    max_files : int
+    max_bytes : int
+    """
+
+    ACTIONS = ['recycle', 'delete', 'refuse']
+    ANSWERS = {
+        'confirm': ['yes', 'no'], 'dirs': ['add', 'ignore', 'cancel'],
+        'missing-trash': ['skip', 'create', 'root', 'del'],
+        'recycle-failed': ['yes', 'no'], 'shred-failed': ['yes', 'no'],
+    }
+
+    def __init__(self, path=None):
+        """Load the policy in path, if given, raises ValueError if invalid."""
+        self.path = path
+        self.rules = []
+        self.answers = {}
+        self.max_files = None
+        self.max_bytes = None
+        if path:
+            with open(path) as fin:
+                for num, line in enumerate(fin, 1):
+                    try:
+                        self.add_rule(line.split('#', 1)[0].split())
+                    except ValueError as err:
+                        raise ValueError('{0}:{1}: {2}'.format(path, num, err))
+
+    def add_rule(self, words):
+        """Add the rule in the words of one line of a policy file."""
+        if not words:
+            return
+        if len(words) != 2:
+            raise ValueError('expected "<rule> <value>"')
+        rule, val = words
+        if rule in self.ACTIONS:
+            pattern = os.path.expandvars(os.path.expanduser(val))
+            self.rules.append((rule, os.path.normpath(pattern)))
+        elif rule == 'max-files':
+            self.max_files = int(val)
+        elif rule == 'max-bytes':
+            self.max_bytes = parse_size(val)
+        elif rule in self.ANSWERS:
+            if val not in self.ANSWERS[rule]:
+                raise ValueError('{0} must be one of {1}'.format(
+                    rule, ', '.join(self.ANSWERS[rule])
+                ))
+            # yesno takes y and n
+            self.answers[rule] = val[0] if val in ('yes', 'no') else val
+        else:
+            raise ValueError('unknown rule {0}'.format(rule))
+
+    def action(self, path, is_dir=False):
+        """Return the action of the first rule matching path, or None.
+
+        A directory is refused if a refuse rule could match anything below
+        it, before any rule that matches the directory itself, as removing
+        it would remove those paths too.
+        """
+        for action, pattern in self.rules:
+            if fnmatch(path, pattern) or \
+                    fnmatch(path, pattern.rstrip('/') + '/*'):
+                return action
+            if is_dir and action == 'refuse' and \
+                    self.matches_below(path, pattern):
+                return action
+        return None
+
+    @staticmethod
+    def matches_below(path, pattern):
+        """Return True if pattern could match a path below the path directory.
+
+        Compares a component at a time, a * can match across /, so anything
+        from a component with a * on could match.
+        """
+        parts = [i for i in path.split(os.sep) if i]
+        for num, part in enumerate(i for i in pattern.split(os.sep) if i):
+            if '*' in part:
+                return True
+            if num >= len(parts):
+                return True
+            if not fnmatch(parts[num], part):
+                return False
+        return False
+
+    def over_limit(self, files, nbytes):
+        """Return why files and nbytes are over the limits, or None."""
+        if self.max_files is not None and files > self.max_files:
+            return '{0} files, more than max-files {1}'.format(
+                format_count(files), self.max_files
+            )
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return '{0}, more than max-bytes {1}'.format(
+                format_size(nbytes), format_size(self.max_bytes)
+            )
+        return None
+
+
+def load_policy(path=None):
+    """Return the Policy in path, $CAREFUL_RM_POLICY, or POLICY_FILE.
+
+    Returns None if no path is given and neither exists.
+    """
+    if path is None:
+        path = os.environ.get('CAREFUL_RM_POLICY') or POLICY_FILE
+        if not os.path.isfile(path):
+            return None
+    return Policy(path)
+
+
+###############################################################################
+#                              Operation Journal                              #
+###############################################################################
+
+
+class Journal(object):
+    """Wall time, item counts, bytes, and failures for each phase of a run.
+
+    Phases are recorded in the order they first happen, using the same name
+    again adds to it. Phases can overlap, e.g. glob is part of parse, and the
+    time spent at a prompt is also counted in the phase that asked.
+
+    Attributes
+    ----------
+    path : str
+        Where to append the journal, None to not write it
+    stats : bool
+        Print the phases to STDERR when done
+    """
+
+    def __init__(self, argv):
+        """Start timing the run of argv."""
+        self.argv = list(argv)
+        self.start = time.time()
+        self.phases = []
+        self._phases = {}
+        self.stats = False
+        self.mountpoints = []
+        self.path = os.environ.get('CAREFUL_RM_JOURNAL') or (
+            JOURNAL_PATH if os.path.isfile(os.path.join(HOME, '.rm_journal'))
+            else None
+        )
+
+    def add(self, name, seconds=0.0, items=None, nbytes=None, failed=None):
+        """Add time and counts to the phase name."""
+        if name not in self._phases:
+            self._phases[name] = {'phase': name, 'time': 0.0}
+            self.phases.append(self._phases[name])
+        phase = self._phases[name]
+        phase['time'] += seconds
+        for key, val in [('items', items), ('bytes', nbytes),
+                         ('failed', failed)]:
+            if val is not None:
+                phase[key] = phase.get(key, 0) + val
+
+    def phase(self, name):
+        """Return a context manager that adds the time it takes to name."""
+        return _Timer(self, name)
+
+    def mounts(self, infos):
+        """Record the mountpoints of the FileInfos in infos."""
+        devs = {}
+        for info in infos:
+            if info.st_dev not in devs:
+                devs[info.st_dev] = get_mount(info.abspath, info)
+        self.mountpoints = sorted(devs.values())
+
+    def finish(self, code):
+        """Write the journal and print stats, if anything was done."""
+        if not self.phases:
+            return
+        total = time.time() - self.start
+        if self.stats:
+            sys.stderr.write('\nTook {0:.3f}s, exit code {1}\n'.format(
+                total, code
+            ))
+            for phase in self.phases:
+                counts = []
+                if 'items' in phase:
+                    counts.append('{0} items'.format(phase['items']))
+                if 'bytes' in phase:
+                    counts.append(format_size(phase['bytes']))
+                if phase.get('failed'):
+                    counts.append('{0} failed'.format(phase['failed']))
+                sys.stderr.write('    {0:<10} {1:>8.3f}s  {2}\n'.format(
+                    phase['phase'], phase['time'], ', '.join(counts)
+                ))
+        if not self.path:
+            return
+        record = {
+            'date': dt.fromtimestamp(self.start).strftime(TIMEFMT),
+            'pid': os.getpid(), 'cwd': os.getcwd(), 'argv': self.argv,
+            'exit': code, 'time': round(total, 6),
+            'mounts': self.mountpoints,
+            'phases': [
+                dict(p, time=round(p['time'], 6)) for p in self.phases
+            ],
+        }
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path, 'a') as fout:
+                fout.write(json.dumps(record, sort_keys=True) + '\n')
+        except (IOError, OSError) as err:
+            sys.stderr.write('Could not write journal {0}: {1}\n'.format(
+                self.path, getattr(err, 'strerror', None) or err
+            ))
+
+
+class _Timer(object):
+    """Times a with block into a Journal phase, see Journal.phase."""
+
+    def __init__(self, journal, name):
+        self.journal = journal
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if self.journal is not None:
+            self.journal.add(self.name, time.time() - self.start)
+        return False
+
+
+def journal_phase(name):
+    """Time a with block into the current run's journal, if there is one."""
+    return _Timer(_JOURNAL.get('current'), name)
+
+
 ###############################################################################
 #                         Core Function—Run As Script                         #
 ###############################################################################
 
 
+def purge_main(args):
+    """Parse the arguments for --purge and run purge_trash."""
+    kwargs = {}
+    args = iter(args)
+    for arg in args:
+        opt, _, val = arg.partition('=')
+        try:
+            if opt in ('--older-than', '--max-size'):
+                val = val if val else next(args)
+                if opt == '--older-than':
+                    kwargs['older_than'] = parse_duration(val)
+                else:
+                    kwargs['max_size'] = parse_size(val)
+        except (ValueError, StopIteration):
+            sys.stderr.write('Invalid value for {0}\n'.format(opt))
+            return 99
+        if arg in ('-f', '--force'):
+            kwargs['force'] = True
+        elif arg in ('-v', '--verbose'):
+            kwargs['verbose'] = True
+        elif arg == '--dryrun':
+            kwargs['dryrun'] = True
+    if 'older_than' not in kwargs and 'max_size' not in kwargs:
+        sys.stderr.write('--purge requires --older-than or --max-size\n')
+        return 99
+    return purge_trash(**kwargs)
+
+
+def compress_main(args):
+    """Parse the arguments for --compress-trash and run compress_trashes."""
+    kwargs = {}
+    args = iter(args)
+    for arg in args:
+        opt, _, val = arg.partition('=')
+        if opt == '--older-than':
+            try:
+                val = val if val else next(args)
+                kwargs['older_than'] = parse_duration(val)
+            except (ValueError, StopIteration):
+                sys.stderr.write('Invalid value for {0}\n'.format(opt))
+                return 99
+        elif arg in ('-v', '--verbose'):
+            kwargs['verbose'] = True
+        elif arg == '--dryrun':
+            kwargs['dryrun'] = True
+    return compress_trashes(**kwargs)
+
+
+
 def main(argv=None):
     """The careful rm function."""
     if not argv:
@@ -590,16 +4828,51 @@ def main(argv=None):
             'Arguments required\n\n' + DOCSTR
         )
         return 99
-    file_sep = '--'  # Used to separate files from args, change to '' if needed
-    flags = []
+    # The daemon only gets our STDIN, STDOUT, STDERR, and terminal
+    if not _DAEMON['child'] and not _DAEMON['asked'] and \
+            '--daemon' not in argv and \
+            not os.environ.get('CAREFUL_RM_NO_DAEMON') and \
+            not any(i.startswith('--progress-fd=') for i in argv):
+        code = run_client(argv)
+        if code is not None:
+            return code
+    journal = Journal(argv)
+    _JOURNAL['current'] = journal
+    code = 1
+    try:
+        code = run_rm(argv, journal)
+    finally:
+        journal.finish(code)
+    return code
+
+
+def run_rm(argv, journal):
+    """Parse argv and remove (or recycle, or shred) the files, see main."""
     rec_args = []
     shred_args = ['-z']
-    all_files = []
+    patterns = []
     shred      = False  # Shred (destroy) files prior to deletion
+    shred_external = False  # Use the shred executable, not Shredder
     dryrun     = False  # Don't do anything, just print commands
     verbose    = False  # Print extra info
     recursive  = False  # Delete stuff in directories
+    dirs       = False  # Delete empty directories without -r
+    force      = False  # Never prompt, ignore missing files
+    interactive = False  # Prompt before every removal
+    null_sep   = False  # STDIN paths are NUL separated, streamed, not globbed
+    from_stdin = False  # Read paths from STDIN after parsing arguments
     no_recycle = False  # Force off recycling
+    background = False  # Copy to trashes on other devices in the background
+    fast       = False  # Stage for a background reaper instead of deleting
+    dedup      = os.path.isfile(os.path.join(HOME, '.rm_dedup'))
+    compress   = os.path.isfile(os.path.join(HOME, '.rm_compress'))
+    ops_rate   = None   # Most unlinks, renames etc per second
+    bytes_rate = None   # Most bytes copied or shredded per second
+    io_class   = None   # ionice style I/O scheduling class
+    show_progress = None  # Status line, by default if STDERR is a terminal
+    progress_fd = None  # File descriptor to stream progress to
+    policy_file = None  # Policy to use instead of the default
+    use_policy = True   # Use a policy if there is one
     recycle    = os.path.isfile(os.path.join(HOME, '.rm_recycle'))
     recycle_hm = os.path.isfile(os.path.join(HOME, '.rm_recycle_home'))
     for arg in argv[1:]:
@@ -610,8 +4883,66 @@ def main(argv=None):
             recycle = True
         elif arg == '--direct':
             no_recycle = True
+        elif arg == '--background-copy':
+            background = True
+        elif arg == '--fast':
+            fast = True
+        elif arg == '--dedup':
+            dedup = True
+        elif arg == '--compress':
+            compress = True
+        elif arg == '--stats':
+            journal.stats = True
+        elif arg == '--progress':
+            show_progress = True
+        elif arg == '--no-progress':
+            show_progress = False
+        elif arg.startswith('--progress-fd='):
+            progress_fd = arg.split('=', 1)[1]
+            if not progress_fd.isdigit():
+                sys.stderr.write('Invalid value for --progress-fd: {0}\n'
+                                 .format(progress_fd))
+                return 99
+            progress_fd = int(progress_fd)
+        elif arg.startswith('--policy='):
+            policy_file = arg.split('=', 1)[1]
+        elif arg == '--no-policy':
+            use_policy = False
+        elif arg == '--journal':
+            journal.path = journal.path or JOURNAL_PATH
+        elif arg.startswith('--journal='):
+            journal.path = arg.split('=', 1)[1]
+        elif arg.startswith(('--max-ops-per-sec=', '--max-bytes-per-sec=',
+                             '--io-class=')):
+            opt, val = arg.split('=', 1)
+            try:
+                if opt == '--max-ops-per-sec':
+                    ops_rate = float(val)
+                elif opt == '--max-bytes-per-sec':
+                    bytes_rate = parse_size(val)
+                elif val in IO_CLASSES:
+                    io_class = val
+                else:
+                    raise ValueError(val)
+            except ValueError:
+                sys.stderr.write('Invalid value for {0}: {1}\n'.format(
+                    opt, val
+                ))
+                return 99
         elif arg == '-s' or arg == '--shred':
             shred = True
+        elif arg == '--shred-external':
+            shred = True
+            shred_external = True
+        elif arg.startswith('--shred-passes='):
+            passes = arg.split('=', 1)[1]
+            if not passes.isdigit():
+                sys.stderr.write('Invalid number of passes {0}\n'.format(
+                    passes
+                ))
+                return 1
+            shred = True
+            shred_args += ['-n', passes]
         elif arg == '--dryrun':
             dryrun = True
             sys.stderr.write('Dry Run. Not actually removing files.\n\n')
@@ -619,44 +4950,119 @@ def main(argv=None):
             # Print trash for next arg and immediately exit
             tindex = argv.index(arg)+1
             tpath = argv[tindex] if len(argv) > tindex else os.curdir
-            sys.stdout.write(get_trash(tpath))
+            sys.stdout.write(get_trash_cached(tpath))
             return 0
+        elif arg == '--get-trash-many':
+            # Print the trash for every following arg (or line of STDIN)
+            tpaths = argv[argv.index(arg)+1:]
+            if not tpaths:
+                tpaths = sys.stdin.read().splitlines()
+            for tpath in tpaths:
+                sys.stdout.write(get_trash_cached(tpath) + '\n')
+            return 0
+        elif arg == '--daemon':
+            return run_daemon()
+        elif arg == '--stop-daemon':
+            # Only reached in-process if the daemon is not running
+            if _DAEMON['child']:
+                os.kill(os.getppid(), signal.SIGTERM)
+                return 0
+            sys.stderr.write('Daemon is not running\n')
+            return 1
+        elif arg == '--list-trash':
+            # List trashed files matching the next arg and immediately exit
+            tindex = argv.index(arg)+1
+            pattern = argv[tindex] if len(argv) > tindex else None
+            return list_trash(pattern)
+        elif arg == '--trash-usage':
+            return trash_usage()
+        elif arg == '--purge':
+            # Purge by the options anywhere in argv and immediately exit
+            return purge_main(argv[1:])
+        elif arg == '--compress-trash':
+            # Compress by the options anywhere in argv and immediately exit
+            return compress_main(argv[1:])
+        elif arg == '--restore':
+            # Restore trashed files matching the next arg and exit
+            tindex = argv.index(arg)+1
+            if len(argv) <= tindex:
+                sys.stderr.write('--restore requires a pattern\n')
+                return 99
+            return restore_files(argv[tindex], verbose=verbose, dryrun=dryrun)
         elif arg == '--':
             # Everything after this is a file
-            file_sep = '--'
-            all_files += [
-                i for l in [glob(n) for n in argv[argv.index(arg):]] \
-                for i in l
-            ]
+            patterns += argv[argv.index(arg)+1:]
             break
+        elif arg == '--from0':
+            null_sep = True
+        elif arg == '--stdin0':
+            null_sep = True
+            from_stdin = True
         elif arg == '-':
-            # Read files in from STDIN
-            all_files += [
-                i for l in \
-                [glob(n) for n in sys.stdin.read().strip().split()] \
-                for i in l
-            ]
-        elif arg.startswith('-'):
-            if 'r' in arg or 'R' in arg:
+            # Read files in from STDIN once all arguments are parsed
+            from_stdin = True
+        elif arg.startswith('--'):
+            # Long rm options, the last of --force/--interactive wins
+            if arg == '--force':
+                force = True
+                interactive = False
+            elif arg == '--interactive' or arg == '--interactive=always':
+                interactive = True
+                force = False
+            elif arg == '--interactive=once':
+                # As -I, which careful_rm's prompts already are
+                interactive = False
+                force = False
+            elif arg == '--recursive':
                 recursive = True
-            if 'c' in arg:
-                arg = arg.replace('c', '')
-                recycle = True
-            if 's' in arg:
-                arg = arg.replace('s', '')
-                shred = True
-            if 'f' in arg:
-                rec_args.append('-f')
-                shred_args.append('-f')
-            if 'i' in arg:
-                rec_args.append('-i')
-            if 'v' in arg:
+            elif arg == '--dir':
+                dirs = True
+            elif arg == '--verbose':
                 verbose = True
-                rec_args.append('-v')
-                shred_args.append('-v')
-            flags.append(quote(arg))
+            elif not arg.startswith(('--interactive=', '--one-file-system',
+                                     '--preserve-root', '--no-preserve-root')):
+                sys.stderr.write('Ignoring unknown option {0}\n'.format(arg))
+        elif arg.startswith('-'):
+            # Short rm options, may be combined, e.g. -rfv
+            for char in arg[1:]:
+                if char in 'rR':
+                    recursive = True
+                elif char == 'c':
+                    recycle = True
+                elif char == 's':
+                    shred = True
+                elif char == 'f':
+                    force = True
+                    interactive = False
+                elif char == 'i':
+                    interactive = True
+                    force = False
+                elif char == 'I':
+                    # Only undoes -i and -f, careful_rm already asks once
+                    interactive = False
+                    force = False
+                elif char == 'd':
+                    dirs = True
+                elif char == 'v':
+                    verbose = True
+                elif char == '0':
+                    null_sep = True
         else:
-            all_files += glob(arg)
+            patterns.append(arg)
+    if force:
+        rec_args.append('-f')
+        shred_args.append('-f')
+    if interactive:
+        rec_args.append('-i')
+    if verbose:
+        rec_args.append('-v')
+        shred_args.append('-v')
+    if from_stdin:
+        _STDIN['files'] = True
+        if not null_sep:
+            patterns += sys.stdin.read().strip().split()
+    with journal.phase('glob'):
+        all_files, entries = expand_globs(patterns)
     if shred and (recycle or recycle_hm):
         sys.stderr.write('Recycle disabled because shred is in use\n')
         recycle = False
@@ -666,9 +5072,12 @@ def main(argv=None):
         sys.stderr.write('Recycle foreced off\n')
         recycle = False
         recycle_hm = False
+    if interactive and (recycle or recycle_hm):
+        # Nothing in the trash is ever overwritten, so there is nothing to ask
+        sys.stderr.write('-i is ignored for recycled files\n')
 
     if shred:
-        if not SHRED:
+        if shred_external and not get_shred():
             sys.stderr.write(
                 'Cannot use shred as neither shred nor gshred '
                 'are in your path\n'
@@ -682,22 +5091,87 @@ def main(argv=None):
             sys.stderr.write('Using shred+remove instead of recycle\n\n')
         else:
             sys.stderr.write('Using remove instead of recycle\n\n')
-    drs = []
-    fls = []
-    bad = []
-    oth = []
-    for fl in all_files:
-        if os.path.isdir(fl) and not os.path.islink(fl):
-            drs.append(fl)
-        elif os.path.isfile(fl) or os.path.islink(fl):
-            fls.append(fl)
-        # Anything else, even broken symlinks
-        elif os.path.lexists(fl):
-            oth.append(fl)
-        # Should not happen as glob would reject
-        else:
-            bad.append(fl)
-    if bad:
+
+    journal.add('parse', time.time() - journal.start)
+    policy = None
+    if use_policy:
+        try:
+            policy = load_policy(policy_file)
+        except (IOError, OSError, ValueError) as err:
+            sys.stderr.write('Invalid policy: {0}\n'.format(
+                getattr(err, 'strerror', None) or err
+            ))
+            return 99
+        _POLICY['current'] = policy
+    set_throttle(ops_rate, bytes_rate)
+    if io_class and not set_io_class(io_class) and verbose:
+        sys.stderr.write('Could not set the I/O class, only nice\n')
+    if show_progress is None:
+        show_progress = sys.stderr.isatty() and not (
+            verbose or interactive or dryrun
+        )
+    if show_progress or progress_fd is not None:
+        _PROGRESS['current'] = Progress(show_progress, progress_fd)
+    if not dryrun:
+        resume_reaps()
+    if from_stdin and null_sep:
+        stream = getattr(sys.stdin, 'buffer', sys.stdin)
+        batches = read_paths(stream)
+        if all_files:
+            batches = chain([all_files], batches)
+        with journal.phase('stream'):
+            with progress_phase('stream'):
+                return stream_files(
+                    batches, rec_args, shred_args, recursive=recursive,
+                    dirs=dirs, force=force, interactive=interactive,
+                    verbose=verbose, dryrun=dryrun, recycle=recycle,
+                    recycle_hm=recycle_hm, shred=shred,
+                    shred_external=shred_external, dedup=dedup
+                )
+    # One lstat per path for the whole run, infos is path->FileInfo
+    with journal.phase('classify'):
+        drs, fls, oth, bad, infos = classify_files(all_files, entries)
+    journal.add('classify', items=len(infos), failed=len(bad),
+                nbytes=sum(infos[i].st_size for i in fls))
+    if journal.path or journal.stats:
+        journal.mounts(infos.values())
+
+    # Decide every path's fate by the policy once, up front
+    actions = {}
+    refused = []
+    if policy is not None:
+        with journal.phase('policy'):
+            actions = dict((i, policy.action(
+                infos[i].abspath, stat.S_ISDIR(infos[i].st_mode)
+            )) for i in drs + fls + oth)
+            refused = [i for i in drs + fls + oth if actions[i] == 'refuse']
+            if refused:
+                sys.stderr.write('Policy refuses to remove:\n{0}\n'.format(
+                    format_list(refused)
+                ))
+                drs = [i for i in drs if actions[i] != 'refuse']
+                fls = [i for i in fls if actions[i] != 'refuse']
+                oth = [i for i in oth if actions[i] != 'refuse']
+            if policy.max_files is not None or policy.max_bytes is not None:
+                nfiles = len(fls) + len(oth)
+                nbytes = sum(infos[i].st_size for i in fls)
+                if drs and (recursive or policy.answers.get('dirs') == 'add'):
+                    # Stops once over max-files, however many dirs
+                    summary = summarize_dirs(
+                        drs, budget=float('inf'), max_entries=float('inf'),
+                        max_files=policy.max_files
+                    )
+                    nfiles += summary.files
+                    nbytes += summary.nbytes
+                reason = policy.over_limit(nfiles, nbytes)
+                if reason:
+                    sys.stderr.write(
+                        'Policy refuses to remove {0}\n'.format(reason)
+                    )
+                    return 15
+            if refused and not drs + fls + oth:
+                return 15
+    if bad and not force:
         sys.stderr.write(
             'The following files do not match any files\n{0}\n'
             .format(' '.join(bad))
@@ -709,8 +5183,8 @@ def main(argv=None):
             .format(ld, len(fls), len(oth), len(bad))
         )
 
-    # Directory handling
-    if drs and not recursive:
+    # Directory handling, -d only removes empty directories so is left to fail
+    if drs and not recursive and not dirs:
         if ld < MAX_LINE:
             sys.stderr.write(
                 'Directories {0} included but -r not sent\n'
@@ -723,10 +5197,9 @@ def main(argv=None):
             )
         ans = get_ans(
             '\nAdd -r, ignore dirs, or cancel?', ['add', 'ignore', 'cancel'],
-            default='cancel'
+            default='cancel', key='dirs'
         )
         if ans == 'add':
-            flags.append('-r')
             recursive = True
         elif ans == 'ignore':
             drs = []
@@ -736,51 +5209,47 @@ def main(argv=None):
             raise Exception('Invalid response {0}'.format(ans))
         sys.stderr.write('\n')
 
+    # The counts below directories, also the totals for the progress report
+    summary = TreeSummary()
     if recursive:
         if drs:
-            dc = 0
-            fc = 0
-            for dr in drs:
-                for i in [os.path.join(dr, d) for d in os.listdir(dr)]:
-                    if os.path.isdir(i):
-                        dc += 1
-                    else:
-                        fc += 1
-            info = []
-            if dc or fc:
-                if fc:
-                    info.append('{0} subfiles'.format(fc))
-                if dc:
-                    info.append('{0} subfolders'.format(dc))
-            inf = ' and '.join(info)
+            # Bounded by SUMMARY_TIME, so huge trees give a lower bound
+            with journal.phase('count'):
+                summary = summarize_dirs(drs)
+            journal.add('count', items=summary.files + summary.dirs,
+                        nbytes=summary.nbytes)
+            inf = summary.describe()
             msg = 'Recursively deleting '
             if ld < MAX_LINE:
                 msg += 'the folders {0}'.format(drs)
-                if info:
+                if inf:
                     msg += ' with ' + inf
             else:
                 msg += '{0} dirs:'.format(ld)
                 msg += '\n{0}\n'.format(format_list(drs))
-                if info:
+                if inf:
                     msg += '\nThey contain ' + inf
                 else:
                     msg += '\nThey contain no subfiles or directories'
             sys.stderr.write(msg + '\n')
-            if not yesno('Really delete?', False):
+            if not yesno('Really delete?', False, key='confirm',
+                         full_list=drs):
                 return 1
             sys.stderr.write('\n')
 
     # File handling
     if len(fls) >= CUTOFF:
+        fsize = format_size(sum(infos[i].st_size for i in fls))
         if len(fls) < MAX_LINE:
-            if not yesno('Delete the files {0}?'.format(fls), False):
+            if not yesno('Delete the files {0} ({1})?'.format(fls, fsize),
+                         False, key='confirm'):
                 return 6
         else:
             sys.stderr.write(
-                'Deleting the following {0} files:\n{1}\n'
-                .format(len(fls), format_list(fls))
+                'Deleting the following {0} files ({1}):\n{2}\n'
+                .format(len(fls), fsize, format_list(fls))
             )
-            if not yesno('Delete?', False):
+            if not yesno('Delete?', False, key='confirm', full_list=fls):
                 return 10
         sys.stderr.write('\n')
 
@@ -791,10 +5260,18 @@ def main(argv=None):
         to_recycle = to_delete
         to_delete  = []
     elif recycle_hm:
-        for fl in to_delete:
-            if os.path.abspath(fl).startswith(HOME):
-                to_recycle.append(fl)
-                to_delete.remove(fl)
+        in_home = [infos[i].abspath.startswith(HOME) for i in to_delete]
+        to_recycle = [i for i, h in zip(to_delete, in_home) if h]
+        to_delete = [i for i, h in zip(to_delete, in_home) if not h]
+    if actions and not shred:
+        everything = to_recycle + to_delete
+        to_recycle = [
+            i for i in everything if actions[i] == 'recycle' or (
+                actions[i] != 'delete' and i in to_recycle
+            )
+        ]
+        recycling = set(to_recycle)
+        to_delete = [i for i in everything if i not in recycling]
     if verbose:
         sys.stderr.write(
             'Have {0} items to delete and {1} item to recycle\n\n'
@@ -810,38 +5287,34 @@ def main(argv=None):
             'The following cannot be recycled and will be deleted:\n{0}\n'
             .format(format_list(oth))
         )
-        if yesno('Delete?', False):
-            if call(sh.split('rm -- {0}'.format(' '.join(oth)))) == 0:
+        if yesno('Delete?', False, key='confirm', full_list=oth):
+            if dryrun:
+                sys.stdout.write(
+                    'Removing: {0}\n'.format(' '.join(quote(i) for i in oth))
+                )
+            elif not delete_files(oth, force=force, verbose=verbose,
+                                  infos=infos):
                 sys.stderr.write('Done\n')
             else:
                 sys.stderr.write('Delete failed!\n')
                 return 1
-        if not to_delete:
+        if not to_delete and not to_recycle:
             return 0
         sys.stderr.write('\n')
 
     # Shred here
     if shred:
-        failed = []
-        if drs:
-            if verbose:
-                sys.stderr.write(
-                    'Recursively shredding files in the following dirs:\n{0}\n'
-                    .format(format_list(drs))
+        passes = SHRED_PASSES
+        if '-n' in shred_args:
+            passes = int(shred_args[shred_args.index('-n') + 1])
+        nbytes = summary.nbytes + sum(infos[i].st_size for i in fls)
+        with journal.phase('shred'):
+            with progress_phase('shred', len(fls) + summary.files,
+                                nbytes * (passes + 1), summary.complete):
+                failed = shred_paths(
+                    drs, fls, shred_args, verbose, dryrun, shred_external
                 )
-            for dr in drs:
-                for wroot, wdirs, wfiles in os.walk(dr):
-                    if verbose:
-                        sys.stderr.write('Shredding in {0}\n'.format(wroot))
-                    if wfiles:
-                        sfls = [os.path.join(wroot, i) for i in wfiles]
-                        if shred_files(sfls, shred_args, verbose, dryrun) != 0:
-                            failed.append(os.path.join(dr, wroot))
-                    elif verbose:
-                        sys.stderr.write('No files to shred\n')
-        if fls:
-            if shred_files(fls, shred_args, verbose, dryrun) != 0:
-                failed += fls
+        journal.add('shred', items=len(drs) + len(fls), failed=len(failed))
         if failed:
             sys.stderr.write(
                 'shred FAILED on the following files and dirs:\n{0}\n\n'.format(
@@ -849,7 +5322,7 @@ def main(argv=None):
                 )
             )
             msg = 'Continue with deletion anyway (data may not be scrubbed)?'
-            if not yesno(msg, False):
+            if not yesno(msg, False, key='shred-failed'):
                 return 13
             sys.stderr.write('\n')
 
@@ -859,30 +5332,53 @@ def main(argv=None):
             os.makedirs(RECYCLE_BIN)
         try_apple = SYSTEM == 'Darwin' and not \
             os.path.isfile(os.path.join(HOME, '.no_apple_rm'))
-        to_delete += recycle_files(
-            to_recycle, mv_flags=rec_args, try_apple=try_apple,
-            verbose=verbose, dryrun=dryrun
-        )
+        rec_infos = dict((infos[i].abspath, infos[i]) for i in to_recycle)
+        with journal.phase('recycle'):
+            with progress_phase('recycle', len(to_recycle)):
+                failed = recycle_files(
+                    to_recycle, mv_flags=rec_args, try_apple=try_apple,
+                    verbose=verbose, dryrun=dryrun, infos=rec_infos,
+                    background=background, dedup=dedup
+                )
+        journal.add('recycle', items=len(to_recycle), failed=len(failed))
+        to_delete += failed
+        if compress and not dryrun:
+            start_compactor()
 
-    # And finally.... the rm wrapper itself, attempts to quote and isolate
-    # file names to increase the number of things we could delete (e.g. files
-    # that start with '-' or contain '@', '*', or '~'
+    # And finally.... the deletion itself, done in-process so that there are
+    # no argv limits or quoting issues (e.g. files that start with '-')
     if to_delete:
-        cmnd = 'rm {0} {1} {2}'.format(
-            ' '.join(flags), file_sep,
-            ' '.join([quote(i) for i in to_delete])
-        )
-
         if dryrun or verbose:
             if verbose:
-                sys.stderr.write('Actually running rm\n')
-            sys.stdout.write('Running: {0}\n'.format(cmnd))
+                sys.stderr.write('Actually deleting files\n')
+            sys.stdout.write(
+                'Removing: {0}\n'.format(' '.join(quote(i) for i in to_delete))
+            )
             if dryrun:
                 return 0
 
-        return call(sh.split(cmnd))
+        if fast and not interactive:
+            count = len(to_delete)
+            with journal.phase('stage'):
+                to_delete = stage_files(
+                    to_delete, infos, recursive=recursive, verbose=verbose
+                )
+            journal.add('stage', items=count, failed=len(to_delete))
+        # Items below directories, unless they were recycled or staged
+        total = None
+        if not to_recycle and not fast:
+            total = len(to_delete) + summary.files + summary.dirs
+        with journal.phase('delete'):
+            with progress_phase('delete', total, exact=summary.complete):
+                failed = to_delete and delete_files(
+                    to_delete, force=force, interactive=interactive,
+                    verbose=verbose, recursive=recursive, dirs=dirs,
+                    infos=infos
+                )
+        journal.add('delete', items=len(to_delete), failed=len(failed or []))
+        return 1 if failed or refused else 0
 
-    return 0
+    return 1 if refused else 0
 
 
 # The End
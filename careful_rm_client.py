@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""careful_rm client, what the rm alias runs.
+
+Passes the arguments to the careful_rm daemon (careful_rm.py --daemon) if
+one is running, without loading careful_rm at all, so each rm costs little
+more than starting python. If no daemon answers, careful_rm is imported and
+run in-process. As a module its bytecode is cached, a script's never is, so
+this is faster than running careful_rm.py even then.
+
+Speaks the protocol of careful_rm.run_client and careful_rm._send_request,
+keep them in step.
+
+Usage: careful_rm_client.py [careful_rm arguments] ..
+"""
+import os
+import sys
+import signal
+
+DAEMON_NAME = 'careful_rm.sock'
+
+
+def daemon_socket():
+    """Return the path of the per-user daemon socket, as careful_rm."""
+    run_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not run_dir or not os.path.isdir(run_dir):
+        run_dir = '/tmp/careful_rm-{0}'.format(os.getuid())
+    return os.path.join(run_dir, DAEMON_NAME)
+
+
+def send_request(sock, argv, fds):
+    """Send cwd, argv, the environment, our umask, and fds over sock."""
+    import socket
+    import array
+    umask = os.umask(0)
+    os.umask(umask)
+    fields = [os.getcwd(), str(len(argv))] + list(argv) + [
+        '{0}={1}'.format(k, v) for k, v in os.environ.items()
+        if k != 'CAREFUL_RM_UMASK'
+    ] + ['CAREFUL_RM_UMASK={0:o}'.format(umask), '', '']
+    data = '\0'.join(fields).encode('utf-8', 'surrogateescape')
+    sent = sock.sendmsg([data[:1]], [(
+        socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds)
+    )])
+    sock.sendall(data[sent:])
+
+
+def run_client(argv):
+    """Run argv in the daemon, returns the exit code, None if not run."""
+    path = daemon_socket()
+    if not os.path.exists(path) or \
+            os.stat(os.path.dirname(path)).st_uid != os.getuid():
+        return None
+    import socket
+    if not hasattr(socket, 'AF_UNIX') or \
+            not hasattr(socket.socket, 'sendmsg'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    fds = [0, 1, 2]
+    try:
+        fds.append(os.open('/dev/tty', os.O_RDWR | os.O_NOCTTY))
+    except OSError:
+        pass
+    try:
+        sock.connect(path)
+        send_request(sock, argv, fds)
+        reply = sock.makefile('rb')
+        pid = reply.readline()
+        if not pid:
+            return None
+        pid = int(pid)
+
+        def forward(sig, frame):
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, forward)
+        code = reply.readline()
+        return int(code) if code else 1
+    except (OSError, IOError, ValueError):
+        return None
+    finally:
+        sock.close()
+        for fd in fds[3:]:
+            os.close(fd)
+
+
+def main(argv=None):
+    """Run argv in the daemon, or in-process if no daemon answers."""
+    argv = sys.argv if argv is None else argv
+    if '--daemon' not in argv and \
+            not os.environ.get('CAREFUL_RM_NO_DAEMON') and \
+            not any(i.startswith('--progress-fd=') for i in argv):
+        code = run_client(argv)
+        if code is not None:
+            return code
+    import careful_rm
+    # The daemon has been asked already
+    careful_rm._DAEMON['asked'] = True
+    return careful_rm.main(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -41,14 +41,14 @@ setup(
     # Packages are directories with __init__.py files
     # Modules are python scripts (minus the .py)
     #  packages=["careful_rm"],
-    py_modules=['careful_rm'],
+    py_modules=['careful_rm', 'careful_rm_client'],
 
     # Entry points and scripts
     # Entry points are functions that can use sys.argv (e.g. main())
     # Scripts are independent pieces of code intended to be executed as is
     entry_points = {
         'console_scripts': [
-            'careful_rm = careful_rm:main',
+            'careful_rm = careful_rm_client:main',
             'rm_trash = careful_rm:get_trash',
         ],
     },
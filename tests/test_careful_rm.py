@@ -0,0 +1,760 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Regression tests for careful_rm, run against the script in a sandbox.
+
+Every test gets its own HOME, so no trash, policy, or daemon of the user's
+is touched.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+try:
+    from unittest import mock
+except ImportError:
+    mock = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(HERE), 'careful_rm.py')
+CLIENT = os.path.join(os.path.dirname(HERE), 'careful_rm_client.py')
+sys.path.insert(0, os.path.dirname(HERE))
+
+import careful_rm  # noqa: E402
+
+
+class CarefulRmTest(unittest.TestCase):
+
+    """Runs careful_rm.py in a temporary HOME and working directory."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='careful_rm_test_')
+        self.home = os.path.join(self.tmp, 'home')
+        os.mkdir(self.home)
+        self.env = dict(os.environ)
+        self.env.update({
+            'HOME': self.home, 'CAREFUL_RM_NO_DAEMON': '1',
+            'XDG_DATA_HOME': os.path.join(self.home, '.local', 'share'),
+            'XDG_CONFIG_HOME': os.path.join(self.home, '.config'),
+            'XDG_CACHE_HOME': os.path.join(self.home, '.cache'),
+            'XDG_STATE_HOME': os.path.join(self.home, '.local', 'state'),
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def make_tree(self, *paths):
+        """Create the files in paths (and their directories) under tmp."""
+        for pth in paths:
+            full = os.path.join(self.tmp, pth)
+            if not os.path.isdir(os.path.dirname(full)):
+                os.makedirs(os.path.dirname(full))
+            with open(full, 'w') as fout:
+                fout.write('data\n')
+
+    def path(self, *parts):
+        """Return parts joined under tmp."""
+        return os.path.join(self.tmp, *parts)
+
+    def home_trash(self):
+        """Create and return the HOME trash."""
+        trash = os.path.join(self.home, '.local', 'share', 'Trash')
+        if not os.path.isdir(trash):
+            os.makedirs(trash)
+        return trash
+
+    def rm(self, args, cwd=None, answers='y\n', script=SCRIPT):
+        """Run careful_rm.py (or script) with args, return (code, stderr).
+
+        answers is the STDIN, there is no terminal. STDOUT is kept in
+        self.out.
+        """
+        proc = subprocess.Popen(
+            [sys.executable, script] + list(args), cwd=cwd or self.tmp,
+            env=self.env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, preexec_fn=os.setsid
+        )
+        out, err = proc.communicate(answers.encode())
+        self.out = out.decode()
+        return proc.returncode, err.decode()
+
+    def test_fast_refuses_dot(self):
+        """-rf --fast . leaves the current directory alone."""
+        self.make_tree('a/sub/f')
+        sub = os.path.join(self.tmp, 'a', 'sub')
+        code, err = self.rm(['-rf', '--fast', '.'], cwd=sub)
+        self.assertEqual(code, 1)
+        self.assertIn("refusing to remove '.' or '..'", err)
+        self.assertTrue(os.path.isfile(os.path.join(sub, 'f')))
+
+    def test_fast_refuses_dotdot(self):
+        """-rf --fast .. leaves the parent directory alone."""
+        self.make_tree('a/sub/f', 'a/g')
+        sub = os.path.join(self.tmp, 'a', 'sub')
+        code, err = self.rm(['-rf', '--fast', '..'], cwd=sub)
+        self.assertEqual(code, 1)
+        self.assertIn("refusing to remove '.' or '..'", err)
+        self.assertTrue(os.path.isfile(os.path.join(sub, 'f')))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp, 'a', 'g')))
+
+    def test_policy_refuses_below_directory(self):
+        """A refuse pattern below a directory argument keeps the directory."""
+        self.make_tree('p/keep/x.db', 'p/keep/y.txt', 'p/scr/z')
+        policy = os.path.join(self.tmp, 'pol')
+        with open(policy, 'w') as fout:
+            fout.write('refuse {0}/*.db\nconfirm yes\ndirs add\n'.format(
+                os.path.join(self.tmp, 'p', 'keep')
+            ))
+        code, err = self.rm(['--direct', '--policy=' + policy, 'keep', 'scr'],
+                            cwd=os.path.join(self.tmp, 'p'))
+        self.assertEqual(code, 1)
+        self.assertIn('Policy refuses to remove', err)
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.tmp, 'p', 'keep', 'x.db')
+        ))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'p', 'scr')))
+
+    def test_policy_max_files_counts_below_directories(self):
+        """max-files counts files, however many directories hold them."""
+        self.make_tree(*['t/d{0}/f'.format(i) for i in range(150)])
+        policy = os.path.join(self.tmp, 'pol')
+        with open(policy, 'w') as fout:
+            fout.write('max-files 100\nconfirm yes\n')
+        code, err = self.rm(['-rf', '--direct', '--policy=' + policy, 't'])
+        self.assertEqual(code, 15)
+        self.assertIn('more than max-files 100', err)
+        self.assertEqual(len(os.listdir(self.path('t'))), 150)
+        # The stream checks the same way
+        code, err = self.rm(
+            ['-rf', '--direct', '--policy=' + policy, '--stdin0'],
+            answers=self.path('t') + '\0'
+        )
+        self.assertEqual(code, 15)
+        self.assertEqual(len(os.listdir(self.path('t'))), 150)
+        # And within the limit it is all removed
+        with open(policy, 'w') as fout:
+            fout.write('max-files 150\nconfirm yes\n')
+        code, err = self.rm(['-rf', '--direct', '--policy=' + policy, 't'])
+        self.assertEqual(code, 0)
+        self.assertFalse(os.path.lexists(self.path('t')))
+
+    def test_compress_older_than_zero(self):
+        """--older-than 0s compresses items trashed in the same second."""
+        trash = self.home_trash()
+        with open(os.path.join(self.home, 'f'), 'w') as fout:
+            fout.write('a' * 200000)
+        code, _ = self.rm(['-c', 'f'], cwd=self.home)
+        self.assertEqual(code, 0)
+        # Only this trash, --compress-trash would do the user's too
+        count, _ = careful_rm.compress_trash(trash, older_than=0)
+        self.assertEqual(count, 1)
+        self.assertTrue(os.path.isfile(os.path.join(trash, 'files', 'f.gz')))
+
+    def test_daemon_uses_client_umask(self):
+        """Requests run by the daemon create files with the client's umask."""
+        run_dir = os.path.join(self.tmp, 'run')
+        os.mkdir(run_dir, 0o700)
+        trash = self.home_trash()
+        self.env['XDG_RUNTIME_DIR'] = run_dir
+        del self.env['CAREFUL_RM_NO_DAEMON']
+        code, _ = self.rm(['--daemon'])
+        self.assertEqual(code, 0)
+        old = os.umask(0o077)
+        try:
+            with open(os.path.join(self.home, 'f'), 'w') as fout:
+                fout.write('data\n')
+            code, _ = self.rm(['-c', 'f'], cwd=self.home)
+        finally:
+            os.umask(old)
+            self.rm(['--stop-daemon'])
+        self.assertEqual(code, 0)
+        info = os.stat(os.path.join(trash, 'info', 'f.trashinfo'))
+        self.assertEqual(info.st_mode & 0o777, 0o600)
+
+    def test_client_with_and_without_daemon(self):
+        """The client runs requests in the daemon, or in-process if none."""
+        run_dir = os.path.join(self.tmp, 'run')
+        os.mkdir(run_dir, 0o700)
+        trash = self.home_trash()
+        self.env['XDG_RUNTIME_DIR'] = run_dir
+        del self.env['CAREFUL_RM_NO_DAEMON']
+        self.make_tree('home/f', 'home/g')
+        code, _ = self.rm(['-c', 'f'], cwd=self.home, script=CLIENT)
+        self.assertEqual(code, 0)
+        sock = os.path.join(run_dir, 'careful_rm.sock')
+        self.assertFalse(os.path.exists(sock))
+        code, _ = self.rm(['--daemon'])
+        self.assertEqual(code, 0)
+        try:
+            code, _ = self.rm(['-c', 'g'], cwd=self.home, script=CLIENT)
+        finally:
+            self.rm(['--stop-daemon'])
+        self.assertEqual(code, 0)
+        for name in ('f', 'g'):
+            self.assertFalse(os.path.exists(os.path.join(self.home, name)))
+            self.assertTrue(os.path.isfile(os.path.join(trash, 'files', name)))
+
+    def test_recycle_warns_interactive(self):
+        """-i is reported as ignored when recycling, not silently dropped."""
+        self.home_trash()
+        self.make_tree('home/f')
+        code, err = self.rm(['-ci', 'f'], cwd=self.home)
+        self.assertEqual(code, 0)
+        self.assertIn('-i is ignored for recycled files', err)
+        self.assertFalse(os.path.exists(os.path.join(self.home, 'f')))
+
+    def test_capital_i_undoes_force(self):
+        """-I is accepted, and as in rm undoes an earlier -f."""
+        self.make_tree('f')
+        code, err = self.rm(['--direct', '-I', 'f'])
+        self.assertEqual(code, 0)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'f')))
+        code, err = self.rm(['--direct', '-fI', 'missing'])
+        self.assertIn('missing', err)
+
+    def test_delete_missing(self):
+        """As rm, a missing file is an error, unless -f."""
+        code, err = self.rm(['--direct', 'missing'])
+        self.assertNotEqual(code, 0)
+        self.assertIn('missing', err)
+        code, err = self.rm(['--direct', '-f', 'missing'])
+        self.assertNotIn('missing', err)
+
+    def test_delete_dir_flag(self):
+        """-d removes empty directories only."""
+        os.mkdir(self.path('empty'))
+        self.make_tree('full/f')
+        code, _ = self.rm(['--direct', '-d', 'empty'])
+        self.assertEqual(code, 0)
+        self.assertFalse(os.path.exists(self.path('empty')))
+        code, err = self.rm(['--direct', '-d', 'full'])
+        self.assertEqual(code, 1)
+        self.assertIn('Directory not empty', err)
+        self.assertTrue(os.path.isfile(self.path('full', 'f')))
+
+    def test_delete_interactive(self):
+        """-i asks about every file, and keeps those refused."""
+        self.make_tree('a', 'b')
+        code, _ = self.rm(['--direct', '-i', 'a', 'b'], answers='y\nn\n')
+        self.assertEqual(code, 0)
+        self.assertFalse(os.path.exists(self.path('a')))
+        self.assertTrue(os.path.exists(self.path('b')))
+
+    def test_delete_refuses_dot(self):
+        """-rf . is refused, as by rm."""
+        self.make_tree('a/f')
+        code, err = self.rm(['--direct', '-rf', '.'], cwd=self.path('a'))
+        self.assertEqual(code, 1)
+        self.assertIn("refusing to remove '.' or '..'", err)
+        self.assertTrue(os.path.isfile(self.path('a', 'f')))
+
+    def test_delete_symlink_not_followed(self):
+        """-rf on a symlink to a directory removes only the link."""
+        self.make_tree('d/sub/f')
+        os.symlink('d', self.path('link'))
+        code, _ = self.rm(['--direct', '-rf', 'link'])
+        self.assertEqual(code, 0)
+        self.assertFalse(os.path.lexists(self.path('link')))
+        self.assertTrue(os.path.isfile(self.path('d', 'sub', 'f')))
+
+    def test_delete_symlink_slash_force(self):
+        """-rf link/ empties the target silently and keeps the link, as rm."""
+        self.make_tree('d/sub/f', 'd/g')
+        os.symlink('d', self.path('link'))
+        code, err = self.rm(['--direct', '-rf', 'link/'])
+        self.assertEqual(code, 0)
+        self.assertNotIn('Not a directory', err)
+        self.assertTrue(os.path.islink(self.path('link')))
+        self.assertEqual(os.listdir(self.path('d')), [])
+
+    @unittest.skipIf(mock is None, 'needs unittest.mock')
+    def test_delete_asks_write_protected_in_tree(self):
+        """Without -f, write-protected files below -r trees are asked about."""
+        self.make_tree('d/sub/ro', 'd/sub/rw', 'd/other')
+        ro = self.path('d', 'sub', 'ro')
+        asked = []
+
+        def yesno(message, def_yes=True, key=None, full_list=None):
+            asked.append(message)
+            return False
+        tty = mock.Mock(isatty=lambda: True)
+        with mock.patch.object(careful_rm, 'yesno', yesno), \
+                mock.patch.object(careful_rm.sys, 'stdin', tty), \
+                mock.patch.object(careful_rm.os, 'access',
+                                  lambda pth, mode: pth != ro):
+            failed = careful_rm.delete_files(
+                [self.path('d')], recursive=True, workers=4
+            )
+        self.assertEqual(failed, [])
+        self.assertEqual(len(asked), 1)
+        self.assertIn('write-protected', asked[0])
+        self.assertTrue(os.path.isfile(ro))
+        self.assertFalse(os.path.exists(self.path('d', 'sub', 'rw')))
+        self.assertFalse(os.path.exists(self.path('d', 'other')))
+
+    def test_stream_force_still_confirms(self):
+        """-f does not skip the confirmation of paths streamed with -0."""
+        self.make_tree('a', 'b', 'c', 'd')
+        paths = ''.join(self.path(i) + '\0' for i in 'abcd')
+        code, err = self.rm(['--direct', '-f', '--stdin0'], answers=paths)
+        self.assertEqual(code, 1)
+        self.assertIn('Delete these and all further paths?', err)
+        self.assertTrue(all(os.path.exists(self.path(i)) for i in 'abcd'))
+        policy = self.path('pol')
+        with open(policy, 'w') as fout:
+            fout.write('confirm yes\n')
+        code, _ = self.rm(['--direct', '-f', '--stdin0', '--policy=' + policy],
+                          answers=paths)
+        self.assertEqual(code, 0)
+        self.assertFalse(any(os.path.exists(self.path(i)) for i in 'abcd'))
+
+    def test_stream_few_files_not_confirmed(self):
+        """As main, a couple of streamed files are removed without asking."""
+        self.make_tree('a', 'b')
+        paths = self.path('a') + '\0' + self.path('b') + '\0'
+        code, err = self.rm(['--direct', '--stdin0'], answers=paths)
+        self.assertEqual(code, 0)
+        self.assertNotIn('Delete these', err)
+        self.assertFalse(os.path.exists(self.path('a')))
+
+    @unittest.skipIf(mock is None, 'needs unittest.mock')
+    def test_summarize_dirs_scales_workers(self):
+        """The -r prompt's count uses one thread per directory given."""
+        self.make_tree('a/x/f', 'a/y/g', 'b/h')
+        started = []
+        real = careful_rm.threading.Thread
+
+        def thread(*args, **kwargs):
+            started.append(1)
+            return real(*args, **kwargs)
+        with mock.patch.object(careful_rm.threading, 'Thread', thread):
+            summary = careful_rm.summarize_dirs([self.path('a')])
+            self.assertEqual(len(started), 1)
+            self.assertEqual((summary.files, summary.dirs), (2, 2))
+            self.assertTrue(summary.complete)
+            careful_rm.summarize_dirs([self.path('a'), self.path('b')])
+            self.assertEqual(len(started), 3)
+
+    def test_shredder_overwrites_in_place(self):
+        """Shredder zeroes files (-z) and never follows symlinks."""
+        self.make_tree('d/sub/f', 'g', 'target')
+        os.symlink(self.path('target'), self.path('d', 'link'))
+        shredder = careful_rm.Shredder(['-z', '-n', '1'], workers=2)
+        failed = shredder.run([self.path('d')], [self.path('g')])
+        self.assertEqual(failed, [])
+        self.assertEqual(shredder.files, 2)
+        for pth in [self.path('d', 'sub', 'f'), self.path('g')]:
+            with open(pth, 'rb') as fin:
+                data = fin.read()
+            self.assertTrue(data)
+            self.assertEqual(data.strip(b'\0'), b'')
+        with open(self.path('target')) as fin:
+            self.assertEqual(fin.read(), 'data\n')
+
+    def test_shred_removes_tree(self):
+        """-rs shreds in-process, then removes everything."""
+        self.make_tree('d/sub/f', 'd/g')
+        code, err = self.rm(['-rs', 'd'])
+        self.assertEqual(code, 0)
+        self.assertIn('Shredded 2 files', err)
+        self.assertFalse(os.path.exists(self.path('d')))
+
+    def test_index_list_and_restore(self):
+        """Recycled items are indexed, listed, and restored by the index."""
+        trash = self.home_trash()
+        self.make_tree('home/a', 'home/d/b')
+        self.assertEqual(self.rm(['-c', 'a'], cwd=self.home)[0], 0)
+        self.assertEqual(self.rm(['-rc', 'd'], cwd=self.home)[0], 0)
+        with open(careful_rm.index_path(trash)) as fin:
+            records = [json.loads(i) for i in fin]
+        self.assertEqual([(i['op'], i['name']) for i in records],
+                         [('add', 'a'), ('add', 'd')])
+        # Absolute patterns, so no other trash on this machine matches
+        pattern = os.path.join(self.home, '*')
+        self.assertEqual(self.rm(['--list-trash', pattern])[0], 0)
+        self.assertIn(os.path.join(self.home, 'a'), self.out)
+        self.assertIn(os.path.join(self.home, 'd'), self.out)
+        code, _ = self.rm(['--restore', os.path.join(self.home, 'a')])
+        self.assertEqual(code, 0)
+        with open(os.path.join(self.home, 'a')) as fin:
+            self.assertEqual(fin.read(), 'data\n')
+        self.rm(['--list-trash', pattern])
+        self.assertNotIn(os.path.join(self.home, 'a'), self.out)
+        self.assertEqual(careful_rm.read_index(trash).keys(), {'d'})
+
+    def test_trashinfo_path_round_trips(self):
+        """Path= is percent-encoded, so % and newlines survive reading."""
+        trash = self.home_trash()
+        name = 'x%41y\nz'
+        self.make_tree(os.path.join('home', name))
+        self.assertEqual(self.rm(['-c', name], cwd=self.home)[0], 0)
+        info = os.path.join(trash, 'info', name + '.trashinfo')
+        with open(info) as fin:
+            self.assertIn('/x%2541y%0Az\n', fin.read())
+        self.assertEqual(careful_rm.read_trashinfo(info)['path'],
+                         os.path.join(self.home, name))
+
+    def test_trash_names_reserved(self):
+        """Files with the same name get numbered names, one trashinfo each."""
+        trash = self.home_trash()
+        self.make_tree('home/a/f', 'home/b/f', 'home/c/f', 'home/f')
+        os.makedirs(os.path.join(trash, 'files'))
+        self.make_tree(os.path.join(trash, 'files', 'f.2'))
+        code, _ = self.rm(['-c', 'a/f', 'b/f', 'c/f', 'f'], cwd=self.home)
+        self.assertEqual(code, 0)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(trash, 'files'))),
+            ['f', 'f.2', 'f.3', 'f.4', 'f.5']
+        )
+        paths = set(
+            careful_rm.read_trashinfo(os.path.join(trash, 'info', i))['path']
+            for i in os.listdir(os.path.join(trash, 'info'))
+        )
+        self.assertEqual(paths, set(
+            os.path.join(self.home, i) for i in ['a/f', 'b/f', 'c/f', 'f']
+        ))
+
+    @unittest.skipIf(mock is None, 'needs unittest.mock')
+    def test_copier_waits_out_slow_copies(self):
+        """A copy still running at a progress report is not a failure."""
+        self.make_tree('src/d/f', 'src/g')
+        copier = careful_rm.TreeCopier(workers=2, progress=True)
+        copy_file = copier.copy_file
+
+        def slow_copy(*args):
+            careful_rm.time.sleep(0.05)
+            return copy_file(*args)
+        copier.copy_file = slow_copy
+        with mock.patch.object(careful_rm, 'PROGRESS_INTERVAL', 0.01):
+            ok = copier.run([(self.path('src'), self.path('dst'))])
+        self.assertEqual(ok, [True])
+        self.assertTrue(os.path.isfile(self.path('dst', 'd', 'f')))
+        self.assertTrue(os.path.isfile(self.path('dst', 'g')))
+
+    def test_get_trash_cached(self):
+        """--get-trash answers from the cache while the mount is unchanged."""
+        self.make_tree('d/f')
+        cache = os.path.join(self.home, '.cache', 'careful_rm', 'trashes')
+        code, _ = self.rm(['--get-trash', self.path('d')])
+        self.assertEqual(code, 0)
+        trash = self.out
+        with open(cache) as fin:
+            lines = fin.read().splitlines()
+        self.assertEqual(lines[0].split('\t')[:2], ['home', self.home])
+        dev, mount, cached = lines[-1].split('\t')
+        self.assertEqual(cached, trash)
+        self.assertEqual(int(dev), os.stat(mount).st_dev)
+        # A cached entry is used without looking up the trash again
+        lines[-1] = '\t'.join([dev, mount, '/cached/trash'])
+        with open(cache, 'w') as fout:
+            fout.write('\n'.join(lines) + '\n')
+        self.rm(['--get-trash', self.path('d')])
+        self.assertEqual(self.out, '/cached/trash')
+        # But not one written for another HOME
+        lines[0] = '\t'.join(['home', '/elsewhere', '/elsewhere/.Trash'])
+        with open(cache, 'w') as fout:
+            fout.write('\n'.join(lines) + '\n')
+        self.rm(['--get-trash', self.path('d')])
+        self.assertEqual(self.out, trash)
+
+    def test_get_trash_many(self):
+        """--get-trash-many prints one trash per argument or STDIN line."""
+        trash = self.home_trash()
+        self.make_tree('d/f')
+        code, _ = self.rm(['--get-trash-many', self.home, self.path('d')])
+        self.assertEqual(code, 0)
+        lines = self.out.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0], trash)
+        code, _ = self.rm(
+            ['--get-trash-many'],
+            answers='{0}\n{1}\n'.format(self.path('d'), self.home)
+        )
+        self.assertEqual(code, 0)
+        self.assertEqual(self.out.splitlines(), lines[::-1])
+
+    def test_purge_keeps_undated(self):
+        """--purge --older-than keeps items with no valid deletion date."""
+        trash = self.path('Trash')
+        dates = {'old': '2000-01-01T00:00:00', 'empty': '', 'bad': 'soon'}
+        for name, date in dates.items():
+            self.make_tree(os.path.join('Trash', 'files', name))
+            self.make_tree(os.path.join('Trash', 'info', name + '.trashinfo'))
+            with open(os.path.join(
+                    trash, 'info', name + '.trashinfo'), 'w') as fout:
+                fout.write('[Trash Info]\nPath=/{0}\nDeletionDate={1}\n'
+                           .format(name, date))
+        err = mock.Mock()
+        # Only this trash, --purge would do the user's too
+        with mock.patch.object(careful_rm, 'get_all_trashes',
+                               lambda indexed: [trash]), \
+                mock.patch.object(careful_rm.sys, 'stderr', err):
+            code = careful_rm.purge_trash(older_than=3600, force=True)
+        self.assertEqual(code, 0)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(trash, 'files'))), ['bad', 'empty']
+        )
+        written = ''.join(c[0][0] for c in err.write.call_args_list)
+        self.assertIn('Kept 2 items with no valid deletion date', written)
+
+    def stage(self, *paths):
+        """Stage paths under tmp for fast deletion, return the reaped dirs.
+
+        The staging directory is made in tmp, rather than at the root of
+        its mount, and the reaper is not started.
+        """
+        started = []
+        with mock.patch.object(careful_rm, 'get_mount',
+                               lambda fl, st=None: self.tmp), \
+                mock.patch.object(careful_rm, 'REAP_LIST',
+                                  self.path('reap')), \
+                mock.patch.object(careful_rm, 'start_reaper', started.extend):
+            self.left = careful_rm.stage_files(
+                [self.path(i) for i in paths], recursive=True
+            )
+        return started
+
+    def test_fast_stages_then_reaps(self):
+        """--fast renames targets out of the way, the reaper deletes them."""
+        self.make_tree('d/sub/f', 'g')
+        reap_dir = self.path(careful_rm.REAP_DIR)
+        self.assertEqual(self.stage('d', 'g'), [reap_dir])
+        self.assertEqual(self.left, [])
+        self.assertFalse(os.path.lexists(self.path('d')))
+        self.assertFalse(os.path.lexists(self.path('g')))
+        self.assertEqual(len(os.listdir(reap_dir)), 2)
+        self.assertEqual(os.stat(reap_dir).st_mode & 0o777, 0o700)
+        with open(self.path('reap')) as fin:
+            self.assertEqual(fin.read(), reap_dir + '\n')
+        careful_rm.reap(reap_dir)
+        self.assertFalse(os.path.lexists(reap_dir))
+
+    def test_fast_ignores_untrusted_reap_dir(self):
+        """A planted staging directory is neither used nor reaped."""
+        self.make_tree('d/f', careful_rm.REAP_DIR + '/keep')
+        reap_dir = self.path(careful_rm.REAP_DIR)
+        os.chmod(reap_dir, 0o755)
+        # Falls back to HOME, on the same device here
+        with mock.patch.object(careful_rm, 'HOME', self.home):
+            started = self.stage('d')
+        home_reap = os.path.join(self.home, careful_rm.REAP_DIR)
+        self.assertEqual(started, [home_reap])
+        self.assertEqual(os.listdir(reap_dir), ['keep'])
+        careful_rm.reap(reap_dir)
+        self.assertEqual(os.listdir(reap_dir), ['keep'])
+        careful_rm.reap(home_reap)
+        self.assertFalse(os.path.lexists(home_reap))
+
+    def test_resume_reaps(self):
+        """Staging directories left with contents are reaped again."""
+        self.make_tree('d/f')
+        reap_dir = self.path(careful_rm.REAP_DIR)
+        self.stage('d')
+        with open(self.path('reap'), 'a') as fout:
+            fout.write(self.path('gone') + '\n')
+        started = []
+        with mock.patch.object(careful_rm, 'REAP_LIST', self.path('reap')), \
+                mock.patch.object(careful_rm, 'start_reaper', started.extend):
+            careful_rm.resume_reaps()
+        self.assertEqual(started, [reap_dir])
+        with open(self.path('reap')) as fin:
+            self.assertEqual(fin.read(), reap_dir + '\n')
+
+    def test_rate_limiter_buckets(self):
+        """RateLimiter allows one second's burst, then sleeps off the debt."""
+        clock = [1000.0]
+        slept = []
+        with mock.patch.object(careful_rm.time, 'time', lambda: clock[0]), \
+                mock.patch.object(careful_rm.time, 'sleep', slept.append):
+            limiter = careful_rm.RateLimiter(ops_rate=10, bytes_rate=100)
+            for _ in range(10):
+                limiter.wait()
+            self.assertEqual(slept, [])
+            limiter.wait()
+            self.assertEqual(slept, [0.1])
+            # Bytes over the burst are debt, the longest wait is slept
+            clock[0] += 1
+            limiter.wait(0, 250)
+            self.assertEqual(slept[-1], 1.5)
+            # Nothing is refilled past one second's worth
+            clock[0] += 60
+            limiter.wait(0, 100)
+            self.assertEqual(len(slept), 2)
+            limiter.wait(0, 50)
+            self.assertEqual(slept[-1], 0.5)
+
+    def test_max_ops_per_sec(self):
+        """--max-ops-per-sec slows deletion down to the rate given."""
+        self.make_tree(*['d/f{0}'.format(i) for i in range(10)])
+        start = time.time()
+        code, _ = self.rm(['--direct', '-rf', '--max-ops-per-sec=5', 'd'])
+        # 11 operations, 5 of them free
+        self.assertGreaterEqual(time.time() - start, 1.0)
+        self.assertEqual(code, 0)
+        self.assertFalse(os.path.lexists(self.path('d')))
+        code, err = self.rm(['--max-ops-per-sec=fast', 'd'])
+        self.assertEqual(code, 99)
+        self.assertIn('Invalid value for --max-ops-per-sec', err)
+
+    def test_dedup_links_and_restores(self):
+        """--dedup stores identical files once, restores them unshared."""
+        trash = self.home_trash()
+        self.make_tree('home/a', 'home/b')
+        mtimes = {'a': 1500000000123456789, 'b': 1600000000987654321}
+        for name, mtime in mtimes.items():
+            pth = os.path.join(self.home, name)
+            with open(pth, 'wb') as fout:
+                fout.write(b'x' * careful_rm.DEDUP_MIN_SIZE)
+            os.utime(pth, ns=(mtime, mtime))
+        code, _ = self.rm(['-c', '--dedup', 'a', 'b'], cwd=self.home)
+        self.assertEqual(code, 0)
+        files = os.path.join(trash, 'files')
+        self.assertTrue(os.path.samefile(
+            os.path.join(files, 'a'), os.path.join(files, 'b')
+        ))
+        records = careful_rm.read_index(trash)
+        self.assertEqual(records['a']['object'], records['b']['object'])
+        self.assertEqual(sorted(
+            records[i]['usage'] for i in records
+        ), [0, careful_rm.DEDUP_MIN_SIZE])
+        code, _ = self.rm(['--restore', os.path.join(self.home, '*')])
+        self.assertEqual(code, 0)
+        for name, mtime in mtimes.items():
+            st = os.lstat(os.path.join(self.home, name))
+            self.assertEqual(st.st_nlink, 1)
+            self.assertEqual(st.st_mtime_ns, mtime)
+        # The stored copy went with the last file linked to it
+        self.assertEqual(
+            os.listdir(os.path.join(trash, careful_rm.DEDUP_DIR)), []
+        )
+
+    def test_compressed_items_restored(self):
+        """Compressed items come back decompressed, with mode and mtime."""
+        trash = self.home_trash()
+        data = b'log line\n' * 20000
+        with open(os.path.join(self.home, 'log'), 'wb') as fout:
+            fout.write(data)
+        os.chmod(os.path.join(self.home, 'log'), 0o640)
+        os.utime(os.path.join(self.home, 'log'), (1500000000, 1500000000))
+        self.make_tree('home/small')
+        code, _ = self.rm(['-c', 'log', 'small'], cwd=self.home)
+        self.assertEqual(code, 0)
+        count, saved = careful_rm.compress_trash(trash, older_than=0)
+        # small is under COMPRESS_MIN_SIZE, so not even tried
+        self.assertEqual(count, 1)
+        self.assertGreater(saved, 0)
+        self.assertEqual(sorted(os.listdir(os.path.join(trash, 'files'))),
+                         ['log.gz', 'small'])
+        self.assertEqual(careful_rm.read_index(trash)['log.gz']['codec'], 'gz')
+        code, _ = self.rm(['--restore', os.path.join(self.home, 'log')])
+        self.assertEqual(code, 0)
+        pth = os.path.join(self.home, 'log')
+        with open(pth, 'rb') as fin:
+            self.assertEqual(fin.read(), data)
+        self.assertEqual(os.stat(pth).st_mode & 0o777, 0o640)
+        self.assertEqual(os.stat(pth).st_mtime, 1500000000)
+        self.assertFalse(os.path.lexists(
+            os.path.join(trash, 'files', 'log.gz')
+        ))
+
+    def test_expand_globs_lists_each_directory_once(self):
+        """Patterns in one directory share a single listing."""
+        self.make_tree('b/x.o', 'b/y.o', 'b/x.d', 'b/.h.o', 'b/z.tmp',
+                       'c1/x.o', 'c2/x.o', 'c2/y.d')
+        scanned = []
+        scan_dir = careful_rm.scan_dir
+
+        def counting(path):
+            scanned.append(path)
+            return scan_dir(path)
+        patterns = [self.path('b', i) for i in ('*.o', '*.d', '*.tmp')]
+        with mock.patch.object(careful_rm, 'scan_dir', counting):
+            paths, entries = careful_rm.expand_globs(patterns)
+        self.assertEqual(scanned, [self.path('b')])
+        # Each pattern's matches in turn, hidden files left out
+        self.assertEqual(
+            [sorted(paths[:2]), paths[2:]],
+            [[self.path('b', 'x.o'), self.path('b', 'y.o')],
+             [self.path('b', 'x.d'), self.path('b', 'z.tmp')]]
+        )
+        self.assertEqual(sorted(entries), sorted(paths))
+        self.assertTrue(entries[self.path('b', 'x.d')].is_file())
+        # Wildcards in the directory, and patterns for hidden files
+        paths, _ = careful_rm.expand_globs(
+            [self.path('c*', 'x.o'), self.path('b', '.*.o')]
+        )
+        self.assertEqual(sorted(paths[:2]),
+                         [self.path('c1', 'x.o'), self.path('c2', 'x.o')])
+        self.assertEqual(paths[2:], [self.path('b', '.h.o')])
+
+    def test_expand_globs_takes_existing_paths(self):
+        """Paths that exist are not globbed, missing literals pass through."""
+        self.make_tree('a[1]', 'a1')
+        paths, entries = careful_rm.expand_globs(
+            [self.path('a[1]'), self.path('missing'), self.path('none*')]
+        )
+        self.assertEqual(paths, [self.path('a[1]'), self.path('missing')])
+        self.assertEqual(entries, {})
+        code, _ = self.rm(['--direct', 'a[1]'])
+        self.assertEqual(code, 0)
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['a1', 'home'])
+
+    def test_format_list_preview(self):
+        """Long lists show a head and tail, then the biggest groups."""
+        names = ['src/f{0}.c'.format(i) for i in range(600)] + \
+            ['doc/f{0}.txt'.format(i) for i in range(400)]
+        infos = {i: mock.Mock(st_size=1024) for i in names}
+        with mock.patch.object(careful_rm, 'get_term_width', lambda: 80):
+            out = careful_rm.format_list(names, infos=infos)
+            short = careful_rm.format_list(['a', 'b'])
+        self.assertIn("'src/f0.c'", out)
+        self.assertIn("'doc/f399.txt'", out)
+        self.assertNotIn("'src/f300.c'", out)
+        half = careful_rm.LIST_PREVIEW // 2
+        self.assertIn('... {0} more ...'.format(1000 - 2 * half), out)
+        self.assertIn('By directory (2 in all): src (600), doc (400)', out)
+        self.assertIn('By extension (2 in all): .c (600), .txt (400)', out)
+        self.assertIn('Total size: 1000.0 KB', out)
+        self.assertEqual(short, "'a', 'b'")
+
+    def test_yesno_pages_long_lists(self):
+        """'l' pages the full list, then asks again."""
+        names = ['f{0}'.format(i) for i in range(careful_rm.LIST_PREVIEW + 1)]
+        answers = iter(['l', 'y', 'y'])
+        asked = []
+
+        def get_ans(message, options, default, key=None):
+            asked.append((message, options))
+            return next(answers)
+        paged = []
+        with mock.patch.object(careful_rm, 'get_ans', get_ans), \
+                mock.patch.object(careful_rm, 'page_list', paged.append):
+            self.assertTrue(careful_rm.yesno('Remove?', full_list=names))
+            self.assertTrue(careful_rm.yesno('Remove?', full_list=names[:2]))
+        self.assertEqual(paged, [names])
+        self.assertEqual(asked[0], (
+            'Remove? (l to list all {0})'.format(len(names)), ['y', 'n', 'l']
+        ))
+        self.assertEqual(len(asked), 3)
+        self.assertEqual(asked[2], ('Remove?', ['y', 'n']))
+
+    def test_page_list(self):
+        """The list goes to $PAGER, or to STDERR if there is none."""
+        out = self.path('paged')
+        pager = 'sh -c "cat > {0}"'.format(out)
+        with mock.patch.dict(os.environ, {'PAGER': pager}):
+            careful_rm.page_list(['a', 'b c'])
+        with open(out) as fin:
+            self.assertEqual(fin.read(), "a\n'b c'\n")
+        err = mock.Mock()
+        with mock.patch.dict(os.environ, {'PAGER': self.path('no_pager')}), \
+                mock.patch.object(careful_rm.sys, 'stderr', err):
+            careful_rm.page_list(['a'])
+        err.write.assert_called_once_with('a\n')
+
+
+if __name__ == '__main__':
+    unittest.main()